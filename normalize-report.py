@@ -1,16 +1,119 @@
-from normalize import build_droid_profile, batch_norm
+from normalize import build_droid_profile, batch_norm, tool_names, LibreOfficePool, IdentificationCache,\
+                      iter_droid_profile_sharded, iter_droid_profile_batches, placement_strategies, RunMetrics,\
+                      InkscapePool, CostModel, SQLiteJobQueue, coordinate, run_worker,\
+                      RunResults, result_queries, watch_and_normalize, droid_sign_file
+from signature_matcher import SignatureMatcher
+from contextlib import ExitStack
 import argparse
+import sys
 
-def main(working_dir, target_dir):
+def main(working_dir, target_dir, workers=1, tool_limits=None, libreoffice_pool=0,
+         libreoffice_batch_size=20, libreoffice_max_conversions=500, id_cache=None,
+         id_cache_max_entries=1000000, id_cache_verify_hash=False, resume=False, droid_shards=1,
+         droid_shard_balance='count', stream=False, stream_queue_size=256, stream_batch_size=200,
+         placement='copy', dedup=False, dedup_store=None, event_log=None, metrics_file=None, metrics_port=None,
+         inkscape_pool=0, inkscape_max_conversions=200, schedule='profile', cost_history=(), probe_media=False, role='local',
+         queue=None, lease_seconds=300, results_db=None, watch=False, watch_settle_seconds=2.0, watch_batch_size=50,
+         watch_poll=None, watch_existing=False, expand_archives=False, scratch_dir=None, scratch_mb=1024):
     """
     Main function to build the DROID profile for a directory and perform batch normalization.
+    As a 'coordinator' the files are queued in `queue` for 'worker' processes on any host to normalize.
+    With `watch` nothing is profiled up front; files are normalized as they arrive until interrupted.
+    With `expand_archives` the members of ZIP and TAR archives are normalized without extracting them.
     """
+    with ExitStack() as stack:
+        job_queue = None
+        if role != 'local':
+            job_queue = stack.enter_context(SQLiteJobQueue(queue, lease_seconds=lease_seconds))
+        if role == 'worker':
+            # the coordinator records the working and target directories in the queue
+            svg_pool = None
+            if inkscape_pool:
+                svg_pool = stack.enter_context(InkscapePool(size=inkscape_pool, max_conversions=inkscape_max_conversions))
+            run_worker(job_queue, workers=workers, placement=placement, inkscape_pool=svg_pool)
+            return
 
-    # Build the DROID profile for the working directory
-    droid_profile = build_droid_profile(working_dir)
-    
-    # Perform batch normalization on the files identified in the DROID profile
-    batch_norm(droid_profile, target_dir)
+        cache = None
+        if id_cache:
+            cache = stack.enter_context(IdentificationCache(id_cache, max_entries=id_cache_max_entries,
+                                                            verify_hash=id_cache_verify_hash))
+
+        pool = None
+        if libreoffice_pool:
+            pool = stack.enter_context(LibreOfficePool(size=libreoffice_pool, batch_size=libreoffice_batch_size,
+                                                       max_conversions=libreoffice_max_conversions))
+
+        svg_pool = None
+        if inkscape_pool:
+            svg_pool = stack.enter_context(InkscapePool(size=inkscape_pool, max_conversions=inkscape_max_conversions))
+
+        metrics = None
+        if metrics_file or metrics_port is not None:
+            metrics = stack.enter_context(RunMetrics(path=metrics_file, port=metrics_port))
+
+        archive_args = {}
+        if expand_archives:
+            # members are identified from their header bytes against DROID's own signature file
+            archive_args = {'expand_archives': True, 'scratch_dir': scratch_dir, 'scratch_bytes': int(scratch_mb * 1e6),
+                            'matcher': SignatureMatcher(droid_sign_file)}
+
+        if watch:
+            # polling every watch_poll seconds instead of inotify, e.g. for network shares
+            watch_and_normalize(working_dir, target_dir, cache=cache, batch_size=watch_batch_size,
+                                settle_seconds=watch_settle_seconds, poll_interval=watch_poll or 2.0,
+                                use_inotify=watch_poll is None, initial_scan=watch_existing, workers=workers,
+                                tool_limits=tool_limits, libreoffice_pool=pool, resume=resume, placement=placement,
+                                dedup=dedup, dedup_store=dedup_store, event_log=event_log, metrics=metrics,
+                                inkscape_pool=svg_pool, results_db=results_db, **archive_args)
+            return
+
+        # Build the DROID profile for the working directory, reusing cached identifications if asked to
+        if stream:
+            # small DROID batches feed the converters while the rest of the tree is still being identified
+            droid_profile = iter_droid_profile_batches(working_dir, batch_size=stream_batch_size,
+                                                       processes=max(1, droid_shards), cache=cache)
+        elif cache is not None:
+            droid_profile = build_droid_profile(working_dir, cache=cache)
+        elif droid_shards > 1:
+            # rows stream in as each shard finishes
+            droid_profile = iter_droid_profile_sharded(working_dir, shards=droid_shards, balance=droid_shard_balance)
+        else:
+            droid_profile = build_droid_profile(working_dir)
+
+        if role == 'coordinator':
+            coordinate(droid_profile, job_queue, target_dir, working_dir=working_dir)
+            return
+
+        # Perform batch normalization on the files identified in the DROID profile
+        batch_norm(droid_profile, target_dir, working_dir=working_dir, workers=workers,
+                   tool_limits=tool_limits, libreoffice_pool=pool, resume=resume,
+                   stream_queue_size=stream_queue_size if stream else None, placement=placement,
+                   dedup=dedup, dedup_store=dedup_store, event_log=event_log, metrics=metrics,
+                   inkscape_pool=svg_pool, schedule=schedule,
+                   cost_model=CostModel(cost_history, probe_media=probe_media) if schedule == 'lpt' else None,
+                   results_db=results_db,
+                   **archive_args)
+
+
+def print_results(results_db, query, run_id=None):
+    """
+    Prints one of the result_queries over a run recorded with --results-db as tab-separated rows.
+    """
+    with RunResults(results_db) as results:
+        columns, rows = results.query(query, run_id)
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if value is None else str(value) for value in row))
+
+
+def parse_tool_limit(value):
+    """
+    Parses a TOOL=N command-line value into a (tool, limit) pair.
+    """
+    tool, sep, limit = value.partition('=')
+    if not sep or tool not in tool_names or not limit.isdigit() or int(limit) < 1:
+        raise argparse.ArgumentTypeError(f"expected TOOL=N with TOOL one of {', '.join(tool_names)}, got {value!r}")
+    return tool, int(limit)
 
 
 if __name__ == '__main__':
@@ -28,14 +131,162 @@ if __name__ == '__main__':
     python normalize-report.py /path/to/input /path/to/output
     Examine usage, note working-dir and target-dir are required args
     python normalize-report.py --working-dir my_project/input --target_dir my_project/output
+    Run up to 8 conversions per tool at once, but only 2 ffmpeg transcodes
+    python normalize-report.py --workers 8 --tool-limit ffmpeg=2
+    Convert documents in batches on 4 LibreOffice instances
+    python normalize-report.py --workers 8 --libreoffice-pool 4
+    Only send new or changed files to DROID on nightly re-runs
+    python normalize-report.py --id-cache /app/output/.identification.sqlite
+    Pick up where a killed run stopped, or only process what changed since the last run
+    python normalize-report.py --resume
+    Profile a very large tree with 8 DROID processes
+    python normalize-report.py --droid-shards 8 --droid-shard-balance bytes --workers 8
+    Convert files as soon as they are identified, with 2 DROID processes feeding the converters
+    python normalize-report.py --stream --droid-shards 2 --workers 8
+    Clone or kernel-copy files that need no conversion instead of copying them through Python
+    python normalize-report.py --placement auto
+    Convert each distinct file once, across runs, linking the derivative to every copy
+    python normalize-report.py --dedup-store /app/output/.derivatives --placement hardlink
+    Log per-file timings and converter resource use, and serve Prometheus metrics while running
+    python normalize-report.py --event-log /app/output/events.jsonl --metrics-port 9464
+    Convert EPS and PostScript on 4 long-lived Inkscape shell processes
+    python normalize-report.py --workers 4 --inkscape-pool 4
+    Start the longest conversions first, predicted from the event logs of earlier runs
+    python normalize-report.py --workers 8 --schedule lpt --cost-history /app/output/events.jsonl --event-log /app/output/events.jsonl
+    Spread a run over several hosts sharing storage: one coordinator, and a worker per host
+    python normalize-report.py --role coordinator --queue /shared/jobs.sqlite --working_dir /shared/input --target_dir /shared/output
+    python normalize-report.py --role worker --queue /shared/jobs.sqlite --workers 8
+    Record results on disk instead of in memory, then list the failures by MIME type without rerunning
+    python normalize-report.py --results-db /app/output/results.sqlite
+    python normalize-report.py --results-db /app/output/results.sqlite --query failures-by-mime
+    Run as a hot folder, normalizing files within seconds of them being written to the working directory
+    python normalize-report.py --watch --watch-existing --id-cache /app/output/.identification.sqlite
+    Normalize the members of ZIP and TAR bundles without extracting them, spooling at most 2 GB for conversion
+    python normalize-report.py --expand-archives --scratch-dir /app/scratch --scratch-mb 2000
     """
     # Define the command-line arguments
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--working_dir', help='The working directory to search for files', default='/app/input')
     parser.add_argument('--target_dir', help='The target directory to move or copy files to', default='/app/output')
+    parser.add_argument('--workers', type=int, default=1, help='Number of concurrent conversions per tool (default: 1, sequential)')
+    parser.add_argument('--tool-limit', type=parse_tool_limit, action='append', default=[], metavar='TOOL=N',
+                        help=f"Cap concurrent jobs for one tool ({', '.join(tool_names)}); may be repeated")
+    parser.add_argument('--libreoffice-pool', type=int, default=0, metavar='N',
+                        help='Convert documents in batches on N LibreOffice instances with their own profiles (default: off)')
+    parser.add_argument('--libreoffice-batch-size', type=int, default=20, help='Documents per soffice call in pooled mode')
+    parser.add_argument('--libreoffice-max-conversions', type=int, default=500,
+                        help='Documents an instance converts before its profile is recycled')
+    parser.add_argument('--id-cache', metavar='PATH', help='SQLite file caching DROID results so unchanged files are not re-identified')
+    parser.add_argument('--id-cache-max-entries', type=int, default=1000000, help='Entries kept in the identification cache')
+    parser.add_argument('--id-cache-verify-hash', action='store_true',
+                        help='Confirm cache hits by SHA-256 and reuse results for byte-identical files')
+    parser.add_argument('--resume', '--incremental', action='store_true',
+                        help='Keep a progress journal in the target directory and skip files whose output is already current')
+    parser.add_argument('--droid-shards', type=int, default=1, metavar='N',
+                        help='Profile the working directory with N DROID processes in parallel (with --id-cache, only together with --stream)')
+    parser.add_argument('--droid-shard-balance', choices=['count', 'bytes'], default='count',
+                        help='Balance DROID shards by number of files or by bytes')
+    parser.add_argument('--stream', action='store_true',
+                        help='Start converting while DROID is still identifying, in batches of --stream-batch-size files')
+    parser.add_argument('--stream-queue-size', type=int, default=256, help='Identified rows buffered ahead of the converters')
+    parser.add_argument('--stream-batch-size', type=int, default=200, help='Files per DROID run in streaming mode')
+    parser.add_argument('--placement', choices=list(placement_strategies), default='copy',
+                        help="How files that are not converted reach the target directory: 'copy' (default), "
+                             "'auto' (reflink, then kernel-side copy, then copy) or 'hardlink' (hardlink first, shares the original's inode)")
+    parser.add_argument('--dedup', action='store_true', help='Convert byte-identical files once and reuse the derivative')
+    parser.add_argument('--dedup-store', metavar='DIR',
+                        help='Keep derivatives in DIR, keyed by source content, for reuse by later runs (implies --dedup)')
+    parser.add_argument('--event-log', metavar='PATH',
+                        help='Append a JSON record per file (size, PUID, function, timings, converter CPU and memory) to PATH')
+    parser.add_argument('--metrics-file', metavar='PATH', help='Write live aggregate metrics in Prometheus text format to PATH')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT', help='Serve the metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--inkscape-pool', type=int, default=0, metavar='N',
+                        help='Convert PostScript on N long-lived `inkscape --shell` processes (default: off)')
+    parser.add_argument('--inkscape-max-conversions', type=int, default=200,
+                        help='Files an Inkscape process converts before it is restarted')
+    parser.add_argument('--schedule', choices=['profile', 'lpt'], default='profile',
+                        help="Dispatch files in profile order (default) or costliest first within each tool ('lpt'); not with --stream")
+    parser.add_argument('--cost-history', action='append', default=[], metavar='PATH',
+                        help='An --event-log file from an earlier run to predict conversion times from; may be repeated')
+    parser.add_argument('--probe-media', action='store_true',
+                        help='With --schedule lpt, ffprobe audio and video without history for their duration to predict their cost')
+    parser.add_argument('--role', choices=['local', 'coordinator', 'worker'], default='local',
+                        help="'local' (default) normalizes here; a 'coordinator' queues the files in --queue for 'worker' processes on any host")
+    parser.add_argument('--queue', metavar='PATH', help='SQLite job queue shared by the coordinator and workers')
+    parser.add_argument('--lease-seconds', type=float, default=300,
+                        help='How long a worker holds a job without a heartbeat before it is retried elsewhere')
+    parser.add_argument('--results-db', metavar='PATH',
+                        help='Record every file\'s result in an SQLite file as it finishes, keeping only counts in memory')
+    parser.add_argument('--query', choices=list(result_queries),
+                        help='Print a report from --results-db instead of normalizing anything')
+    parser.add_argument('--run', type=int, metavar='ID', help='The run to --query, the latest by default')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and normalize files as they are written to the working directory, until interrupted')
+    parser.add_argument('--watch-settle-seconds', type=float, default=2.0,
+                        help='How long a file must stay unchanged before it is treated as fully written')
+    parser.add_argument('--watch-batch-size', type=int, default=50, help='Most arrived files identified and normalized together')
+    parser.add_argument('--watch-poll', type=float, metavar='SECONDS',
+                        help='Poll the working directory every SECONDS instead of using inotify, e.g. on network shares')
+    parser.add_argument('--watch-existing', action='store_true',
+                        help='Also normalize the files already in the working directory when watching starts')
+    parser.add_argument('--expand-archives', action='store_true',
+                        help='Normalize the members of ZIP and TAR archives by streaming them, without extracting the archives')
+    parser.add_argument('--scratch-dir', metavar='DIR', help='Where archive members are spooled for conversion (default: system temp)')
+    parser.add_argument('--scratch-mb', type=float, default=1024,
+                        help='Most MB of archive members spooled at once; a larger member is spooled on its own')
     args = parser.parse_args()
+    if args.query:
+        if not args.results_db:
+            parser.error('--query needs --results-db')
+        print_results(args.results_db, args.query, args.run)
+        sys.exit(0)
+    if args.role != 'local' and not args.queue:
+        parser.error('--role coordinator and --role worker need --queue')
+    if args.expand_archives and (args.role != 'local' or args.schedule != 'profile'):
+        parser.error('--expand-archives cannot be combined with --role or --schedule lpt')
+    if args.probe_media and args.schedule != 'lpt':
+        parser.error('--probe-media needs --schedule lpt')
+    if args.watch and (args.role != 'local' or args.stream or args.schedule != 'profile'):
+        parser.error('--watch runs locally and cannot be combined with --role, --stream or --schedule lpt')
 
     # Call the main function with the parsed arguments
     main(working_dir=args.working_dir, 
-         target_dir=args.target_dir)
\ No newline at end of file
+         target_dir=args.target_dir,
+         workers=args.workers,
+         tool_limits=dict(args.tool_limit),
+         libreoffice_pool=args.libreoffice_pool,
+         libreoffice_batch_size=args.libreoffice_batch_size,
+         libreoffice_max_conversions=args.libreoffice_max_conversions,
+         id_cache=args.id_cache,
+         id_cache_max_entries=args.id_cache_max_entries,
+         id_cache_verify_hash=args.id_cache_verify_hash,
+         resume=args.resume,
+         droid_shards=args.droid_shards,
+         droid_shard_balance=args.droid_shard_balance,
+         stream=args.stream,
+         stream_queue_size=args.stream_queue_size,
+         stream_batch_size=args.stream_batch_size,
+         placement=args.placement,
+         dedup=args.dedup,
+         dedup_store=args.dedup_store,
+         event_log=args.event_log,
+         metrics_file=args.metrics_file,
+         metrics_port=args.metrics_port,
+         inkscape_pool=args.inkscape_pool,
+         inkscape_max_conversions=args.inkscape_max_conversions,
+         schedule=args.schedule,
+         cost_history=args.cost_history,
+         probe_media=args.probe_media,
+         role=args.role,
+         queue=args.queue,
+         lease_seconds=args.lease_seconds,
+         results_db=args.results_db,
+         watch=args.watch,
+         watch_settle_seconds=args.watch_settle_seconds,
+         watch_batch_size=args.watch_batch_size,
+         watch_poll=args.watch_poll,
+         watch_existing=args.watch_existing,
+         expand_archives=args.expand_archives,
+         scratch_dir=args.scratch_dir,
+         scratch_mb=args.scratch_mb)
@@ -2,63 +2,766 @@ import os
 import subprocess
 import json
 from typing import Dict
-from pydub import AudioSegment
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 import sys
 import mimetypes
 import shlex
 import csv
 import argparse
-from shutil import copyfile, copy
+from shutil import copyfile, copy, rmtree, copyfileobj, SameFileError
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque, namedtuple, OrderedDict, Counter
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
 import pprint
+import errno
+try:
+    import fcntl
+except ImportError:  # not available on Windows, reflinks are then never attempted
+    fcntl = None
+import threading
+import hashlib
+import sqlite3
+import pathlib
+import posixpath
+import tarfile
+import zipfile
+import queue
+import time
+import asyncio
+import functools
+import signal
+import selectors
+import struct
+import socket
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 droid_cmd = 'java -jar droid-command-line-6.6.1.jar'
 droid_sign_file = "DROID_SignatureFile_V111.xml"
 libreoffice_cmd = 'soffice'
+inkscape_cmd = 'inkscape'
+ffprobe_cmd = 'ffprobe'
 
+# Output settings of every MP3 derivative, shared by norm_to_mp3 and norm_file
+mp3_ffmpeg_args = ['-vn', '-ar', '44100', '-ac', '2', '-ab', '192k', '-f', 'mp3']
 
-def build_droid_profile(dirpath):
+# Threads each ffmpeg process may use, None for ffmpeg's own default. A parallel batch_norm run that leaves
+# this unset passes its own share of the cores to each conversion instead
+ffmpeg_threads = None
+
+# Codecs norm_to_mp4 copies into the MP4 container as they are
+mp4_video_codecs = {'h264'}
+mp4_audio_codecs = {'aac'}
+
+# How long each conversion may run before its converter is killed, as (base seconds, seconds per MB of input).
+# The allowance grows with file size so hung converters are reaped without cutting off long legitimate jobs.
+conversion_timeouts = {
+    'probe_streams': (60, 0),
+    'norm_to_mp4': (300, 30),
+    'norm_to_mp3': (120, 5),
+    'norm_to_doc': (300, 10),
+    'norm_to_pdf': (300, 10),
+    'norm_to_svg': (120, 10),
+}
+
+_conversion_notes = threading.local()
+
+
+def note_conversion(key, value):
     """
-    This function uses DROID to identify the MIME type and other metadata for all files in a specified directory. 
-    It creates a DROID profile for the directory, extracts the metadata into a CSV file, and then reads this CSV file into a list of dictionaries.
+    Records a detail of the conversion running on this thread, such as which path norm_to_mp4 took.
+    batch_norm counts these per key in its status_dict; outside of batch_norm they are discarded.
+    """
+    notes = getattr(_conversion_notes, 'current', None)
+    if notes is not None:
+        notes[key] = value
+
+
+def add_conversion_cost(key, amount):
+    """
+    Adds to a numeric detail of the conversion running on this thread, such as the CPU seconds its tools used.
+    """
+    notes = getattr(_conversion_notes, 'current', None)
+    if notes is not None:
+        notes[key] = notes.get(key, 0) + amount
+
+
+def note_peak(key, amount):
+    """
+    Keeps the largest value seen for a detail of the conversion running on this thread, such as a tool's peak memory.
+    """
+    notes = getattr(_conversion_notes, 'current', None)
+    if notes is not None:
+        notes[key] = max(notes.get(key, amount), amount)
+
+
+# What a converter run produced: its exit status, the tail of its output, and the resources wait4 reported for it
+ToolResult = namedtuple('ToolResult', ['returncode', 'stdout', 'stderr', 'cpu_seconds', 'max_rss_kb', 'timed_out'])
+
+
+class ToolEngine:
+    """
+    Runs external converters as subprocesses on an asyncio event loop in a background thread.
+
+    Each tool has a number of slots, so no more than its limit of processes run at once however many
+    threads call run. Processes are started off the loop, since fork and exec block. Every process starts
+    in its own session, and when its timeout expires the whole process group is killed, including helpers
+    it spawned. Its exit is awaited through a pidfd where the platform has one, then it is reaped with wait4
+    for its rusage, so nothing polls. stdout and stderr are captured, keeping the last output_limit bytes
+    of each.
 
     Parameters:
-    dirpath (str): The path to the directory to be profiled.
+    limits (dict, optional): Concurrent processes allowed per tool name. Tools not listed are not limited.
+    output_limit (int): Bytes of stdout and of stderr kept per process.
+    """
+
+    def __init__(self, limits=None, output_limit=64 * 1024):
+        self.output_limit = output_limit
+        self.limits = dict(limits or {})
+        # processes running per tool; only touched on the loop's thread
+        self._running = {}
+        self._loop = asyncio.new_event_loop()
+        self._slot_freed = asyncio.Condition()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='norm-tools', daemon=True)
+        self._thread.start()
+
+    def run(self, cmd, tool=None, timeout=None, shell=False):
+        """
+        Runs a command to completion from any thread and returns its ToolResult.
+        """
+        return asyncio.run_coroutine_threadsafe(self.run_async(cmd, tool, timeout, shell), self._loop).result()
+
+    async def run_async(self, cmd, tool=None, timeout=None, shell=False):
+        """
+        Runs a command on the engine's loop, waiting for a slot of tool first, and returns its ToolResult.
+        """
+        async with self._slot_freed:
+            await self._slot_freed.wait_for(lambda: self.limits.get(tool) is None or
+                                            self._running.get(tool, 0) < self.limits[tool])
+            self._running[tool] = self._running.get(tool, 0) + 1
+        try:
+            return await self._execute(cmd, timeout, shell)
+        finally:
+            async with self._slot_freed:
+                self._running[tool] -= 1
+                self._slot_freed.notify_all()
+
+    async def _execute(self, cmd, timeout, shell):
+        loop = asyncio.get_running_loop()
+        starting = loop.run_in_executor(None, functools.partial(
+            subprocess.Popen, cmd, shell=shell, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, start_new_session=True))
+        try:
+            proc = await asyncio.shield(starting)
+        except asyncio.CancelledError:
+            # the process may still be starting; kill and reap it once it has
+            starting.add_done_callback(lambda f: f.cancelled() or f.exception() or self._abandon(loop, f.result()))
+            raise
+        outputs = [self._capture(loop, proc.stdout), self._capture(loop, proc.stderr)]
+        exited = self._wait_exit(loop, proc.pid)
+        timed_out = False
+        try:
+            await asyncio.wait_for(asyncio.shield(exited), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            kill_process_group(proc.pid)
+        except BaseException:
+            kill_process_group(proc.pid)
+            raise
+        finally:
+            # reaped even when this task is cancelled after the group was killed
+            status, usage = await asyncio.shield(exited)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # a helper that left the group can hold the pipes open, so do not wait on them for long
+        done, still_open = await asyncio.wait(outputs, timeout=1)
+        for future in still_open:
+            future.cancel()
+        stdout, stderr = (future.result() if future in done else b'' for future in outputs)
+        return ToolResult(proc.returncode, stdout, stderr, usage.ru_utime + usage.ru_stime, usage.ru_maxrss, timed_out)
+
+    def _abandon(self, loop, proc):
+        """
+        Kills and reaps a process whose caller was cancelled while it was being started.
+        """
+        kill_process_group(proc.pid)
+        self._wait_exit(loop, proc.pid)
+        proc.stdout.close()
+        proc.stderr.close()
+
+    def _capture(self, loop, pipe):
+        """
+        Reads a pipe as data arrives, returning a future of the last output_limit bytes once it closes.
+        """
+        fd = pipe.fileno()
+        os.set_blocking(fd, False)
+        captured = bytearray()
+        future = loop.create_future()
+
+        def finish():
+            loop.remove_reader(fd)
+            pipe.close()
+            if not future.done():
+                future.set_result(bytes(captured))
+
+        def read():
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                finish()
+                return
+            captured.extend(data)
+            del captured[:-self.output_limit]
+
+        loop.add_reader(fd, read)
+        future.add_done_callback(lambda f: f.cancelled() and finish())
+        return future
+
+    def _wait_exit(self, loop, pid):
+        """
+        Returns a future of the wait4 status and rusage of a child, resolved once it exits.
+        """
+        if not hasattr(os, 'pidfd_open'):
+            return asyncio.ensure_future(loop.run_in_executor(None, lambda: os.wait4(pid, 0)[1:]))
+        pidfd = os.pidfd_open(pid)
+        future = loop.create_future()
+
+        def reap():
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+            future.set_result(os.wait4(pid, 0)[1:])
+
+        loop.add_reader(pidfd, reap)
+        return future
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def kill_process_group(pid):
+    """
+    Kills every process in the group a ToolEngine started a converter in.
+    """
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+_tool_engine = None
+_tool_engine_lock = threading.Lock()
+_run_engine = threading.local()
+
+
+def get_tool_engine():
+    """
+    Returns the ToolEngine converters on this thread use: the engine of the batch_norm run the thread is
+    working for, see using_tool_engine, or else the shared one, created on first use with
+    resolve_tool_limits for the CPU count.
+    """
+    global _tool_engine
+    engine = getattr(_run_engine, 'current', None)
+    if engine is not None:
+        return engine
+    with _tool_engine_lock:
+        if _tool_engine is None:
+            _tool_engine = ToolEngine(resolve_tool_limits(os.cpu_count() or 1))
+        return _tool_engine
+
+
+@contextmanager
+def using_tool_engine(engine):
+    """
+    Runs the converters started on this thread within the block on engine, or on the shared one if it is None.
+    """
+    previous = getattr(_run_engine, 'current', None)
+    _run_engine.current = engine
+    try:
+        yield engine
+    finally:
+        _run_engine.current = previous
+
+
+def conversion_timeout(function_name, filepaths):
+    """
+    Returns the seconds a converter may run on some files before it is killed, per conversion_timeouts, or None.
+    """
+    allowance = conversion_timeouts.get(function_name)
+    if allowance is None:
+        return None
+    base, per_mb = allowance
+    total = 0
+    for filepath in filepaths:
+        try:
+            total += os.path.getsize(filepath)
+        except OSError:
+            pass
+    return base + per_mb * total / 1e6
+
+
+def run_tool(cmd, shell=False, check=True, tool=None, timeout=None):
+    """
+    Runs an external converter on the shared ToolEngine like subprocess.check_call, and adds the CPU time
+    it used, taken from the rusage wait4 reports for it, to the current conversion's 'cpu_seconds'. Its
+    exit status and peak resident memory are noted as 'exit_code' and 'max_rss_kb' for the event log.
+    The converter's stderr is printed if it fails.
+
+    Parameters:
+    tool (str, optional): The tool class whose concurrency limit applies, see ToolEngine.
+    timeout (float, optional): Seconds after which the converter's process group is killed.
 
     Returns:
-    list: A list of dictionaries, where each dictionary contains the metadata for a file in the directory.
+    ToolResult: The result, only with a non-zero returncode or timed_out when check is False.
     """
-    md5_sum = 'temp'
-    create_profile_cmd = f"{droid_cmd} -R {dirpath} -Ns {droid_sign_file} -p {md5_sum}.droid"
-    args = shlex.split(create_profile_cmd)
+    result = get_tool_engine().run(cmd, tool, timeout, shell)
+    add_conversion_cost('cpu_seconds', result.cpu_seconds)
+    note_conversion('exit_code', result.returncode)
+    note_peak('max_rss_kb', result.max_rss_kb)
+    if result.returncode != 0 and result.stderr:
+        sys.stderr.write(result.stderr.decode(errors='replace'))
+    if check and result.timed_out:
+        raise subprocess.TimeoutExpired(cmd, timeout, result.stdout, result.stderr)
+    if check and result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+    return result
+
+
+@contextmanager
+def conversion_notes():
+    """
+    Collects the note_conversion calls made on this thread inside the block into the yielded dict.
+    """
+    notes = {}
+    outer = getattr(_conversion_notes, 'current', None)
+    _conversion_notes.current = notes
+    try:
+        yield notes
+    finally:
+        _conversion_notes.current = outer
+
+
+class IdentificationCache:
+    """
+    A persistent SQLite cache of DROID identification results.
+
+    Entries are keyed by absolute path and are reused while the file's size and modification time are
+    unchanged. With verify_hash the file's SHA-256 must also match, and a file whose path is not in the
+    cache can reuse the entry of a byte-identical file elsewhere. The whole cache is dropped whenever
+    droid_cmd or the contents of droid_sign_file change, and the least recently used entries are
+    evicted once it holds more than max_entries.
+
+    Parameters:
+    path (str): The SQLite database file.
+    max_entries (int): The most entries kept after each write.
+    verify_hash (bool): Whether to confirm hits against the content hash.
+    """
+
+    def __init__(self, path, max_entries=1000000, verify_hash=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.verify_hash = verify_hash
+        # digests computed recently, so a lookup and the put that follows it read each file once
+        self._digests = OrderedDict()
+        # a cache may be handed to a background thread, e.g. by prefetch, but is never used by two at once
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries (path TEXT, kind TEXT, size INTEGER, mtime_ns INTEGER, '
+                         'sha256 TEXT, row TEXT, last_used REAL, PRIMARY KEY (path, kind))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_sha256 ON entries (sha256, kind)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        fingerprint = droid_fingerprint()
+        stored = self._db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if stored is None or stored[0] != fingerprint:
+            self._db.execute('DELETE FROM entries')
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+        self._db.commit()
+
+    def get(self, filepath, kind='profile'):
+        """
+        Returns the cached row for filepath, or None if it is missing or stale.
+        """
+        filepath = os.path.abspath(filepath)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        entry = self._db.execute('SELECT size, mtime_ns, sha256, row FROM entries WHERE path = ? AND kind = ?',
+                                 (filepath, kind)).fetchone()
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            if not self.verify_hash or entry[2] == self._sha256(filepath, st):
+                self._touch(filepath, kind)
+                return json.loads(entry[3])
+        if self.verify_hash:
+            entry = self._db.execute('SELECT path, row FROM entries WHERE sha256 = ? AND kind = ? LIMIT 1',
+                                     (self._sha256(filepath, st), kind)).fetchone()
+            if entry:
+                row = json.loads(entry[1])
+                if 'FILE_PATH' in row:
+                    row['FILE_PATH'] = filepath
+                    row['NAME'] = os.path.basename(filepath)
+                self.put(filepath, row, kind)
+                return row
+        return None
+
+    def put(self, filepath, row, kind='profile'):
+        """
+        Stores the identification row for filepath.
+        """
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        sha256 = self._sha256(filepath, st) if self.verify_hash else None
+        self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (filepath, kind, st.st_size, st.st_mtime_ns, sha256, json.dumps(row), time.time()))
+
+    def _sha256(self, filepath, st, keep=1024):
+        """
+        Returns the digest of filepath, hashing it only if its size or modification time changed since it was last hashed.
+        """
+        key = (filepath, st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = self._digests[key] = file_sha256(filepath)
+            if len(self._digests) > keep:
+                self._digests.popitem(last=False)
+        else:
+            self._digests.move_to_end(key)
+        return digest
+
+    def _touch(self, filepath, kind):
+        self._db.execute('UPDATE entries SET last_used = ? WHERE path = ? AND kind = ?', (time.time(), filepath, kind))
+
+    def commit(self):
+        """
+        Evicts the least recently used entries beyond max_entries and writes pending changes to disk.
+        """
+        self._db.execute('DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY last_used DESC '
+                         'LIMIT -1 OFFSET ?)', (self.max_entries,))
+        self._db.commit()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def file_sha256(filepath, chunk_size=1024 * 1024):
+    """
+    Returns the hex SHA-256 digest of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def droid_fingerprint():
+    """
+    Identifies the DROID build and signature file in use, so cached identifications can be invalidated when either changes.
+    """
+    fingerprint = f'{droid_cmd}|{droid_sign_file}'
+    if os.path.exists(droid_sign_file):
+        fingerprint += '|' + file_sha256(droid_sign_file)
+    return fingerprint
+
+
+def export_droid_profile(resource_args, work_dir):
+    """
+    Runs DROID in profile mode over the given resource arguments and exports the profile to a CSV file.
+
+    Every run uses its own work_dir, so concurrent runs never overwrite each other's profile or export.
+
+    Returns:
+    str: The path of the exported CSV, which may be missing if DROID failed.
+    """
+    profile_path = os.path.join(work_dir, 'profile.droid')
+    output_path = os.path.join(work_dir, 'profile.droid_output')
+    args = shlex.split(droid_cmd) + resource_args + ['-Ns', droid_sign_file, '-p', profile_path]
     subprocess.call(args)
 
     # extract the metadata
-    extract_metadata_cmd = f"{droid_cmd} -p {md5_sum}.droid -e {md5_sum}.droid_output"
-    args = shlex.split(extract_metadata_cmd)
+    args = shlex.split(droid_cmd) + ['-p', profile_path, '-e', output_path]
     subprocess.call(args)
 
-    #dump to stdout
-    file_to_stdout = f"cat {md5_sum}.droid_output"
-    args = shlex.split(file_to_stdout)
-    output = subprocess.check_output(args, universal_newlines=True)
+    return output_path
+
 
-    # cleanup
-    cleanup_cmd = f"rm {md5_sum}.droid_output {md5_sum}.droid"
-    args = shlex.split(cleanup_cmd)
-    subprocess.call(args)
+def read_droid_export(output_path):
+    """
+    Yields the rows of an exported DROID profile CSV one at a time.
+    """
+    if not os.path.exists(output_path):
+        print(f'DROID did not produce a profile export at {output_path}', file=sys.stderr)
+        return
+    with open(output_path, newline='') as f:
+        yield from csv.DictReader(f)
+
+
+def run_droid_profile(resource_args):
+    """
+    Runs DROID in profile mode over the given resource arguments and returns the exported CSV rows.
+    """
+    work_dir = mkdtemp(prefix='droid-profile-')
+    try:
+        return list(read_droid_export(export_droid_profile(resource_args, work_dir)))
+    finally:
+        # cleanup
+        rmtree(work_dir, ignore_errors=True)
+
+
+def plan_droid_shards(dirpath, shards, balance='count'):
+    """
+    Splits a directory tree into shards of roughly equal work for parallel DROID runs.
+
+    The unit of work is a single directory and the files directly inside it, weighted by its file count or
+    total bytes. Units are handed out largest first to the lightest shard. A single directory is never split.
+
+    Parameters:
+    dirpath (str): The root of the tree.
+    shards (int): The number of shards to produce.
+    balance (str): 'count' to balance by number of files, 'bytes' to balance by their total size.
+
+    Returns:
+    list: Up to `shards` lists of directories; empty shards are dropped.
+    """
+    if balance not in ('count', 'bytes'):
+        raise ValueError(f"balance must be 'count' or 'bytes', not {balance!r}")
+    units = []
+    for root, dirnames, filenames in os.walk(dirpath):
+        if balance == 'count':
+            weight = len(filenames)
+        else:
+            weight = 0
+            for filename in filenames:
+                try:
+                    weight += os.lstat(os.path.join(root, filename)).st_size
+                except OSError:
+                    pass
+        units.append((weight, root))
+
+    loads = [[0, []] for _ in range(max(1, shards))]
+    for weight, root in sorted(units, key=lambda unit: unit[0], reverse=True):
+        lightest = min(loads, key=lambda load: load[0])
+        lightest[0] += weight
+        lightest[1].append(root)
+    return [dirs for weight, dirs in loads if dirs]
+
+
+def profile_shard(dirs, max_arg_chars=100000):
+    """
+    Profiles one shard's directories non-recursively, in as many DROID runs as the command-line length needs.
+
+    Returns:
+    list: The (work_dir, export path) of every run, for the caller to read and clean up.
+    """
+    exports = []
+    chunk = []
+    chunk_chars = 0
+    for i, d in enumerate(dirs):
+        chunk.append(d)
+        chunk_chars += len(d) + 1
+        if chunk_chars >= max_arg_chars or i == len(dirs) - 1:
+            work_dir = mkdtemp(prefix='droid-shard-')
+            exports.append((work_dir, export_droid_profile(['-a', *chunk], work_dir)))
+            chunk = []
+            chunk_chars = 0
+    return exports
 
-    #profile_dict = io.StringIO(output)
-    csv_reader = csv.DictReader(output.splitlines())
 
-    return list(csv_reader)
+def stream_droid_profiles(resource_groups, processes):
+    """
+    Profiles each group of DROID resources with profile_shard on up to `processes` threads and yields rows
+    as each group finishes. Groups are pulled from resource_groups lazily, a few ahead of the running ones.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, processes), thread_name_prefix='droid-shard')
+    pending = set()
+    groups = iter(resource_groups)
+    exhausted = False
+    try:
+        while pending or not exhausted:
+            while not exhausted and len(pending) < 2 * max(1, processes):
+                group = next(groups, None)
+                if group is None:
+                    exhausted = True
+                else:
+                    pending.add(executor.submit(profile_shard, group))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from read_shard_exports(future.result())
+    finally:
+        discard_shards(executor, pending)
+
+
+def read_shard_exports(exports):
+    """
+    Yields the rows of the exports profile_shard returned, removing each one's temporary files once it is read.
+    """
+    for work_dir, output_path in exports:
+        try:
+            yield from read_droid_export(output_path)
+        finally:
+            rmtree(work_dir, ignore_errors=True)
+
+
+def discard_shards(executor, futures):
+    """
+    Cancels the profile_shard runs that have not started, waits for the rest and removes the temporary
+    files of those that finished but were never read.
+    """
+    for future in futures:
+        future.cancel()
+    executor.shutdown(wait=True)
+    for future in futures:
+        if future.done() and not future.cancelled() and future.exception() is None:
+            for work_dir, output_path in future.result():
+                rmtree(work_dir, ignore_errors=True)
+
+
+def iter_droid_profile_sharded(dirpath, shards=4, balance='count'):
+    """
+    Profiles a large tree with several DROID processes at once and streams back the merged rows.
+
+    The tree is split with plan_droid_shards and each shard is profiled by its own DROID run with its own
+    temporary files. Rows are read lazily from each shard's export as soon as that shard finishes, so the
+    whole profile is never held in memory. Row order therefore follows shard completion, not the tree.
+
+    Parameters:
+    dirpath (str): The path to the directory to be profiled.
+    shards (int): The number of DROID processes to run in parallel.
+    balance (str): 'count' or 'bytes', see plan_droid_shards.
+
+    Yields:
+    dict: DROID profile rows, as returned by build_droid_profile.
+    """
+    plan = plan_droid_shards(dirpath, shards, balance)
+    return stream_droid_profiles(plan, processes=len(plan))
+
+
+def iter_droid_profile_batches(dirpath, batch_size=200, processes=2, cache=None):
+    """
+    Profiles a tree in small batches of files so the first rows are available within seconds.
+
+    The tree is walked lazily and every batch_size files are handed to their own DROID run, with up to
+    `processes` runs at once. This trades a few extra JVM starts for a short time to first row, which is
+    what a streaming batch_norm needs. Only File rows are produced.
+
+    Parameters:
+    dirpath (str): The path to the directory to be profiled.
+    batch_size (int): The number of files per DROID run.
+    processes (int): The number of DROID runs in parallel.
+    cache (IdentificationCache, optional): Rows for unchanged files are yielded straight from the cache.
+
+    Yields:
+    dict: DROID profile rows, as returned by build_droid_profile.
+    """
+    def droid_rows(future):
+        for row in read_shard_exports(future.result()):
+            if row.get('TYPE') != 'File':
+                continue
+            if cache is not None:
+                cache.put(row['FILE_PATH'], row)
+            yield row
+
+    executor = ThreadPoolExecutor(max_workers=max(1, processes), thread_name_prefix='droid-batch')
+    # DROID runs in the order they were started, read first in first out so rows keep roughly to the walk's order
+    pending = deque()
+    batch = []
+    try:
+        for root, dirnames, filenames in os.walk(dirpath):
+            for filename in filenames:
+                filepath = os.path.abspath(os.path.join(root, filename))
+                row = cache.get(filepath) if cache is not None else None
+                if row is not None:
+                    yield row
+                else:
+                    batch.append(filepath)
+                    if len(batch) >= batch_size:
+                        # a few runs are kept queued ahead of the running ones, and the walk waits beyond that
+                        while len(pending) >= 2 * max(1, processes):
+                            yield from droid_rows(pending.popleft())
+                        pending.append(executor.submit(profile_shard, batch))
+                        batch = []
+                while pending and pending[0].done():
+                    yield from droid_rows(pending.popleft())
+        if batch:
+            pending.append(executor.submit(profile_shard, batch))
+        while pending:
+            yield from droid_rows(pending.popleft())
+    finally:
+        discard_shards(executor, pending)
+    if cache is not None:
+        cache.commit()
+
 
+def build_droid_profile(dirpath, cache=None, droid_batch_size=500):
+    """
+    This function uses DROID to identify the MIME type and other metadata for all files in a specified directory. 
+    It creates a DROID profile for the directory, extracts the metadata into a CSV file, and then reads this CSV file into a list of dictionaries.
+
+    Parameters:
+    dirpath (str): The path to the directory to be profiled.
+    cache (IdentificationCache, optional): Reuse earlier results for unchanged files and only send new or
+                                           changed files to DROID. Folder rows are not returned in this mode.
+    droid_batch_size (int): The most files added to a single DROID run when a cache is used.
+
+    Returns:
+    list: A list of dictionaries, where each dictionary contains the metadata for a file in the directory.
+    """
+    if cache is None:
+        return run_droid_profile(['-R', dirpath])
+
+    rows = []
+    misses = []
+    for root, dirnames, filenames in os.walk(dirpath):
+        for filename in filenames:
+            filepath = os.path.abspath(os.path.join(root, filename))
+            row = cache.get(filepath)
+            if row is None:
+                misses.append(filepath)
+            else:
+                rows.append(row)
+
+    for i in range(0, len(misses), droid_batch_size):
+        for row in run_droid_profile(['-a', *misses[i:i + droid_batch_size]]):
+            if row.get('TYPE') == 'File':
+                cache.put(row['FILE_PATH'], row)
+                rows.append(row)
+    cache.commit()
 
-def identify_file(filepath):
+    return rows
+
+
+def identify_file(filepath, cache=None, matcher=None):
     """
     Identifies the PUID for a file using DROID in no-profile mode
+    If a signature_matcher.SignatureMatcher is given it is tried first, and DROID only runs for files it cannot settle.
     """
+    if cache is not None:
+        metadata = cache.get(filepath, kind='identify')
+        if metadata is not None:
+            return metadata
+
+    if matcher is not None:
+        metadata = matcher.identify(filepath)
+        if metadata is not None:
+            return metadata
 
     output = subprocess.check_output(" ".join([droid_cmd, '-Nr', filepath, '-Ns', droid_sign_file]), universal_newlines=True ,shell=True)
 
@@ -70,8 +773,86 @@ def identify_file(filepath):
     for i, key in enumerate(keys):
         metadata[key] = values[i]
 
+    if cache is not None:
+        cache.put(filepath, metadata, kind='identify')
+        cache.commit()
+
     return metadata
 
+def identify_files(paths, batch_size=500, cache=None, matcher=None):
+    """
+    Identifies many files with a handful of DROID no-profile runs instead of one JVM start per file.
+
+    Paths are symlinked into a temporary directory in groups of batch_size and each group is identified by a
+    single `-Nr` run. DROID's CSV rows are mapped back to the original paths and yielded as DROID prints them.
+    Files found in the cache or settled by the matcher never reach DROID.
+
+    Parameters:
+    paths (iterable): The files to identify.
+    batch_size (int): The most files handed to one DROID run.
+    cache (IdentificationCache, optional): Earlier identify_file results to reuse, and to store new ones in.
+    matcher (SignatureMatcher, optional): Tried before DROID, see identify_file.
+
+    Yields:
+    tuple: (path, metadata) for every input path, with metadata None if DROID reported nothing for it.
+    """
+    batch = []
+    for path in paths:
+        metadata = cache.get(path, kind='identify') if cache is not None else None
+        if metadata is None and matcher is not None:
+            metadata = matcher.identify(path)
+        if metadata is not None:
+            yield path, metadata
+            continue
+        batch.append(path)
+        if len(batch) >= batch_size:
+            yield from identify_batch(batch, cache)
+            batch = []
+    if batch:
+        yield from identify_batch(batch, cache)
+    if cache is not None:
+        cache.commit()
+
+
+def identify_batch(paths, cache=None):
+    """
+    Runs one DROID no-profile identification over a group of files through a temporary directory of symlinks.
+    A path listed more than once is identified once and yielded once for every time it is listed.
+    """
+    link_dir = mkdtemp(prefix='droid-batch-')
+    try:
+        originals = {}
+        occurrences = Counter(paths)
+        for i, path in enumerate(occurrences):
+            # keep the extension, DROID uses it when no signature matches
+            link = os.path.join(link_dir, f'{i:06d}{os.path.splitext(path)[1]}')
+            os.symlink(os.path.abspath(path), link)
+            originals[link] = path
+            originals[os.path.realpath(path)] = path
+
+        args = shlex.split(droid_cmd) + ['-Nr', link_dir, '-Ns', droid_sign_file]
+        remaining = set(occurrences)
+        with subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True) as proc:
+            for metadata in csv.DictReader(proc.stdout):
+                reported = metadata.get('FILE_PATH') or next(iter(metadata.values()), '')
+                path = originals.get(reported) or originals.get(os.path.realpath(reported))
+                if path is None or path not in remaining:
+                    continue
+                remaining.discard(path)
+                metadata['FILE_PATH'] = path
+                metadata['NAME'] = os.path.basename(path)
+                if cache is not None:
+                    cache.put(path, metadata, kind='identify')
+                for n in range(occurrences[path]):
+                    yield path, dict(metadata)
+        for path in occurrences:
+            if path in remaining:
+                print(f'DROID did not report an identification for {path}', file=sys.stderr)
+                for n in range(occurrences[path]):
+                    yield path, None
+    finally:
+        rmtree(link_dir, ignore_errors=True)
+
 def construct_output_path(filepath, suffix, output_dir=None):
     """
     Constructs the path for the output file.
@@ -97,74 +878,430 @@ def replace_suffix(filename, new_suffix):
     base_name = os.path.splitext(os.path.basename(filename))[0]
     return base_name + new_suffix
 
-def norm_to_mp4(filepath, output_dir=None):
+def probe_streams(filepath):
+    """
+    Returns the codec_type and codec_name of every stream in a media file according to ffprobe, or None if it cannot be probed.
+    """
+    cmd = [ffprobe_cmd, '-v', 'error', '-show_entries', 'stream=codec_type,codec_name', '-of', 'json', filepath]
+    try:
+        result = run_tool(cmd, tool='ffmpeg', timeout=conversion_timeout('probe_streams', [filepath]))
+        return json.loads(result.stdout).get('streams', [])
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        print(f'Could not probe {filepath}: {e}', file=sys.stderr)
+        return None
+
+
+def probe_duration(filepath):
+    """
+    Returns the duration of a media file in seconds according to ffprobe, or None if it cannot be probed.
+    """
+    cmd = [ffprobe_cmd, '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', filepath]
+    try:
+        result = run_tool(cmd, tool='ffmpeg', timeout=conversion_timeout('probe_streams', [filepath]))
+        return float(json.loads(result.stdout)['format']['duration'])
+    except (OSError, subprocess.SubprocessError, ValueError, KeyError, TypeError):
+        return None
+
+
+def ffmpeg_thread_args(threads=None):
+    """
+    Returns the ffmpeg output options that limit it to threads, or to ffmpeg_threads if threads is None.
+    """
+    threads = threads or ffmpeg_threads
+    return ['-threads', str(threads)] if threads else []
+
+
+def mp4_strategy(streams):
+    """
+    Picks the cheapest way to produce an H.264/AAC MP4 from a file's streams.
+
+    Returns:
+    str: 'remux' when both the video and audio can be copied, 'copy_video' or 'copy_audio' when only one
+         of them can, and 'transcode' otherwise.
+    """
+    if not streams:
+        return 'transcode'
+    video = [s.get('codec_name') for s in streams if s.get('codec_type') == 'video']
+    audio = [s.get('codec_name') for s in streams if s.get('codec_type') == 'audio']
+    if not video:
+        return 'transcode'
+    copy_video = video[0] in mp4_video_codecs
+    copy_audio = not audio or audio[0] in mp4_audio_codecs
+    if copy_video and copy_audio:
+        return 'remux'
+    if copy_video:
+        return 'copy_video'
+    if copy_audio and audio:
+        return 'copy_audio'
+    return 'transcode'
+
+
+def norm_to_mp4(filepath, output_dir=None, threads=None):
     """
     Create a normalized video file to MP4 format using FFmpeg.
+    The source is probed first, and streams that are already H.264 or AAC are copied rather than re-encoded.
+    threads caps ffmpeg's threads, see ffmpeg_thread_args.
     """
     mp4_path = construct_output_path(filepath, '.mp4', output_dir)
-    cmd = f'ffmpeg -i "{filepath}" "{mp4_path}"'
+    strategy = mp4_strategy(probe_streams(filepath))
+    if strategy == 'transcode':
+        cmd = ['ffmpeg', '-i', filepath, *ffmpeg_thread_args(threads), '-y', mp4_path]
+    else:
+        # only the first video and audio streams, a copied subtitle or data stream may not fit in MP4
+        cmd = ['ffmpeg', '-i', filepath, '-map', '0:v:0', '-map', '0:a:0?',
+               '-c:v', 'copy' if strategy in ('remux', 'copy_video') else 'libx264',
+               '-c:a', 'copy' if strategy in ('remux', 'copy_audio') else 'aac', *ffmpeg_thread_args(threads), '-y', mp4_path]
     try:
-        subprocess.check_call(cmd, shell=True)
-    except subprocess.CalledProcessError as e:
+        run_tool(cmd, tool='ffmpeg', timeout=conversion_timeout('norm_to_mp4', [filepath]))
+    except subprocess.SubprocessError as e:
         print(f'Error creating a normalized derivative of {filepath} to MP4: {e}', file=sys.stderr)
         return
+    note_conversion('mp4_strategy', strategy)
     return mp4_path
 
-def norm_to_mp3(filepath, output_dir=None):
+def norm_to_mp3(filepath, output_dir=None, threads=None):
     """
     Create a normalized derivative from audio file to MP3 format using FFmpeg.
+    threads caps ffmpeg's threads, see ffmpeg_thread_args.
     """
     mp3_path = construct_output_path(filepath, '.mp3', output_dir)
+    # ffmpeg will not write over its own input, so an MP3 re-encoded in place goes through a file beside it
+    in_place = os.path.exists(mp3_path) and os.path.samefile(filepath, mp3_path)
+    if in_place:
+        with NamedTemporaryFile(dir=os.path.dirname(mp3_path), suffix='.mp3', delete=False) as f:
+            output_path = f.name
+    else:
+        output_path = mp3_path
 
-    cmd = f'ffmpeg -i "{filepath}" -vn -ar 44100 -ac 2 -ab 192k -f mp3 "{mp3_path}"'
+    # ffmpeg streams the audio through the encoder, so memory use does not grow with the length of the file
+    cmd = ['ffmpeg', '-i', filepath, *mp3_ffmpeg_args, *ffmpeg_thread_args(threads), '-y', output_path]
     try:
-        subprocess.check_call(cmd, shell=True)
-    except subprocess.CalledProcessError as e:
+        run_tool(cmd, tool='ffmpeg', timeout=conversion_timeout('norm_to_mp3', [filepath]))
+    except subprocess.SubprocessError as e:
         print(f'Error creating a normalized derivative of {filepath} to MP3: {e}', file=sys.stderr)
+        if in_place:
+            os.unlink(output_path)
         return
+    if in_place:
+        os.replace(output_path, mp3_path)
     return mp3_path
 
-def norm_to_doc(filepath, output_dir=None):
+def norm_to_doc(filepath, output_dir=None, pool=None):
     """
     Create a normalized derivative from a document file to DOC format using LibreOffice.
+    If a LibreOfficePool is given the conversion runs on one of its instances.
     """
     doc_path = construct_output_path(filepath, '.doc', output_dir)
+    if pool is not None:
+        return pool.convert([filepath], 'doc', os.path.dirname(doc_path))[0]
     cmd = [libreoffice_cmd, '--headless', '--convert-to', 'doc', filepath, '--outdir', os.path.dirname(doc_path)]
     try:
-        subprocess.check_call(cmd, shell=False)
-    except subprocess.CalledProcessError as e:
+        run_tool(cmd, tool='libreoffice', timeout=conversion_timeout('norm_to_doc', [filepath]))
+    except subprocess.SubprocessError as e:
         print(f'Error creating a normalized derivative of {filepath} to DOC: {e}', file=sys.stderr)
         return
     return doc_path
 
-def norm_to_pdf(filepath, output_dir=None):
+def norm_to_pdf(filepath, output_dir=None, pool=None):
     """
     Create a normalized derivative from a document file to PDF format using LibreOffice.
+    If a LibreOfficePool is given the conversion runs on one of its instances.
     """
     pdf_path = construct_output_path(filepath, '.pdf', output_dir)
+    if pool is not None:
+        return pool.convert([filepath], 'pdf', os.path.dirname(pdf_path))[0]
     cmd = [libreoffice_cmd, '--headless', '--convert-to', 'pdf', filepath, '--outdir', os.path.dirname(pdf_path)]
     try:
-        subprocess.check_call(cmd, shell=False)
-    except subprocess.CalledProcessError as e:
+        run_tool(cmd, tool='libreoffice', timeout=conversion_timeout('norm_to_pdf', [filepath]))
+    except subprocess.SubprocessError as e:
         print(f'Error creating a normalized derivative of {filepath} to PDF: {e}', file=sys.stderr)
         return
     return pdf_path
 
-def norm_to_svg(filepath, output_dir=None):
+class LibreOfficePool:
+    """
+    A pool of headless LibreOffice instances, each with its own user profile directory.
+
+    Documents are converted in batches with a single `soffice --convert-to` call per batch, so LibreOffice
+    startup is paid once per batch rather than once per file, and instances can run concurrently without
+    colliding on a shared profile. An instance's profile is thrown away and recreated after
+    `max_conversions` documents or whenever soffice exits with an error.
+
+    Parameters:
+    size (int): The number of instances, i.e. how many conversions may run at once.
+    batch_size (int): The largest number of documents handed to one soffice call by batch_norm.
+    max_conversions (int): Documents converted by an instance before its profile is recycled.
+    """
+
+    def __init__(self, size=1, batch_size=20, max_conversions=500):
+        self.size = size
+        self.batch_size = batch_size
+        self.max_conversions = max_conversions
+        self._closed = False
+        self._instances = queue.Queue()
+        for _ in range(size):
+            self._instances.put(self._new_instance())
+
+    def _new_instance(self):
+        return {'profile_dir': mkdtemp(prefix='soffice-profile-'), 'conversions': 0}
+
+    def _recycle(self, instance):
+        rmtree(instance['profile_dir'], ignore_errors=True)
+        return self._new_instance()
+
+    def _run(self, instance, filepaths, fmt, outdir):
+        cmd = [libreoffice_cmd, f"-env:UserInstallation={pathlib.Path(instance['profile_dir']).as_uri()}",
+               '--headless', '--convert-to', fmt, '--outdir', outdir, *filepaths]
+        started = time.time()
+        # the pool's own instance queue bounds concurrency, so no tool limit applies
+        result = run_tool(cmd, check=False, timeout=conversion_timeout(f'norm_to_{fmt}', filepaths))
+        returncode = result.returncode
+        if result.timed_out:
+            print(f'LibreOffice timed out converting {len(filepaths)} file(s) to {fmt.upper()} and was killed', file=sys.stderr)
+        elif returncode != 0:
+            print(f'LibreOffice exited with status {returncode} converting {len(filepaths)} file(s) to {fmt.upper()}', file=sys.stderr)
+        instance['conversions'] += len(filepaths)
+        results = []
+        for filepath in filepaths:
+            out_path = construct_output_path(filepath, '.' + fmt, outdir)
+            # soffice does not report per-file failures, so only count outputs written by this call
+            if os.path.exists(out_path) and os.path.getmtime(out_path) >= started - 1:
+                results.append(out_path)
+            else:
+                results.append(None)
+        return returncode, results
+
+    def convert(self, filepaths, fmt, outdir):
+        """
+        Converts documents that share an output directory to `fmt` on one instance of the pool.
+
+        Returns:
+        list: The output path for each input file, or None where the conversion failed.
+        """
+        if self._closed:
+            raise RuntimeError('LibreOfficePool is closed')
+        instance = self._instances.get()
+        try:
+            returncode, results = self._run(instance, filepaths, fmt, outdir)
+            if returncode != 0:
+                instance = self._recycle(instance)
+                # Retry the files a crashed batch left behind one at a time so a single bad document only fails itself
+                if len(filepaths) > 1:
+                    for i, filepath in enumerate(filepaths):
+                        if results[i] is None:
+                            returncode, retried = self._run(instance, [filepath], fmt, outdir)
+                            results[i] = retried[0]
+                            if returncode != 0:
+                                instance = self._recycle(instance)
+            if instance['conversions'] >= self.max_conversions:
+                instance = self._recycle(instance)
+        finally:
+            self._instances.put(instance)
+        for filepath, result in zip(filepaths, results):
+            if result is None:
+                print(f'Error creating a normalized derivative of {filepath} to {fmt.upper()}', file=sys.stderr)
+        return results
+
+    def close(self):
+        """
+        Removes the profile directories of all idle instances.
+        """
+        self._closed = True
+        while not self._instances.empty():
+            rmtree(self._instances.get_nowait()['profile_dir'], ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def norm_to_svg(filepath, output_dir=None, pool=None):
     """
     Create a normalized derivative from a vector image file to SVG format using Inkscape.
+    If an InkscapePool is given the conversion runs on one of its shell-mode instances.
     """
     svg_path = construct_output_path(filepath, '.svg', output_dir)
-    cmd = f'inkscape  --export-filename="{svg_path}" "{filepath}" 2>/dev/null'
+    if pool is not None and pool.accepts(filepath, svg_path):
+        return pool.convert(filepath, svg_path)
+    cmd = [inkscape_cmd, f'--export-filename={svg_path}', filepath]
 
     try:
-        print(cmd)
-        subprocess.check_call(cmd, shell=True)
-    except subprocess.CalledProcessError as e:
+        print(shlex.join(cmd))
+        run_tool(cmd, tool='inkscape', timeout=conversion_timeout('norm_to_svg', [filepath]))
+    except subprocess.SubprocessError as e:
         print(f'Error creating a normalized derivative of {filepath} to SVG: {e}', file=sys.stderr)
         return
     return svg_path
 
+
+# The actions an InkscapePool instance runs for each file, and the prompt `inkscape --shell` shows when it is ready
+inkscape_shell_actions = 'file-open:{source}; export-filename:{target}; export-do; file-close'
+inkscape_shell_prompt = b'> '
+
+
+class InkscapePool:
+    """
+    A pool of long-lived `inkscape --shell` processes that convert PostScript and EPS files to SVG.
+
+    Each file is converted by writing one line of inkscape_shell_actions to an instance and waiting for
+    the shell's next prompt, so Inkscape's GTK and font start-up is paid once per instance rather than once
+    per file. An instance is restarted after `max_conversions` files, and killed and started afresh when it
+    exits or does not prompt again within the conversion's timeout (see conversion_timeouts).
+
+    The CPU time an instance used since its previous file, its peak resident memory and, if it died, its
+    exit status are noted for each file like run_tool does, from /proc while it runs and from the wait4
+    rusage once it is stopped. Where there is no /proc, an instance's usage is only known when it is
+    stopped, and goes to the file it was stopped on.
+
+    Parameters:
+    size (int): The number of instances, i.e. how many conversions may run at once.
+    max_conversions (int): Files converted by an instance before it is restarted.
+    """
+
+    def __init__(self, size=1, max_conversions=200):
+        self.size = size
+        self.max_conversions = max_conversions
+        self._closed = False
+        self._instances = queue.Queue()
+        for _ in range(size):
+            # instances are started on first use
+            self._instances.put({'proc': None, 'conversions': 0, 'cpu_seconds': 0})
+
+    def accepts(self, filepath, svg_path):
+        """
+        Returns whether a path can be passed to the shell, which splits its input on ';' and newlines.
+        """
+        return not any(c in path for path in (filepath, svg_path) for c in ';\n')
+
+    def _start(self, instance):
+        proc = subprocess.Popen([inkscape_cmd, '--shell'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, start_new_session=True)
+        os.set_blocking(proc.stdout.fileno(), False)
+        instance['proc'] = proc
+        instance['conversions'] = 0
+        instance['cpu_seconds'] = 0
+        return self._wait_for_prompt(proc, conversion_timeout('norm_to_svg', []))
+
+    def _stop(self, instance):
+        """
+        Kills and reaps an instance, noting the CPU time it used since the last file was accounted for.
+
+        Returns:
+        int: The instance's exit status, negative for the signal that ended it, or None if it was not running.
+        """
+        proc = instance['proc']
+        instance['proc'] = None
+        if proc is None:
+            return None
+        kill_process_group(proc.pid)
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        proc.stdin.close()
+        proc.stdout.close()
+        self._account(instance, usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+        return proc.returncode
+
+    def _account(self, instance, cpu_seconds, max_rss_kb):
+        # an instance's CPU time is cumulative, so each file gets what was used since the previous one
+        add_conversion_cost('cpu_seconds', max(0, cpu_seconds - instance['cpu_seconds']))
+        instance['cpu_seconds'] = max(cpu_seconds, instance['cpu_seconds'])
+        note_peak('max_rss_kb', max_rss_kb)
+
+    def _usage(self, proc):
+        """
+        Returns the CPU seconds and peak resident kilobytes of a running instance from /proc, or None.
+        """
+        try:
+            with open(f'/proc/{proc.pid}/stat') as f:
+                fields = f.read().rsplit(') ', 1)[1].split()
+            with open(f'/proc/{proc.pid}/status') as f:
+                max_rss_kb = next((int(line.split()[1]) for line in f if line.startswith('VmHWM:')), 0)
+        except (OSError, IndexError, ValueError):
+            return None
+        # utime and stime, the 14th and 15th fields, in clock ticks
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), max_rss_kb
+
+    def _wait_for_prompt(self, proc, timeout):
+        """
+        Reads an instance's output until it prompts for the next command.
+
+        Returns:
+        bool: False if the instance exited or did not prompt within timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        output = b''
+        with selectors.DefaultSelector() as selector:
+            selector.register(proc.stdout, selectors.EVENT_READ)
+            while not output.endswith(inkscape_shell_prompt):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if (remaining is not None and remaining <= 0) or not selector.select(remaining):
+                    return False
+                try:
+                    data = os.read(proc.stdout.fileno(), 65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    return False
+                output = (output + data)[-1024:]
+        return True
+
+    def convert(self, filepath, svg_path):
+        """
+        Converts a file to SVG at svg_path on one instance of the pool.
+
+        Returns:
+        str: svg_path, or None if the conversion failed.
+        """
+        if self._closed:
+            raise RuntimeError('InkscapePool is closed')
+        instance = self._instances.get()
+        started = time.time()
+        try:
+            ok = instance['proc'] is not None or self._start(instance)
+            if ok:
+                command = inkscape_shell_actions.format(source=filepath, target=svg_path)
+                try:
+                    instance['proc'].stdin.write(command.encode() + b'\n')
+                    instance['proc'].stdin.flush()
+                    ok = self._wait_for_prompt(instance['proc'], conversion_timeout('norm_to_svg', [filepath]))
+                except OSError:
+                    ok = False
+            if ok:
+                instance['conversions'] += 1
+                usage = self._usage(instance['proc'])
+                if usage is not None:
+                    self._account(instance, *usage)
+                note_conversion('exit_code', 0)
+            if not ok or instance['conversions'] >= self.max_conversions:
+                # a crashed or hung instance is replaced on next use, as is one that reached its limit
+                returncode = self._stop(instance)
+                if not ok:
+                    note_conversion('exit_code', returncode)
+        finally:
+            self._instances.put(instance)
+        # the shell does not report failed actions, so only count an output written by this call
+        if ok and os.path.exists(svg_path) and os.path.getmtime(svg_path) >= started - 1:
+            return svg_path
+        print(f'Error creating a normalized derivative of {filepath} to SVG', file=sys.stderr)
+        return None
+
+    def close(self):
+        """
+        Stops all idle instances.
+        """
+        self._closed = True
+        while not self._instances.empty():
+            self._stop(self._instances.get_nowait())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def no_norm(filepath, output_dir=None):
     """
     Returns the same filepath if no output_dir is provided.
@@ -181,18 +1318,123 @@ def no_norm(filepath, output_dir=None):
     else:
         return filepath
 
-def norm_file(filepath,metadata):
-    """
-    Create a normalized derivative from a file to a different format based on its MIME type.  
-    Use batch convert if able
-    """
-    mime_type = metadata.get('MIME_TYPE', '').lower()
+# The order in which each placement strategy tries ways of putting an unconverted file into target_dir.
+# Hardlinks share the inode with the original, so they are only used when asked for explicitly.
+placement_strategies = {
+    'copy': ('copy',),
+    'auto': ('reflink', 'copy_file_range', 'copy'),
+    'hardlink': ('hardlink', 'reflink', 'copy_file_range', 'copy'),
+}
+# ioctl request number of Linux FICLONE, which shares a file's extents copy-on-write
+FICLONE = 0x40049409
+
+
+class FilePlacer:
+    """
+    Places files that need no conversion into target_dir as cheaply as the filesystem allows.
+
+    Methods are tried in the order given by the strategy. A method that fails between a pair of devices
+    is not tried again for that pair, so the first file effectively detects what works between
+    working_dir and target_dir. Bytes that were shared (hardlink, reflink) and bytes that were written
+    (copy_file_range, copy) are counted separately.
+
+    Parameters:
+    strategy (str): One of the keys of placement_strategies.
+    """
+
+    def __init__(self, strategy='copy'):
+        if strategy not in placement_strategies:
+            raise ValueError(f"Unknown placement {strategy!r}, expected one of {', '.join(placement_strategies)}")
+        self.strategy = strategy
+        self.bytes_linked = 0
+        self.bytes_copied = 0
+        self._broken = set()
+        self._lock = threading.Lock()
+
+    def place(self, src, dst):
+        """
+        Puts the contents of src at dst, replacing dst if it exists. An existing dst is removed first
+        rather than written over, so a dst hard linked to src never truncates it.
+
+        Returns:
+        str: The method that was used.
+        """
+        size = os.path.getsize(src)
+        devices = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+        methods = placement_strategies[self.strategy]
+        if os.path.lexists(dst):
+            if os.path.realpath(src) == os.path.realpath(dst):
+                raise SameFileError(f'{src} and {dst} are the same file')
+            # the methods write dst in place, which would truncate src if an earlier hardlink run linked them
+            os.remove(dst)
+        for method in methods:
+            if (method, devices) in self._broken:
+                continue
+            try:
+                if method == 'copy':
+                    copyfile(src, dst)
+                else:
+                    place_methods[method](src, dst)
+            except (OSError, AttributeError) as e:
+                if method == methods[-1]:
+                    raise
+                if isinstance(e, AttributeError) or e.errno in placement_unsupported_errnos:
+                    with self._lock:
+                        self._broken.add((method, devices))
+                continue
+            counter = 'bytes_linked' if method in ('hardlink', 'reflink') else 'bytes_copied'
+            with self._lock:
+                setattr(self, counter, getattr(self, counter) + size)
+            # also noted per file, so runs split across workers can total them
+            add_conversion_cost(counter, size)
+            return method
+
+
+# errno values that mean a placement method cannot work between two locations, rather than a one-off failure
+placement_unsupported_errnos = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM}
+
+
+def place_hardlink(src, dst):
+    os.link(src, dst)
+
+
+def place_reflink(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def place_copy_file_range(src, dst):
+    # the kernel copies the data without it passing through this process
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+place_methods = {
+    'hardlink': place_hardlink,
+    'reflink': place_reflink,
+    'copy_file_range': place_copy_file_range,
+}
+
+
+def norm_file(filepath,metadata, libreoffice_pool=None, inkscape_pool=None):
+    """
+    Create a normalized derivative from a file to a different format based on its MIME type.  
+    Use batch convert if able, on the LibreOfficePool or InkscapePool given
+    """
+    mime_type = metadata.get('MIME_TYPE', '').lower()
 
     if 'audio' in mime_type:
-        sound = AudioSegment.from_file(filepath)
-        mp3_path = os.path.splitext(filepath)[0] + '.mp3'
-        sound.export(mp3_path, format='mp3')
-        return mp3_path
+        return norm_to_mp3(filepath)
 
     elif 'video' in mime_type:
         return norm_to_mp4(filepath)
@@ -201,13 +1443,13 @@ def norm_file(filepath,metadata):
         return filepath
     
     elif 'postscript' in mime_type:
-        return norm_to_svg(filepath)
+        return norm_to_svg(filepath, pool=inkscape_pool)
 
     elif 'text/xml' in mime_type:
-        return norm_to_doc(filepath)
+        return norm_to_doc(filepath, pool=libreoffice_pool)
 
     elif 'application/vnd.openxmlformats-officedocument.wordprocessingml.document' in mime_type:
-        return norm_to_doc(filepath)
+        return norm_to_doc(filepath, pool=libreoffice_pool)
     
     elif mime_type == 'text/plain':
         return filepath # no norm
@@ -216,69 +1458,2009 @@ def norm_file(filepath,metadata):
         print(f'Unsupported file type: {mime_type}', file=sys.stderr)
 
 
+mime_normalization_map = {
+    'audio/mpeg': norm_to_mp3,
+    'audio/x-wav': norm_to_mp3,
+    'video/x-msvideo': norm_to_mp4,
+    'application/postscript': norm_to_svg,
+    'application/vnd.oasis.opendocument.text': norm_to_doc,
+    'application/xml': norm_to_doc,
+    'text/xml': norm_to_doc,
+    'text/plain': no_norm,
+    'image/svg+xml': no_norm,
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': norm_to_doc,
+    'video/mp4': no_norm,
+    'application/xml, text/xml': norm_to_doc
+}
+
+# Which external tool each conversion function drives; anything not listed here is a plain copy
+conversion_tools = {
+    norm_to_mp4: 'ffmpeg',
+    norm_to_mp3: 'ffmpeg',
+    norm_to_doc: 'libreoffice',
+    norm_to_pdf: 'libreoffice',
+    norm_to_svg: 'inkscape',
+}
+tool_names = ('ffmpeg', 'libreoffice', 'inkscape', 'copy')
+
+
+def tool_for(conversion_function):
+    """
+    Returns the name of the tool class ('ffmpeg', 'libreoffice', 'inkscape' or 'copy') a conversion function runs under.
+    """
+    return conversion_tools.get(conversion_function, 'copy')
+
+
+def resolve_tool_limits(workers, tool_limits=None):
+    """
+    Builds the per-tool concurrency caps used by a parallel batch_norm run.
+
+    Parameters:
+    workers (int): The default number of concurrent jobs for each tool.
+    tool_limits (dict, optional): Overrides keyed by tool name, e.g. {'ffmpeg': 4}.
+
+    Returns:
+    dict: A mapping of every tool name to its concurrency cap.
+    """
+    limits = {tool: workers for tool in tool_names}
+    # soffice instances started this way share one user profile and collide when run concurrently
+    limits['libreoffice'] = 1
+    for tool, limit in (tool_limits or {}).items():
+        if tool not in limits:
+            raise ValueError(f'Unknown tool {tool!r}, expected one of {", ".join(tool_names)}')
+        limits[tool] = max(1, int(limit))
+    return limits
+
+
+def target_path_for(file_path, target_dir, working_dir):
+    """
+    Returns the path mirroring file_path from working_dir under target_dir.
+    """
+    # Get the relative path of the file from the working directory
+    relative_path = os.path.relpath(file_path, working_dir)
+    # Create the target file path by joining the target directory with the relative path
+    return os.path.join(target_dir, relative_path)
+
+
+def norm_item(item, target_dir, working_dir, placer=None, dedup=None, inkscape_pool=None, ffmpeg_threads=None):
+    """
+    Normalizes a single DROID profile row into the mirrored location under target_dir.
+    Files that are not converted are put in place by placer, a FilePlacer, or copied if there is none.
+    With a DerivativeStore as dedup, byte-identical sources share one conversion. With an InkscapePool,
+    PostScript is converted on its shell-mode instances, and ffmpeg_threads caps each ffmpeg's threads.
+    Rows for archive members, from expand_archive_rows, are handled by norm_member.
+
+    Returns:
+    tuple: The outcome, one of 'success', 'unnormalized', 'undefined' or 'fail', and the output path
+           (None on failure).
+    """
+    mime_type = item['MIME_TYPE']
+    file_path = item['FILE_PATH']
+    target_file_path = target_path_for(file_path, target_dir, working_dir)
+
+    conversion_function = mime_normalization_map.get(mime_type)
+
+    try:
+        if 'MEMBER' in item:
+            return norm_member(item, target_file_path, placer, dedup, inkscape_pool, ffmpeg_threads)
+        if conversion_function:
+            # If the conversion function is not `no_norm`, we perform conversion
+            if conversion_function is not no_norm:
+                target_dir_path = os.path.dirname(target_file_path)
+                kwargs = conversion_args(conversion_function, inkscape_pool, ffmpeg_threads)
+                if dedup is not None:
+                    output_path = convert_deduplicated(conversion_function, file_path, target_dir_path, dedup, placer, **kwargs)
+                else:
+                    output_path = conversion_function(file_path, output_dir=target_dir_path, **kwargs)
+                # the norm_to_* functions report their own errors and return None
+                return ('success', output_path) if output_path else ('fail', None)
+            else: # If it's `no_norm`, we simply copy the file
+                place_unconverted(file_path, target_file_path, placer)
+                return 'unnormalized', target_file_path
+        else: # If no normalization function is define we still copy the file
+            place_unconverted(file_path, target_file_path, placer)
+            return 'undefined', target_file_path
+    except Exception as e:
+        print(f'Error normalizing {file_path}: {e}', file=sys.stderr)
+        return 'fail', None
+
+
+def conversion_args(conversion_function, inkscape_pool=None, ffmpeg_threads=None):
+    """
+    Returns the keyword arguments that hand a run's InkscapePool or ffmpeg thread count to a conversion function.
+    """
+    if conversion_function is norm_to_svg and inkscape_pool is not None:
+        return {'pool': inkscape_pool}
+    if tool_for(conversion_function) == 'ffmpeg' and ffmpeg_threads:
+        return {'threads': ffmpeg_threads}
+    return {}
+
+
+def place_unconverted(file_path, target_file_path, placer=None):
+    """
+    Copies, or links if the placer allows it, a file that needs no conversion to its place in target_dir.
+    """
+    if placer is None:
+        copyfile(file_path, target_file_path)
+    else:
+        note_conversion('placement', placer.place(file_path, target_file_path))
+
+
+# The suffix each conversion function gives its output, so a derivative's path is known before converting
+conversion_suffixes = {
+    norm_to_mp4: '.mp4',
+    norm_to_mp3: '.mp3',
+    norm_to_doc: '.doc',
+    norm_to_pdf: '.pdf',
+    norm_to_svg: '.svg',
+}
+
+
+class DerivativeStore:
+    """
+    Deduplicates conversions by source content, so each distinct input is converted once per conversion function.
+
+    Derivatives are keyed by the SHA-256 of the source plus the conversion function's name. The first file
+    with a given key is converted as usual; every later one gets that derivative placed at its own target
+    path instead. Threads asking for a key that is being converted wait for that conversion rather than
+    repeating it. With store_dir, derivatives are also kept in a content-addressed directory and reused by
+    later runs. The CPU seconds the original conversion took are remembered, to report what reuse saved.
+
+    Parameters:
+    store_dir (str, optional): A directory to keep derivatives in across runs.
+    placer (FilePlacer, optional): How derivatives are put in place, copies if omitted.
+    """
+
+    def __init__(self, store_dir=None, placer=None):
+        self.store_dir = store_dir
+        self.placer = placer or FilePlacer('copy')
+        self._entries = {}
+        self._converting = {}
+        self._lock = threading.Lock()
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+
+    def _object_path(self, key):
+        sha256, function_name, suffix = key
+        return os.path.join(self.store_dir, sha256[:2], f'{sha256}-{function_name}{suffix}')
+
+    def _load(self, key):
+        if not self.store_dir:
+            return None
+        object_path = self._object_path(key)
+        try:
+            with open(object_path + '.json') as f:
+                cpu_seconds = json.load(f).get('cpu_seconds', 0)
+        except (OSError, ValueError):
+            return None
+        return (object_path, cpu_seconds) if os.path.exists(object_path) else None
+
+    def acquire(self, key):
+        """
+        Returns (derivative path, CPU seconds) if a derivative for key exists. Otherwise returns None, and the
+        caller must convert the file and call release with the result.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key) or self._load(key)
+                if entry and os.path.exists(entry[0]):
+                    return entry
+                waiting_on = self._converting.get(key)
+                if waiting_on is None:
+                    self._converting[key] = threading.Event()
+                    return None
+            waiting_on.wait()
+
+    def release(self, key, output_path, cpu_seconds=0):
+        """
+        Records the derivative converted for key, or None if the conversion failed, and wakes up any waiters.
+        """
+        try:
+            if output_path and os.path.exists(output_path):
+                entry = (output_path, cpu_seconds)
+                if self.store_dir:
+                    object_path = self._object_path(key)
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    self.placer.place(output_path, object_path + '.tmp')
+                    os.replace(object_path + '.tmp', object_path)
+                    with open(object_path + '.json.tmp', 'w') as f:
+                        json.dump({'cpu_seconds': cpu_seconds}, f)
+                    os.replace(object_path + '.json.tmp', object_path + '.json')
+                    entry = (object_path, cpu_seconds)
+                with self._lock:
+                    self._entries[key] = entry
+        finally:
+            with self._lock:
+                self._converting.pop(key).set()
 
-def batch_norm(droid_profile, target_dir, working_dir='/app/input/'):
-    mime_normalization_map = {
-        'audio/mpeg': norm_to_mp3,
-        'audio/x-wav': norm_to_mp3,
-        'video/x-msvideo': norm_to_mp4,
-        'application/postscript': norm_to_svg,
-        'application/vnd.oasis.opendocument.text': norm_to_doc,
-        'application/xml': norm_to_doc,
-        'text/xml': norm_to_doc,
-        'text/plain': no_norm,
-        'image/svg+xml': no_norm,
-        'application/vnd.openxmlformats-officedocument.wordprocessingml.document': norm_to_doc,
-        'video/mp4': no_norm,
-        'application/xml, text/xml': norm_to_doc
+
+def convert_deduplicated(conversion_function, file_path, target_dir_path, dedup, placer=None, **kwargs):
+    """
+    Runs a conversion through a DerivativeStore, placing an existing derivative instead where there is one.
+    Extra keyword arguments, such as a pool, are passed on to the conversion function.
+
+    Returns:
+    str: The output path, or None if the conversion failed.
+    """
+    suffix = conversion_suffixes.get(conversion_function)
+    if suffix is None:
+        return conversion_function(file_path, output_dir=target_dir_path, **kwargs)
+    key = (file_sha256(file_path), conversion_function.__name__, suffix)
+    existing = dedup.acquire(key)
+    if existing is not None:
+        derivative_path, cpu_seconds = existing
+        output_path = construct_output_path(file_path, suffix, target_dir_path)
+        if os.path.abspath(derivative_path) != os.path.abspath(output_path):
+            (placer or dedup.placer).place(derivative_path, output_path)
+        note_conversion('dedup', 'reused')
+        add_conversion_cost('cpu_seconds_avoided', cpu_seconds)
+        return output_path
+
+    output_path = None
+    with conversion_notes() as notes:
+        try:
+            output_path = conversion_function(file_path, output_dir=target_dir_path, **kwargs)
+        finally:
+            dedup.release(key, output_path, notes.get('cpu_seconds', 0))
+    # the inner conversion_notes shadowed the caller's notes, so hand ours on to them
+    for key, value in notes.items():
+        if isinstance(value, (int, float)):
+            add_conversion_cost(key, value)
+        else:
+            note_conversion(key, value)
+    note_conversion('dedup', 'converted')
+    return output_path
+
+
+# The file batch_norm keeps its progress journal in, inside target_dir
+journal_name = '.normalize_journal.jsonl'
+
+# The output format a LibreOffice conversion function asks soffice for
+libreoffice_formats = {norm_to_doc: 'doc', norm_to_pdf: 'pdf'}
+
+
+# MIME types DROID gives the ZIP and TAR bundles batch_norm can read members from with expand_archives,
+# and the suffixes stripped from an archive's name to get the directory its members are mirrored into
+archive_mime_types = {'application/zip', 'application/x-zip-compressed', 'application/x-tar', 'application/x-gtar',
+                      'application/gzip', 'application/x-gzip', 'application/x-bzip2', 'application/x-xz'}
+archive_suffixes = ('.tar.gz', '.tar.bz2', '.tar.xz', '.tgz', '.tbz2', '.txz', '.zip', '.tar')
+
+
+class ScratchSpace:
+    """
+    A scratch directory for archive members that have to be on disk to be converted, holding at most
+    max_bytes of them at a time. spool() blocks until there is room, and a member larger than max_bytes
+    waits until the directory is empty and is then spooled on its own, so the space used never exceeds the
+    larger of max_bytes and the biggest member, however large the archive.
+
+    Parameters:
+    path (str, optional): The directory to create the scratch directory in, the system default if omitted.
+    max_bytes (int): The most bytes of members spooled at once.
+    """
+
+    def __init__(self, path=None, max_bytes=1 << 30):
+        self.path = mkdtemp(prefix='normalize-scratch-', dir=path)
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def spool(self, name, size, header, stream):
+        """
+        Writes a member, whose first bytes were already read into header, to a file named like it.
+
+        Returns:
+        str: The spooled file's path, to hand to discard() once it has been converted.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.used == 0 or self.used + size <= self.max_bytes)
+            self.used += size
+            self.peak = max(self.peak, self.used)
+        spool_dir = mkdtemp(dir=self.path)
+        path = os.path.join(spool_dir, posixpath.basename(name))
+        try:
+            with open(path, 'wb') as f:
+                f.write(header)
+                copyfileobj(stream, f, 1024 * 1024)
+        except BaseException:
+            self.discard(path, size)
+            raise
+        return path
+
+    def discard(self, path, size):
+        """
+        Removes a spooled member and frees its space for the next.
+        """
+        rmtree(os.path.dirname(path), ignore_errors=True)
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+    def close(self):
+        rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def archive_kind(item):
+    """
+    Returns 'zip' or 'tar' for a profile row that is an archive expand_archives can read the members of,
+    otherwise None. The archive is only opened here, so its kind can be handed on instead of probed again.
+    """
+    if item['MIME_TYPE'] not in archive_mime_types:
+        return None
+    try:
+        if zipfile.is_zipfile(item['FILE_PATH']):
+            return 'zip'
+        if tarfile.is_tarfile(item['FILE_PATH']):
+            return 'tar'
+    except OSError:
+        pass
+    return None
+
+
+def strip_archive_suffix(name):
+    """
+    Returns name without the archive suffix it ends in, or name itself if it has none.
+    """
+    lowered = name.lower()
+    for suffix in archive_suffixes:
+        if lowered.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def archive_member_root(archive_path):
+    """
+    Returns the path an archive's members are mirrored under: the archive's path without its suffix.
+
+    If that path already exists in the working tree, as a photos/ directory next to photos.zip would, or
+    another file in the same directory has the same name once its suffix is stripped, as photos.tar.gz does,
+    the members go under the archive's full path with '.d' appended instead, numbered if that exists too.
+    """
+    root = strip_archive_suffix(archive_path)
+    taken = [root] + [root + suffix for suffix in archive_suffixes if root + suffix != archive_path]
+    if root != archive_path and not any(os.path.lexists(path) for path in taken):
+        return root
+    root = archive_path + '.d'
+    number = 1
+    while os.path.lexists(root):
+        number += 1
+        root = f'{archive_path}.d{number}'
+    return root
+
+
+def iter_archive_members(archive_path, kind):
+    """
+    Reads the regular files in a ZIP or TAR archive front to back, without extracting it. TAR archives,
+    compressed or not, are read as a stream, so each member's file object is only valid until the next is
+    yielded.
+
+    Parameters:
+    archive_path (str): The archive.
+    kind (str): 'zip' or 'tar', as archive_kind returns.
+
+    Yields:
+    tuple: The member's name, its size and a file object reading its contents.
+    """
+    if kind == 'zip':
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as f:
+                        yield info.filename, info.file_size, f
+    else:
+        with tarfile.open(archive_path, 'r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, member.size, archive.extractfile(member)
+
+
+def identify_member(name, header, size, matcher=None):
+    """
+    Identifies an archive member from its first bytes with a signature_matcher.SignatureMatcher, falling
+    back to its extension when there is no matcher or the header does not settle it.
+
+    Returns:
+    dict: The PUID, MIME_TYPE and METHOD of the member, as in a DROID profile row.
+    """
+    metadata = matcher.identify_header(header, size) if matcher is not None else None
+    if metadata is not None:
+        return metadata
+    mime_type, encoding = mimetypes.guess_type(name)
+    return {'PUID': '', 'MIME_TYPE': mime_type or '', 'METHOD': 'Extension'}
+
+
+def archive_member_rows(archive_path, kind, target_dir, working_dir, scratch, matcher=None, header_bytes=128 * 1024):
+    """
+    Turns one archive of the given kind, 'zip' or 'tar', into profile rows for its members, reading it
+    once from front to back.
+
+    Each member is identified from its first header_bytes. Members that are not converted are written
+    straight to their mirrored path under target_dir as they are read. Members that are converted are
+    spooled into scratch, which blocks while it is full until the converters have discarded earlier ones.
+    Member rows mirror the archive's members under archive_member_root(archive_path), and carry the
+    archive's path as ARCHIVE, the member's name as MEMBER and its size as SIZE, together with either
+    OUTPUT_PATH or the spooled SOURCE_PATH and the SCRATCH it is in, for norm_member.
+
+    Yields:
+    dict: A profile row for every regular file in the archive.
+    """
+    root = archive_member_root(archive_path)
+    try:
+        for name, size, stream in iter_archive_members(archive_path, kind):
+            relative = posixpath.normpath(name.lstrip('/'))
+            if relative == '..' or relative.startswith('../'):
+                print(f'Skipping {name} in {archive_path}: it would be written outside the target directory', file=sys.stderr)
+                continue
+            header = stream.read(header_bytes)
+            row = dict(identify_member(name, header, size, matcher))
+            file_path = os.path.join(root, *relative.split('/'))
+            row.update({'TYPE': 'File', 'FILE_PATH': file_path, 'ARCHIVE': archive_path, 'MEMBER': name, 'SIZE': size})
+            target_file_path = target_path_for(file_path, target_dir, working_dir)
+            os.makedirs(os.path.dirname(target_file_path), exist_ok=True)
+            conversion_function = mime_normalization_map.get(row['MIME_TYPE'])
+            if conversion_function is None or conversion_function is no_norm:
+                try:
+                    with open(target_file_path, 'wb') as f:
+                        f.write(header)
+                        copyfileobj(stream, f, 1024 * 1024)
+                    row['OUTPUT_PATH'] = target_file_path
+                except OSError as e:
+                    print(f'Error writing {name} from {archive_path}: {e}', file=sys.stderr)
+                    row['OUTPUT_PATH'] = None
+            else:
+                row['SOURCE_PATH'] = scratch.spool(name, size, header, stream)
+                row['SCRATCH'] = scratch
+            yield row
+    except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+        print(f'Error reading {archive_path}, stopping at the members read so far: {e}', file=sys.stderr)
+
+
+def expand_archive_rows(files, target_dir, working_dir, scratch, matcher=None, status_dict=None):
+    """
+    Passes profile rows through, replacing each ZIP or TAR archive with rows for its members, see
+    archive_member_rows. Archives that cannot be read are passed through and copied like any other file.
+    """
+    for item in files:
+        kind = archive_kind(item)
+        if kind is None:
+            yield item
+            continue
+        if status_dict is not None:
+            status_dict['archives'] = status_dict.get('archives', 0) + 1
+        yield from archive_member_rows(item['FILE_PATH'], kind, target_dir, working_dir, scratch, matcher)
+
+
+def norm_member(item, target_file_path, placer=None, dedup=None, inkscape_pool=None, ffmpeg_threads=None):
+    """
+    Normalizes a profile row from archive_member_rows, like norm_item does for a file on disk.
+    """
+    conversion_function = mime_normalization_map.get(item['MIME_TYPE'])
+    if 'SOURCE_PATH' not in item:
+        # already written to target_dir while the archive was read
+        add_conversion_cost('bytes_streamed', item['SIZE'])
+        if item['OUTPUT_PATH'] is None:
+            return 'fail', None
+        return ('unnormalized' if conversion_function is no_norm else 'undefined'), item['OUTPUT_PATH']
+    add_conversion_cost('bytes_spooled', item['SIZE'])
+    target_dir_path = os.path.dirname(target_file_path)
+    kwargs = conversion_args(conversion_function, inkscape_pool, ffmpeg_threads)
+    try:
+        if dedup is not None:
+            output_path = convert_deduplicated(conversion_function, item['SOURCE_PATH'], target_dir_path, dedup, placer, **kwargs)
+        else:
+            output_path = conversion_function(item['SOURCE_PATH'], output_dir=target_dir_path, **kwargs)
+    finally:
+        item['SCRATCH'].discard(item['SOURCE_PATH'], item['SIZE'])
+    return ('success', output_path) if output_path else ('fail', None)
+
+
+def norm_batch(items, target_dir, working_dir, pool):
+    """
+    Normalizes profile rows that share a LibreOffice conversion function and target directory with one pool call.
+
+    Returns:
+    list: The norm_item style (outcome, output path) pair for each row.
+    """
+    fmt = libreoffice_formats[mime_normalization_map[items[0]['MIME_TYPE']]]
+    outdir = os.path.dirname(target_path_for(items[0]['FILE_PATH'], target_dir, working_dir))
+    try:
+        results = pool.convert([item['FILE_PATH'] for item in items], fmt, outdir)
+    except Exception as e:
+        print(f'Error normalizing {len(items)} files to {fmt.upper()}: {e}', file=sys.stderr)
+        return [('fail', None)] * len(items)
+    return [('success', result) if result else ('fail', None) for result in results]
+
+
+def plan_jobs(files, target_dir, working_dir, pool=None):
+    """
+    Groups profile rows into units of work for batch_norm.
+
+    Without a pool every row is its own job. With a LibreOfficePool, documents bound for the same
+    conversion function and target directory are gathered into batches of up to pool.batch_size.
+
+    Yields:
+    tuple: The tool the job runs under and the list of profile rows in it.
+    """
+    pending = {}
+    for item in files:
+        conversion_function = mime_normalization_map.get(item['MIME_TYPE'])
+        tool = tool_for(conversion_function)
+        # spooled archive members are not held back for a batch, so the scratch space they fill is freed
+        if pool is None or conversion_function not in libreoffice_formats or 'MEMBER' in item:
+            yield tool, [item]
+            continue
+        key = (conversion_function, os.path.dirname(target_path_for(item['FILE_PATH'], target_dir, working_dir)))
+        batch = pending.setdefault(key, [])
+        batch.append(item)
+        if len(batch) >= pool.batch_size:
+            yield tool, pending.pop(key)
+    for batch in pending.values():
+        yield 'libreoffice', batch
+
+
+# Predicted seconds for a conversion before there is any history, as (seconds per file, seconds per MB,
+# seconds per second of media). Only the relative sizes matter, since they only decide the dispatch order.
+conversion_costs = {
+    'norm_to_mp4': (1.0, 0.2, 0.5),
+    'norm_to_mp3': (0.5, 0.05, 0.05),
+    'norm_to_doc': (2.0, 0.5, 0),
+    'norm_to_pdf': (2.0, 0.5, 0),
+    'norm_to_svg': (1.0, 0.5, 0),
+    'no_norm': (0.001, 0.005, 0),
+    'copy': (0.001, 0.005, 0),
+}
+
+
+class CostModel:
+    """
+    Predicts how long normalizing a profile row will take, for ordering work largest first.
+
+    A prediction is a linear fit of wall time against size, made from the file_event records of earlier
+    runs for the same conversion function and PUID (or MIME type if there is no PUID), falling back to all
+    records for the function. Functions with no history use conversion_costs by size, and also by media
+    duration from ffprobe when probe_media is set. lpt_order probes those files in parallel before it orders
+    the jobs, since probing them one by one would hold up the start of a large run.
+
+    Parameters:
+    history (iterable, optional): Paths of EventLog files from earlier runs to learn from.
+    probe_media (bool): Probe the duration of audio and video without history.
+    """
+
+    def __init__(self, history=(), probe_media=False):
+        self.probe_media = probe_media
+        self.fits = {}
+        self.durations = {}
+        for path in history:
+            self.load(path)
+
+    def load(self, path):
+        """
+        Learns from every record in an EventLog file.
+        """
+        with open(path) as f:
+            for line in f:
+                try:
+                    self.learn(json.loads(line))
+                except (ValueError, KeyError):
+                    continue # a torn or foreign line
+
+    def learn(self, event):
+        """
+        Adds one file_event record to the history.
+        """
+        if event['outcome'] == 'fail' or event.get('size') is None:
+            return
+        x, y = event['size'] / 1e6, event['wall_seconds']
+        for key in ((event['function'], event.get('puid') or event['mime']), (event['function'], None)):
+            sums = self.fits.setdefault(key, [0, 0.0, 0.0, 0.0, 0.0])
+            for i, value in enumerate((1, x, y, x * x, x * y)):
+                sums[i] += value
+
+    def needs_duration(self, item):
+        """
+        Returns whether estimate would use the media duration of a profile row.
+        """
+        function = conversion_name(item['MIME_TYPE'])
+        if not self.probe_media or not conversion_costs.get(function, conversion_costs['copy'])[2]:
+            return False
+        return not any(self.fits.get(key) for key in ((function, item.get('PUID') or item['MIME_TYPE']), (function, None)))
+
+    def probe(self, items, workers=None):
+        """
+        Finds the media durations estimate needs for some profile rows with up to workers ffprobe runs at once,
+        within the ffmpeg limit of this thread's ToolEngine.
+        """
+        paths = {item['FILE_PATH'] for item in items if self.needs_duration(item)} - set(self.durations)
+        engine = get_tool_engine()
+
+        def probe(path):
+            with using_tool_engine(engine):
+                return probe_duration(path)
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1, thread_name_prefix='ffprobe') as executor:
+            self.durations.update(zip(paths, executor.map(probe, paths)))
+
+    def estimate(self, item):
+        """
+        Returns the predicted seconds for normalizing a profile row.
+        """
+        function = conversion_name(item['MIME_TYPE'])
+        try:
+            mb = os.path.getsize(item['FILE_PATH']) / 1e6
+        except OSError:
+            mb = 0
+        for key in ((function, item.get('PUID') or item['MIME_TYPE']), (function, None)):
+            sums = self.fits.get(key)
+            if sums:
+                n, sx, sy, sxx, sxy = sums
+                variance = n * sxx - sx * sx
+                if variance > 1e-12:
+                    slope = max(0.0, (n * sxy - sx * sy) / variance)
+                    return max(0.0, (sy - slope * sx) / n) + slope * mb
+                # every sample had the same size, so scale their mean time by size
+                return sy / sx * mb if sx and mb else sy / n
+        per_file, per_mb, per_media_second = conversion_costs.get(function, conversion_costs['copy'])
+        cost = per_file + per_mb * mb
+        if per_media_second and self.probe_media:
+            if item['FILE_PATH'] not in self.durations:
+                self.durations[item['FILE_PATH']] = probe_duration(item['FILE_PATH'])
+            duration = self.durations[item['FILE_PATH']]
+            if duration:
+                cost += per_media_second * duration
+        return cost
+
+
+def lpt_order(jobs, cost_model):
+    """
+    Orders jobs from plan_jobs largest predicted cost first (longest processing time first scheduling).
+
+    Returns:
+    list: The indices of jobs in the order to dispatch them.
+    """
+    if cost_model.probe_media:
+        cost_model.probe(item for tool, items in jobs for item in items)
+    costs = [sum(cost_model.estimate(item) for item in items) for tool, items in jobs]
+    return sorted(range(len(jobs)), key=lambda i: -costs[i])
+
+
+def run_job(items, target_dir, working_dir, pool=None, journal=None, placer=None, dedup=None, events=None,
+            submitted=None, inkscape_pool=None, engine=None, ffmpeg_threads=None):
+    """
+    Runs a job from plan_jobs and returns the outcome and conversion notes for each of its rows.
+
+    With events, a list of EventLog or RunMetrics sinks, a file_event is sent to each for every row. submitted
+    is the time.monotonic() the job was queued at, for the queue wait. engine is the ToolEngine of the run,
+    the shared one if omitted, and ffmpeg_threads the run's thread cap for each ffmpeg.
+    """
+    with using_tool_engine(engine):
+        started = time.monotonic()
+        if pool is not None and mime_normalization_map.get(items[0]['MIME_TYPE']) in libreoffice_formats and 'MEMBER' not in items[0]:
+            with conversion_notes() as batch_notes:
+                results = norm_batch(items, target_dir, working_dir, pool)
+            # one soffice call converts the whole batch, so each row gets an equal share of its time and costs,
+            # and the peak memory and exit status of the call
+            notes = [{key: value / len(items) if isinstance(value, (int, float)) and key not in event_only_notes else value
+                      for key, value in batch_notes.items()} for item in items]
+            share = (time.monotonic() - started) / len(items)
+            timings = [(started - (submitted or started), share) for item in items]
+        else:
+            results = []
+            notes = []
+            timings = []
+            for item in items:
+                item_started = time.monotonic()
+                with conversion_notes() as item_notes:
+                    results.append(norm_item(item, target_dir, working_dir, placer, dedup, inkscape_pool, ffmpeg_threads))
+                notes.append(item_notes)
+                timings.append((item_started - (submitted or started), time.monotonic() - item_started))
+    if journal is not None:
+        for item, (outcome, output_path) in zip(items, results):
+            journal.record(item, outcome, output_path)
+    for sink in events or ():
+        for item, (outcome, output_path), item_notes, (queue_seconds, wall_seconds) in zip(items, results, notes, timings):
+            sink.record_event(file_event(item, outcome, output_path, item_notes, queue_seconds, wall_seconds))
+    return [(outcome, item_notes) for (outcome, output_path), item_notes in zip(results, notes)]
+
+
+def conversion_name(mime_type):
+    """
+    Returns the name of the conversion function batch_norm uses for a MIME type, 'copy' if none is defined.
+    """
+    conversion_function = mime_normalization_map.get(mime_type)
+    return conversion_function.__name__ if conversion_function else 'copy'
+
+
+def source_fingerprint(file_path):
+    """
+    Returns a cheap fingerprint of a source file that changes whenever its size or modification time does.
+    """
+    st = os.stat(file_path)
+    return f'{st.st_size}:{st.st_mtime_ns}'
+
+
+class ProgressJournal:
+    """
+    An append-only record of the files a batch_norm run has finished, kept in target_dir.
+
+    Each line is a JSON object with the source path, its fingerprint, the conversion function used, the
+    outcome and the output path. When the journal is reopened the last line for each source wins and
+    the file is compacted, so a run that was killed can resume where it stopped.
+
+    Parameters:
+    target_dir (str): The directory the journal file lives in.
+    """
+
+    def __init__(self, target_dir):
+        self.path = os.path.join(target_dir, journal_name)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # a line torn by a crash mid-write
+                    self.entries[entry['source']] = entry
+        os.makedirs(target_dir, exist_ok=True)
+        compacted = self.path + '.tmp'
+        with open(compacted, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(compacted, self.path)
+        self._file = open(self.path, 'a')
+        self._lock = threading.Lock()
+
+    def completed(self, item):
+        """
+        Returns the journal entry for a profile row if its output is present and still current, otherwise None.
+        """
+        file_path = item['FILE_PATH']
+        entry = self.entries.get(file_path)
+        if entry is None or entry['outcome'] == 'fail':
+            return None
+        try:
+            if entry['fingerprint'] != source_fingerprint(file_path):
+                return None
+        except OSError:
+            return None
+        if entry['function'] != conversion_name(item['MIME_TYPE']) or not os.path.exists(entry['output']):
+            return None
+        return entry
+
+    def record(self, item, outcome, output_path):
+        """
+        Appends the result of normalizing a profile row to the journal.
+        """
+        file_path = item['FILE_PATH']
+        try:
+            fingerprint = source_fingerprint(file_path)
+        except OSError:
+            fingerprint = None
+        entry = {'source': file_path, 'fingerprint': fingerprint, 'function': conversion_name(item['MIME_TYPE']),
+                 'outcome': outcome, 'output': output_path}
+        with self._lock:
+            self.entries[file_path] = entry
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# Conversion notes that only describe a single file; they go to the event log but are not totalled in status_dict
+event_only_notes = {'exit_code', 'max_rss_kb'}
+
+# The most jobs a batch_norm run with a results_db submits ahead of the oldest unfinished one
+results_db_pending = 1024
+
+
+def file_event(item, outcome, output_path, notes, queue_seconds, wall_seconds):
+    """
+    Builds the structured record of how one profile row was processed, for an EventLog or RunMetrics.
+    """
+    def size(path):
+        try:
+            return os.path.getsize(path)
+        except (OSError, TypeError):
+            return None
+
+    event = {
+        'source': item['FILE_PATH'],
+        'size': item['SIZE'] if 'MEMBER' in item else size(item['FILE_PATH']),
+        'puid': item.get('PUID') or None,
+        'mime': item['MIME_TYPE'],
+        'function': conversion_name(item['MIME_TYPE']),
+        'tool': tool_for(mime_normalization_map.get(item['MIME_TYPE'])),
+        'outcome': outcome,
+        'queue_seconds': round(queue_seconds, 6),
+        'wall_seconds': round(wall_seconds, 6),
+        'cpu_seconds': None,
+        'max_rss_kb': None,
+        'exit_code': None,
+        'output': output_path,
+        'output_size': size(output_path),
     }
-    status_dict = {'success':[], 'success_copy':[], 'fail':[], 'unnormalized': {}, 'f_count':0,'undefined':{}} 
+    event.update(notes)
+    return event
+
+
+class EventLog:
+    """
+    A JSONL log with one file_event record per processed file, for finding which formats and tools dominate a run.
+
+    Parameters:
+    path (str): The file to append records to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def record_event(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class RunMetrics:
+    """
+    Live aggregate metrics of a batch_norm run in the Prometheus text format.
+
+    Totals of files, wall time, queue wait, child CPU time and bytes in and out are kept per conversion
+    function and MIME type, plus the peak child memory per function. They are rewritten to path at most
+    every write_interval seconds and when closed, and served at http://127.0.0.1:<port>/metrics while open.
+
+    Parameters:
+    path (str, optional): A file to write the metrics to, e.g. for the node_exporter textfile collector.
+    port (int, optional): A local port to serve the metrics on.
+    write_interval (float): Minimum seconds between rewrites of path.
+    """
+
+    def __init__(self, path=None, port=None, write_interval=1.0):
+        self.path = path
+        self.write_interval = write_interval
+        self.files = {}
+        self.totals = {}
+        self.peak_rss = {}
+        self._lock = threading.Lock()
+        self._written = 0
+        self._server = None
+        if port is not None:
+            metrics = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.render().encode()
+                    self.send_response(200 if self.path in ('/', '/metrics') else 404)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            self.port = self._server.server_address[1]
+            threading.Thread(target=self._server.serve_forever, name='norm-metrics', daemon=True).start()
+
+    def record_event(self, event):
+        key = (event['function'], event['mime'])
+        with self._lock:
+            files_key = key + (event['outcome'],)
+            self.files[files_key] = self.files.get(files_key, 0) + 1
+            totals = self.totals.setdefault(key, dict.fromkeys(metric_totals, 0))
+            for metric, field in metric_totals.items():
+                totals[metric] += event.get(field) or 0
+            if event.get('max_rss_kb'):
+                function = event['function']
+                self.peak_rss[function] = max(self.peak_rss.get(function, 0), event['max_rss_kb'] * 1024)
+            due = self.path and time.monotonic() - self._written >= self.write_interval
+        if due:
+            self.write()
+
+    def render(self):
+        """
+        Returns the current metrics in the Prometheus text exposition format.
+        """
+        def labels(**values):
+            return ','.join(f'{name}="{escape_label(value)}"' for name, value in values.items())
+
+        with self._lock:
+            lines = ['# HELP normalize_files_total Files processed.', '# TYPE normalize_files_total counter']
+            for (function, mime, outcome), count in sorted(self.files.items()):
+                lines.append(f'normalize_files_total{{{labels(function=function, mime=mime, outcome=outcome)}}} {count}')
+            for metric, help_text in metric_help.items():
+                lines += [f'# HELP normalize_{metric} {help_text}', f'# TYPE normalize_{metric} counter']
+                for (function, mime), totals in sorted(self.totals.items()):
+                    lines.append(f'normalize_{metric}{{{labels(function=function, mime=mime)}}} {totals[metric]:g}')
+            lines += ['# HELP normalize_max_rss_bytes Peak resident memory of a converter process.',
+                      '# TYPE normalize_max_rss_bytes gauge']
+            for function, peak in sorted(self.peak_rss.items()):
+                lines.append(f'normalize_max_rss_bytes{{{labels(function=function)}}} {peak}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Atomically rewrites the metrics file.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            self._written = time.monotonic()
+        tmp = f'{self.path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, self.path)
+
+    def close(self):
+        self.write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# The counters RunMetrics keeps per function and MIME type, and the file_event field each one totals
+metric_totals = {
+    'wall_seconds_total': 'wall_seconds',
+    'queue_wait_seconds_total': 'queue_seconds',
+    'cpu_seconds_total': 'cpu_seconds',
+    'input_bytes_total': 'size',
+    'output_bytes_total': 'output_size',
+}
+
+metric_help = {
+    'wall_seconds_total': 'Wall-clock seconds spent processing files.',
+    'queue_wait_seconds_total': 'Seconds files waited between being submitted and starting.',
+    'cpu_seconds_total': 'CPU seconds used by converter processes.',
+    'input_bytes_total': 'Bytes of source files processed.',
+    'output_bytes_total': 'Bytes of derivatives and copies written.',
+}
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunResults:
+    """
+    An SQLite store of the result of every file batch_norm processes, written as each file finishes.
+
+    Each batch_norm call is a run. Every processed file gets a row with the file_event fields of its
+    result, and a run's summary counters are stored when it finishes. Rows are committed at least every
+    commit_interval seconds, so a run that dies loses at most the last few results. Use query to report
+    on a run afterwards, e.g. failures by MIME type, without processing anything again.
+
+    Parameters:
+    path (str): The SQLite database file, shared by all runs recorded in it.
+    commit_interval (float): Longest time between commits while a run is recording.
+    """
+
+    columns = ('source', 'size', 'puid', 'mime', 'function', 'tool', 'outcome', 'output', 'output_size',
+               'queue_seconds', 'wall_seconds', 'cpu_seconds')
+
+    def __init__(self, path, commit_interval=1.0):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.run_id = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._committed = time.monotonic()
+        self._db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started TEXT, finished TEXT, '
+                         'working_dir TEXT, target_dir TEXT, summary TEXT)')
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS results (run_id INTEGER, {', '.join(self.columns)}, notes TEXT)")
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_run ON results (run_id, outcome, mime)')
+        self._db.commit()
+
+    def start_run(self, working_dir, target_dir):
+        """
+        Starts recording a new run and returns its id.
+        """
+        with self._lock:
+            cursor = self._db.execute("INSERT INTO runs (started, working_dir, target_dir) VALUES (datetime('now'), ?, ?)",
+                                      (working_dir, target_dir))
+            self._db.commit()
+            self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def record_event(self, event):
+        """
+        Stores the file_event of a processed file in the current run.
+        """
+        notes = {key: value for key, value in event.items() if key not in self.columns}
+        row = (self.run_id, *(event.get(column) for column in self.columns), json.dumps(notes))
+        with self._lock:
+            self._db.execute(f"INSERT INTO results VALUES ({', '.join('?' * len(row))})", row)
+            if time.monotonic() - self._committed >= self.commit_interval:
+                self._db.commit()
+                self._committed = time.monotonic()
+
+    def finish_run(self, status_dict):
+        """
+        Stores the summary counters of the current run, leaving out any path lists.
+        """
+        summary = {key: value for key, value in status_dict.items() if not isinstance(value, list)}
+        with self._lock:
+            self._db.execute("UPDATE runs SET finished = datetime('now'), summary = ? WHERE id = ?",
+                             (json.dumps(summary), self.run_id))
+            self._db.commit()
+
+    def query(self, name, run_id=None):
+        """
+        Runs one of result_queries against a run, the latest one by default.
+
+        Returns:
+        tuple: The column names and the list of result rows.
+        """
+        with self._lock:
+            if run_id is None:
+                run_id = self._db.execute('SELECT MAX(id) FROM runs').fetchone()[0]
+            cursor = self._db.execute(result_queries[name], {'run': run_id})
+            return [column[0] for column in cursor.description], cursor.fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# The reports RunResults.query can produce, with :run standing for the run's id
+result_queries = {
+    'runs': "SELECT id, started, finished, working_dir, target_dir, summary FROM runs ORDER BY id",
+    'summary': "SELECT outcome, COUNT(*) AS files, SUM(size) AS bytes FROM results WHERE run_id = :run "
+               "GROUP BY outcome ORDER BY files DESC",
+    'failures': "SELECT source, mime, puid, function FROM results WHERE run_id = :run AND outcome = 'fail' ORDER BY source",
+    'failures-by-mime': "SELECT mime, COUNT(*) AS files FROM results WHERE run_id = :run AND outcome = 'fail' "
+                        "GROUP BY mime ORDER BY files DESC",
+    'unnormalized-types': "SELECT mime, outcome, COUNT(*) AS files, SUM(size) AS bytes FROM results WHERE run_id = :run "
+                          "AND outcome IN ('unnormalized', 'undefined') GROUP BY mime, outcome ORDER BY files DESC",
+    'slowest-functions': "SELECT function, COUNT(*) AS files, SUM(wall_seconds) AS wall_seconds, SUM(cpu_seconds) AS cpu_seconds "
+                         "FROM results WHERE run_id = :run GROUP BY function ORDER BY wall_seconds DESC",
+}
+
+
+def tally(status_dict, key, file_path):
+    """
+    Adds a file to one of the status_dict path lists, or only counts it if the list was replaced by a count.
+    """
+    if isinstance(status_dict[key], list):
+        status_dict[key].append(file_path)
+    else:
+        status_dict[key] += 1
+
+
+def status_count(status_dict, key):
+    """
+    Returns the number of files in a status_dict path list or count.
+    """
+    value = status_dict[key]
+    return value if isinstance(value, int) else len(value)
+
+
+def record_status(status_dict, item, outcome, notes=None):
+    """
+    Records the outcome of norm_item for a profile row in status_dict, along with any conversion notes.
+    """
+    mime_type = item['MIME_TYPE']
+    file_path = item['FILE_PATH']
+    status_dict['f_count'] += 1
+    if outcome == 'success':
+        tally(status_dict, 'success', file_path)
+    elif outcome == 'fail':
+        tally(status_dict, 'fail', file_path)
+    else:
+        tally(status_dict, 'success_copy', file_path)
+        counts = status_dict[outcome]
+        counts[mime_type] = counts.get(mime_type, 0) + 1
+    for key, value in (notes or {}).items():
+        if key in event_only_notes:
+            continue
+        if isinstance(value, (int, float)):
+            # costs such as cpu_seconds are summed, labels such as mp4_strategy are counted
+            status_dict[key] = status_dict.get(key, 0) + value
+        else:
+            counts = status_dict.setdefault(key, {})
+            counts[value] = counts.get(value, 0) + 1
+
+
+def report_status(status_dict):
+    """
+    Prints the end-of-run user report for a batch_norm status_dict.
+    """
+    print(f"USER REPORT ON SCRIPT RESULTS: {status_count(status_dict, 'success')} files normalized out of {status_dict['f_count']} total files in the directory, and {status_count(status_dict, 'fail')} failed normalizations. {sum(status_dict['unnormalized'].values())} files were copied w/out normalization as explictly dictated by the normalization map and {sum(status_dict['undefined'].values())} withtout a defined normalization were also copied over, for a total for of {status_count(status_dict, 'success_copy')} files that were copied over without normalization.  For the failed normalizations, please review the error messages printed to screen from the software used for normalizing those files. For files that were not failed normalizations, but remain unnormalized, make sure there is a normalization pathway for that file type currently defined in this script.\n\nPlease see the list of unique file types represented among the unnormalized files below, determine your preferred normalized output for those file type, identify & install software to complete the normalization tasks on those file types, and add those normalization paths to this script. Save and rerun to see if the script was able to successfully normalize additional files.\n\nIf you aren't sure which free, open source software will open and normalize the remaining extensions, try asking ChatGPT, or review the normalization paths defined in the Archivematica documentation.")
+    mp4_strategy = status_dict.get('mp4_strategy')
+    if mp4_strategy:
+        print(f"Of the {sum(mp4_strategy.values())} videos normalized to MP4, {mp4_strategy.get('remux', 0)} were remuxed without re-encoding, "
+              f"{mp4_strategy.get('copy_video', 0) + mp4_strategy.get('copy_audio', 0)} had only one stream re-encoded and "
+              f"{mp4_strategy.get('transcode', 0)} were fully transcoded.")
+    dedup = status_dict.get('dedup')
+    if dedup:
+        print(f"{dedup.get('reused', 0)} conversions were avoided by reusing the derivative of a byte-identical file, "
+              f"saving {status_dict.get('cpu_seconds_avoided', 0):.1f} CPU-seconds.")
+    if status_dict.get('bytes_copied') or status_dict.get('bytes_linked'):
+        print(f"Files copied without normalization took {status_dict['bytes_copied'] / 1e6:.1f} MB of physical copying, "
+              f"and {status_dict['bytes_linked'] / 1e6:.1f} MB were linked or cloned without copying data.")
+    if status_dict.get('archives'):
+        print(f"{status_dict['archives']} ZIP and TAR archives were read as streams: {status_dict.get('bytes_streamed', 0) / 1e6:.1f} MB of members "
+              f"were written straight to the target directory and {status_dict.get('bytes_spooled', 0) / 1e6:.1f} MB were spooled for conversion, "
+              f"using at most {status_dict.get('scratch_peak_bytes', 0) / 1e6:.1f} MB of scratch space at once.")
+    if status_dict.get('skipped'):
+        print(f"{status_dict['skipped']} of those files were already up to date in the target directory according to the progress journal and were not processed again.")
+
+
+def new_status_dict(keep_paths=True):
+    """
+    Returns an empty status_dict, as batch_norm fills in and report_status prints.
+    Without keep_paths, 'success', 'success_copy' and 'fail' are counts instead of lists of paths.
+    """
+    paths = list if keep_paths else int
+    return {'success':paths(), 'success_copy':paths(), 'fail':paths(), 'unnormalized': {}, 'f_count':0,'undefined':{}, 'skipped':0,
+            'mp4_strategy': {}, 'placement': {}, 'bytes_copied': 0, 'bytes_linked': 0}
+
+
+def batch_norm(droid_profile, target_dir, working_dir='/app/input/', workers=1, tool_limits=None, libreoffice_pool=None,
+               resume=False, stream_queue_size=None, placement='copy', dedup=False, dedup_store=None, event_log=None,
+               metrics=None, inkscape_pool=None, schedule='profile', cost_model=None, results_db=None, mirror_dirs=True,
+               report=True, expand_archives=False, scratch_dir=None, scratch_bytes=1 << 30, matcher=None):
+    """
+    Normalizes every file in a DROID profile into target_dir, mirroring the layout of working_dir.
+
+    Parameters:
+    droid_profile (iterable): DROID profile rows, as returned by build_droid_profile.
+    target_dir (str): The directory the normalized derivatives and copies are written to.
+    working_dir (str): The directory the profile was built from.
+    workers (int): Concurrent jobs per tool. 1 keeps the original sequential behaviour.
+    tool_limits (dict, optional): Per-tool overrides of the concurrency cap, see resolve_tool_limits.
+    libreoffice_pool (LibreOfficePool, optional): Converts documents in batches on long-lived profiles
+                                                  instead of one soffice start per document.
+    resume (bool): Keep a progress journal in target_dir and skip files whose output it shows is present
+                   and current, redoing only new, changed, failed or missing ones.
+    stream_queue_size (int, optional): Read droid_profile on a background thread through a queue of this
+                                       many rows and start converting as soon as rows arrive, instead of
+                                       after the whole profile is available. Also bounds the jobs in flight.
+    placement (str): How files that are not converted reach target_dir, 'copy', 'auto' or 'hardlink'.
+                     See placement_strategies.
+    dedup (bool): Convert byte-identical sources once and place that derivative for every copy.
+    dedup_store (str, optional): A directory keeping derivatives for reuse by later runs; implies dedup.
+                                 Documents converted in pooled LibreOffice batches are not deduplicated.
+    event_log (str, optional): A JSONL file to append one file_event record to per processed file.
+    metrics (RunMetrics, optional): Aggregates the same records into Prometheus metrics as the run goes.
+    inkscape_pool (InkscapePool, optional): Converts PostScript on long-lived `inkscape --shell` instances
+                                            instead of one Inkscape start per file.
+    schedule (str): 'profile' dispatches files in profile order. 'lpt' dispatches the costliest first within
+                    each tool, so a huge file found last does not run alone after everything else has
+                    finished. Only affects parallel runs, and cannot be combined with stream_queue_size.
+    cost_model (CostModel, optional): Predicts costs for the 'lpt' schedule; a CostModel() if omitted.
+    results_db (str, optional): An SQLite file to record every file's result in as it finishes, see
+                                RunResults. The status_dict then only counts the successful, copied and
+                                failed files instead of listing their paths, and at most results_db_pending
+                                jobs are in flight unless stream_queue_size is given. Memory use still grows
+                                with a profile passed as a list, the 'lpt' schedule, and resume's journal.
+    mirror_dirs (bool): Recreate every directory of working_dir in target_dir first. Without it only the
+                        directories the profile's files need are created, and working_dir is not walked.
+    report (bool): Print the end-of-run user report.
+    expand_archives (bool): Normalize the members of ZIP and TAR archives into a directory named after the
+                            archive, reading each archive once as a stream instead of extracting it. Members
+                            that are not converted are written straight to target_dir; the rest are spooled
+                            one by one into a ScratchSpace. Members are always processed again on resume, and
+                            cannot be scheduled 'lpt'.
+    scratch_dir (str, optional): Where to create the scratch directory, the system default if omitted.
+    scratch_bytes (int): The most bytes of archive members spooled at once, see ScratchSpace.
+    matcher (SignatureMatcher, optional): Identifies archive members from their header bytes; without it, or
+                                          where it cannot decide, members are identified by extension.
+
+    Returns:
+    dict: The status_dict summarizing the run.
+    """
+    if schedule not in ('profile', 'lpt'):
+        raise ValueError(f"Unknown schedule {schedule!r}, expected 'profile' or 'lpt'")
+    if schedule == 'lpt' and stream_queue_size:
+        raise ValueError("The 'lpt' schedule needs the whole profile up front and cannot be used when streaming")
+    if schedule == 'lpt' and expand_archives:
+        raise ValueError("The 'lpt' schedule would spool every archive member at once and cannot be used with expand_archives")
+    status_dict = new_status_dict(keep_paths=not results_db)
+    placer = FilePlacer(placement)
+    derivatives = DerivativeStore(dedup_store, placer) if dedup or dedup_store else None
     
     # Create all directories in the target directory, including empty ones
-    for dirpath, dirnames, filenames in os.walk(working_dir):
+    for dirpath, dirnames, filenames in os.walk(working_dir) if mirror_dirs else ():
         relative_dirpath = os.path.relpath(dirpath, working_dir)
         print(relative_dirpath)
         target_dirpath = os.path.join(target_dir, relative_dirpath)
     
         os.makedirs(target_dirpath, exist_ok=True)
 
-    for item in droid_profile:
-        # Check if it's a file
-        if item['TYPE'] == 'File':
-            mime_type = item['MIME_TYPE']
-            file_path = item['FILE_PATH']
-            status_dict['f_count'] += 1
+    if stream_queue_size:
+        droid_profile = prefetch(droid_profile, stream_queue_size)
+
+    # Check if it's a file
+    files = (item for item in droid_profile if item['TYPE'] == 'File')
+    scratch = ScratchSpace(scratch_dir, scratch_bytes) if expand_archives else None
+    if scratch is not None:
+        files = expand_archive_rows(files, target_dir, working_dir, scratch, matcher, status_dict)
+    if not mirror_dirs:
+        files = with_target_dirs(files, target_dir, working_dir)
+    journal = ProgressJournal(target_dir) if resume else None
+    results = RunResults(results_db) if results_db else None
+    if results is not None:
+        results.start_run(working_dir, target_dir)
+    if journal is not None:
+        files = skip_completed(files, journal, status_dict, results)
+    jobs = plan_jobs(files, target_dir, working_dir, libreoffice_pool)
+    order = None
+    if schedule == 'lpt' and (workers > 1 or tool_limits):
+        jobs = list(jobs)
+        order = lpt_order(jobs, cost_model or CostModel())
+    log = EventLog(event_log) if event_log else None
+    events = [sink for sink in (log, metrics, results) if sink is not None]
+
+    # with results_db the paths are not kept, so neither are more than a bounded number of unrecorded jobs
+    max_pending = stream_queue_size or (results_db_pending if results is not None else None)
+
+    try:
+        run_jobs(jobs, status_dict, target_dir, working_dir, workers, tool_limits, libreoffice_pool, journal,
+                 max_pending=max_pending, placer=placer, dedup=derivatives, events=events,
+                 inkscape_pool=inkscape_pool, order=order)
+        if scratch is not None:
+            status_dict['scratch_peak_bytes'] = scratch.peak
+        status_dict['bytes_copied'] = placer.bytes_copied
+        status_dict['bytes_linked'] = placer.bytes_linked
+        # only reached when the run finished; a run that died keeps the results it recorded, but no summary
+        if results is not None:
+            results.finish_run(status_dict)
+    finally:
+        if scratch is not None:
+            scratch.close()
+        if journal is not None:
+            journal.close()
+        if log is not None:
+            log.close()
+        if metrics is not None:
+            metrics.write()
+        if results is not None:
+            results.close()
+
+    if report:
+        report_status(status_dict)
+    return status_dict
+
+
+def with_target_dirs(files, target_dir, working_dir):
+    """
+    Passes profile rows through, creating the directory each one's output goes to on the way.
+    """
+    for item in files:
+        os.makedirs(os.path.dirname(target_path_for(item['FILE_PATH'], target_dir, working_dir)), exist_ok=True)
+        yield item
+
+
+def skip_completed(files, journal, status_dict, results=None):
+    """
+    Passes through the profile rows the journal has no current output for, recording the rest as skipped.
+    """
+    for item in files:
+        entry = journal.completed(item)
+        if entry is None:
+            yield item
+        else:
+            status_dict['skipped'] += 1
+            record_status(status_dict, item, entry['outcome'])
+            if results is not None:
+                results.record_event(file_event(item, entry['outcome'], entry['output'], {'resume': 'skipped'}, 0, 0))
+
+
+def run_jobs(jobs, status_dict, target_dir, working_dir, workers=1, tool_limits=None, libreoffice_pool=None, journal=None,
+             max_pending=None, placer=None, dedup=None, events=None, inkscape_pool=None, order=None):
+    """
+    Runs the jobs from plan_jobs, sequentially or on per-tool thread pools, and records their outcomes in status_dict.
+
+    With max_pending, no more than that many jobs are submitted ahead of the oldest unfinished one, so a
+    lazily produced profile is consumed at the pace of the converters instead of all at once. With order,
+    a list of indices such as lpt_order returns, a parallel run submits the jobs in that order; outcomes
+    are still recorded in the jobs' own order.
+    """
+    if workers <= 1 and not tool_limits:
+        for tool, items in jobs:
+            results = run_job(items, target_dir, working_dir, libreoffice_pool, journal, placer, dedup, events,
+                              time.monotonic(), inkscape_pool)
+            for item, (outcome, notes) in zip(items, results):
+                record_status(status_dict, item, outcome, notes)
+    else:
+        limits = dict(tool_limits or {})
+        if libreoffice_pool is not None:
+            # Pool instances have their own profiles, so they can all run at once
+            limits.setdefault('libreoffice', libreoffice_pool.size)
+        if inkscape_pool is not None:
+            limits.setdefault('inkscape', inkscape_pool.size)
+        limits = resolve_tool_limits(workers, limits)
+        # One executor per tool so long video transcodes cannot occupy the slots documents need
+        executors = {tool: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f'norm-{tool}')
+                     for tool, limit in limits.items()}
+        # the converter processes themselves run at the same caps as the jobs, on an engine of this run's own
+        # so concurrent runs do not change each other's caps
+        engine = ToolEngine(limits)
+        # and split the cores between the concurrent ffmpeg processes, unless the caller chose a thread count
+        threads = ffmpeg_threads or max(1, (os.cpu_count() or 1) // limits['ffmpeg'])
+        try:
+            if order is not None:
+                jobs = list(jobs)
+                futures = {}
+                for i in order:
+                    tool, items = jobs[i]
+                    futures[i] = executors[tool].submit(run_job, items, target_dir, working_dir, libreoffice_pool, journal,
+                                                        placer, dedup, events, time.monotonic(), inkscape_pool, engine,
+                                                        threads)
+                # Record in plan_jobs order so the status_dict matches a sequential run with the same pool
+                for i, (tool, items) in enumerate(jobs):
+                    record_job(status_dict, items, futures[i])
+                return
+            pending = deque()
+            for tool, items in jobs:
+                future = executors[tool].submit(run_job, items, target_dir, working_dir, libreoffice_pool, journal, placer,
+                                                dedup, events, time.monotonic(), inkscape_pool, engine, threads)
+                pending.append((items, future))
+                while max_pending and len(pending) > max_pending:
+                    record_job(status_dict, *pending.popleft())
+            # Record in plan_jobs order so the status_dict matches a sequential run with the same pool. That is
+            # profile order unless a LibreOfficePool is given: plan_jobs holds documents back until their batch
+            # is full, so they are recorded where their batch was formed, in a sequential run as well.
+            while pending:
+                record_job(status_dict, *pending.popleft())
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+            engine.close()
+
+
+def record_job(status_dict, items, future):
+    """
+    Waits for a submitted job and records the outcome of each of its rows.
+    """
+    for item, (outcome, notes) in zip(items, future.result()):
+        record_status(status_dict, item, outcome, notes)
+
+
+class _ProducerError:
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(rows, maxsize):
+    """
+    Iterates rows on a background thread, handing them over through a queue of at most maxsize rows.
+
+    This lets a slow producer such as a DROID run keep working while the caller processes the rows it has
+    already produced, without ever buffering more than maxsize of them. Exceptions raised by the producer
+    are re-raised in the caller.
+    """
+    handoff = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for row in rows:
+                while not stop.is_set():
+                    try:
+                        handoff.put(row, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            handoff.put(done)
+        except BaseException as e:
+            handoff.put(_ProducerError(e))
+
+    producer = threading.Thread(target=produce, name='norm-prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            row = handoff.get()
+            if row is done:
+                return
+            if isinstance(row, _ProducerError):
+                raise row.error
+            yield row
+    finally:
+        stop.set()
+
+
+class JobQueue(ABC):
+    """
+    The interface a coordinator and its workers share to distribute a batch_norm run over several hosts.
+
+    Jobs are DROID profile rows. A worker leases jobs for lease_seconds, extends the lease with heartbeat
+    while it works on them, and reports each result with complete. A job whose lease expires, because its
+    worker died or hung, goes back to the queue and is leased again, up to max_attempts times before it is
+    recorded as failed. Backends implement these methods; SQLiteJobQueue is the one this module provides.
+    """
+
+    @abstractmethod
+    def configure(self, working_dir, target_dir):
+        """
+        Records the run's directories for workers, which need not be told them on the command line.
+        """
+
+    @abstractmethod
+    def config(self):
+        """
+        Returns the (working_dir, target_dir) recorded by configure, or None before it is called.
+        """
+
+    @abstractmethod
+    def add(self, items):
+        """
+        Appends profile rows as jobs, in order. Rows whose FILE_PATH is already queued are ignored, so a
+        coordinator restarted before it sealed the queue can add the whole profile again.
+        """
+
+    @abstractmethod
+    def seal(self):
+        """
+        Marks the queue as complete, so workers stop once every job is done.
+        """
+
+    @abstractmethod
+    def lease(self, worker_id, count=1):
+        """
+        Leases up to count available jobs to a worker.
+
+        Returns:
+        list: (job_id, profile row) pairs.
+        """
+
+    @abstractmethod
+    def heartbeat(self, worker_id, job_ids):
+        """
+        Extends the worker's leases on jobs it is still working on.
+        """
+
+    @abstractmethod
+    def complete(self, worker_id, job_id, outcome, output_path=None, notes=None):
+        """
+        Records a job's result, unless the worker lost its lease to another one meanwhile.
+
+        Returns:
+        bool: Whether the result was recorded.
+        """
 
-            # Get the relative path of the file from the working directory
-            relative_path = os.path.relpath(file_path, working_dir)
-            # Create the target file path by joining the target directory with the relative path
-            target_file_path = os.path.join(target_dir, relative_path)
+    @abstractmethod
+    def progress(self):
+        """
+        Returns a tuple of the number of jobs done, the total number of jobs and whether the queue is sealed.
+        Jobs whose last lease has expired count as done, so a coordinator still finishes if every worker dies.
+        """
 
-            conversion_function = mime_normalization_map.get(mime_type)
+    @abstractmethod
+    def results(self):
+        """
+        Yields (profile row, outcome, notes) for every finished job, in the order they were added.
+        """
 
+
+class SQLiteJobQueue(JobQueue):
+    """
+    A JobQueue kept in an SQLite database, for workers on one machine or on hosts sharing a filesystem with
+    working locks, such as NFS with lockd. It uses a rollback journal, since WAL mode does not work across hosts.
+    Lease expiry compares wall clock times, so hosts' clocks must agree to within a few seconds.
+
+    Parameters:
+    path (str): The SQLite database file.
+    lease_seconds (float): How long a lease lasts without a heartbeat.
+    max_attempts (int): Leases a job gets before it is recorded as failed.
+    """
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # transactions are explicit, so a lease is taken atomically across processes
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        # WAL's shared memory index only works on one host; the rollback journal relies on file locks alone
+        self._db.execute('PRAGMA journal_mode=DELETE')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, item TEXT, path TEXT, state TEXT, '
+                         'worker TEXT, lease_expires REAL, attempts INTEGER, outcome TEXT, output TEXT, notes TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires)')
+        # a file is queued once, however often a restarted coordinator adds it
+        self._db.execute('CREATE UNIQUE INDEX IF NOT EXISTS jobs_path ON jobs (path)')
+
+    def _transaction(self, statements):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
             try:
-                if conversion_function:
-                    # If the conversion function is not `no_norm`, we perform conversion
-                    if conversion_function is not no_norm:
-                        target_dir_path = os.path.dirname(target_file_path)
-                        conversion_function(file_path, output_dir=target_dir_path)
-                        status_dict['success'].append(file_path)
-                    else: # If it's `no_norm`, we simply copy the file
-                        copyfile(file_path, target_file_path)
-                        status_dict['success_copy'].append(file_path)
-                        if mime_type in status_dict['unnormalized']:
-                            status_dict['unnormalized'][mime_type] += 1
-                        else:
-                            status_dict['unnormalized'].update({mime_type:1})
-                else: # If no normalization function is define we still copy the file
-                    copyfile(file_path, target_file_path)
-                    status_dict['success_copy'].append(file_path)
-                    if mime_type in status_dict['undefined']:
-                        status_dict['undefined'][mime_type] += 1
-                    else:
-                        status_dict['undefined'].update({mime_type:1})
-            except Exception as e:
-                print(f'Error normalizing {file_path}: {e}', file=sys.stderr)
-                status_dict['fail'].append(file_path)
-
-    print(f"USER REPORT ON SCRIPT RESULTS: {len(status_dict['success'])} files normalized out of {status_dict['f_count']} total files in the directory, and {len(status_dict['fail'])} failed normalizations. {sum(status_dict['unnormalized'].values())} files were copied w/out normalization as explictly dictated by the normalization map and {sum(status_dict['undefined'].values())} withtout a defined normalization were also copied over, for a total for of {len(status_dict['success_copy'])} files that were copied over without normalization.  For the failed normalizations, please review the error messages printed to screen from the software used for normalizing those files. For files that were not failed normalizations, but remain unnormalized, make sure there is a normalization pathway for that file type currently defined in this script.\n\nPlease see the list of unique file types represented among the unnormalized files below, determine your preferred normalized output for those file type, identify & install software to complete the normalization tasks on those file types, and add those normalization paths to this script. Save and rerun to see if the script was able to successfully normalize additional files.\n\nIf you aren't sure which free, open source software will open and normalize the remaining extensions, try asking ChatGPT, or review the normalization paths defined in the Archivematica documentation.")
+                result = statements(self._db)
+                self._db.execute('COMMIT')
+                return result
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def _give_up(self, db, now):
+        # leases that expired on their last attempt are recorded as failed
+        db.execute("UPDATE jobs SET state = 'done', outcome = 'fail', notes = ? "
+                   "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                   (json.dumps({'lease': 'expired'}), now, self.max_attempts))
+
+    def configure(self, working_dir, target_dir):
+        self._transaction(lambda db: db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                                    [('working_dir', working_dir), ('target_dir', target_dir)]))
+
+    def config(self):
+        with self._lock:
+            meta = dict(self._db.execute("SELECT key, value FROM meta WHERE key IN ('working_dir', 'target_dir')"))
+        if len(meta) < 2:
+            return None
+        return meta['working_dir'], meta['target_dir']
+
+    def add(self, items):
+        rows = [(json.dumps(item), item['FILE_PATH']) for item in items]
+        self._transaction(lambda db: db.executemany(
+            "INSERT OR IGNORE INTO jobs (item, path, state, attempts) VALUES (?, ?, 'pending', 0)", rows))
+
+    def seal(self):
+        self._transaction(lambda db: db.execute("INSERT OR REPLACE INTO meta VALUES ('sealed', '1')"))
+
+    def lease(self, worker_id, count=1):
+        def take(db):
+            now = time.time()
+            self._give_up(db, now)
+            jobs = db.execute("SELECT id, item FROM jobs WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                              "ORDER BY id LIMIT ?", (now, count)).fetchall()
+            db.executemany("UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                           "WHERE id = ?", [(worker_id, now + self.lease_seconds, job_id) for job_id, item in jobs])
+            return [(job_id, json.loads(item)) for job_id, item in jobs]
+        return self._transaction(take)
+
+    def heartbeat(self, worker_id, job_ids):
+        expires = time.time() + self.lease_seconds
+        self._transaction(lambda db: db.executemany(
+            "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            [(expires, job_id, worker_id) for job_id in job_ids]))
+
+    def complete(self, worker_id, job_id, outcome, output_path=None, notes=None):
+        cursor = self._transaction(lambda db: db.execute(
+            "UPDATE jobs SET state = 'done', outcome = ?, output = ?, notes = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (outcome, output_path, json.dumps(notes or {}), job_id, worker_id)))
+        return cursor.rowcount == 1
+
+    def progress(self):
+        def count(db):
+            # so the run still finishes when no worker is left to lease the jobs
+            self._give_up(db, time.time())
+            done, total = db.execute("SELECT COUNT(CASE WHEN state = 'done' THEN 1 END), COUNT(*) FROM jobs").fetchone()
+            sealed = db.execute("SELECT 1 FROM meta WHERE key = 'sealed'").fetchone() is not None
+            return done, total, sealed
+        return self._transaction(count)
+
+    def results(self):
+        with self._lock:
+            rows = self._db.execute("SELECT item, outcome, notes FROM jobs WHERE state = 'done' ORDER BY id").fetchall()
+        for item, outcome, notes in rows:
+            yield json.loads(item), outcome, json.loads(notes or '{}')
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def coordinate(droid_profile, job_queue, target_dir, working_dir='/app/input/', poll_interval=5, chunk_size=1000):
+    """
+    Runs the coordinator side of a distributed batch_norm: queues the profile's files as jobs, waits for
+    workers started with run_worker to finish them, and reports on the merged results.
+
+    Jobs are added in chunks as the profile is read, so workers can start before DROID has finished.
+    A coordinator restarted on a queue that is already sealed only waits for the remaining jobs; one
+    restarted while it was still adding them adds the profile again, and the files already queued are kept.
+
+    Returns:
+    dict: The status_dict merged from every worker's results, in profile order.
+    """
+    # Create all directories in the target directory, including empty ones, before workers are told where it is
+    for dirpath, dirnames, filenames in os.walk(working_dir):
+        os.makedirs(os.path.join(target_dir, os.path.relpath(dirpath, working_dir)), exist_ok=True)
+    done, total, sealed = job_queue.progress()
+    if not sealed:
+        job_queue.configure(working_dir, target_dir)
+        chunk = []
+        for item in droid_profile:
+            if item['TYPE'] != 'File':
+                continue
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                job_queue.add(chunk)
+                chunk = []
+        job_queue.add(chunk)
+        job_queue.seal()
+
+    while True:
+        done, total, sealed = job_queue.progress()
+        if done == total:
+            break
+        print(f'{done} of {total} files normalized', file=sys.stderr)
+        time.sleep(poll_interval)
+
+    status_dict = new_status_dict()
+    for item, outcome, notes in job_queue.results():
+        record_status(status_dict, item, outcome, notes)
+    report_status(status_dict)
+    return status_dict
+
+
+def run_worker(job_queue, workers=1, worker_id=None, placement='copy', poll_interval=5, heartbeat_interval=None,
+               inkscape_pool=None):
+    """
+    Runs the worker side of a distributed batch_norm until every job in the queue is done.
+
+    Each of the worker's threads leases one job at a time, normalizes it with norm_item and reports the
+    result, while a heartbeat thread keeps the leases of the jobs in progress alive.
+
+    Parameters:
+    job_queue (JobQueue): The queue a coordinator fills.
+    workers (int): Jobs processed at once on this host.
+    worker_id (str, optional): Identifies this worker's leases, the host name and process id by default.
+    placement (str): How files that are not converted reach target_dir, see placement_strategies.
+    poll_interval (float): Seconds to wait when no job is available yet.
+    heartbeat_interval (float, optional): Seconds between lease renewals, a third of the lease by default.
+    inkscape_pool (InkscapePool, optional): Converts PostScript on long-lived Inkscape shell processes.
+
+    Returns:
+    int: The number of jobs this worker completed.
+    """
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    heartbeat_interval = heartbeat_interval or getattr(job_queue, 'lease_seconds', 300) / 3
+    placer = FilePlacer(placement)
+    held = set()
+    held_lock = threading.Lock()
+    stopped = threading.Event()
+    completed = []
+
+    def beat():
+        while not stopped.wait(heartbeat_interval):
+            with held_lock:
+                job_ids = list(held)
+            if job_ids:
+                job_queue.heartbeat(worker_id, job_ids)
+
+    def work():
+        while True:
+            config = job_queue.config()
+            leased = job_queue.lease(worker_id) if config else []
+            if not leased:
+                done, total, sealed = job_queue.progress()
+                if sealed and done == total:
+                    return
+                # the coordinator is still adding jobs, or other workers hold leases that may yet expire
+                time.sleep(poll_interval)
+                continue
+            working_dir, target_dir = config
+            (job_id, item), = leased
+            with held_lock:
+                held.add(job_id)
+            try:
+                with conversion_notes() as notes:
+                    outcome, output_path = norm_item(item, target_dir, working_dir, placer, inkscape_pool=inkscape_pool)
+            finally:
+                with held_lock:
+                    held.discard(job_id)
+            if job_queue.complete(worker_id, job_id, outcome, output_path, notes):
+                completed.append(job_id)
+
+    heart = threading.Thread(target=beat, name='norm-heartbeat', daemon=True)
+    heart.start()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='norm-worker') as executor:
+            for future in [executor.submit(work) for _ in range(workers)]:
+                future.result()
+    finally:
+        stopped.set()
+        heart.join()
+    return len(completed)
+
+
+# Files the watch mode leaves alone: hidden files and the partial files copy tools write before renaming
+watch_ignore_suffixes = ('.part', '.partial', '.tmp', '.crdownload', '~')
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+
+def watch_ignored(path):
+    name = os.path.basename(path)
+    return name.startswith('.') or name.endswith(watch_ignore_suffixes)
+
+
+def scan_tree(root):
+    """
+    Returns the (size, mtime_ns) of every file under root that the watch mode does not ignore.
+    """
+    snapshot = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if watch_ignored(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+class PollingWatcher:
+    """
+    Detects new and modified files under a directory by comparing the tree's metadata every interval seconds.
+    This is the fallback where inotify is unavailable, such as on network shares written from other hosts.
+    """
+
+    def __init__(self, root, interval=2.0):
+        self.root = root
+        self.interval = interval
+        self._snapshot = scan_tree(root)
+        self._scanned = time.monotonic()
+
+    def changes(self, timeout):
+        """
+        Waits up to timeout seconds and returns the paths of files created or modified meanwhile.
+        """
+        time.sleep(max(0, min(timeout, self._scanned + self.interval - time.monotonic())))
+        if time.monotonic() - self._scanned < self.interval:
+            return set()
+        snapshot = scan_tree(self.root)
+        self._scanned = time.monotonic()
+        changed = {path for path, signature in snapshot.items() if self._snapshot.get(path) != signature}
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Detects new and modified files under a directory with Linux inotify, watching every subdirectory and
+    adding watches for new ones as they appear. Files already inside a new directory when its watch is
+    added are reported too. If the kernel's event queue overflows, the tree is rescanned once, any
+    directories whose creation was lost are watched, and only files whose size or modification time differ
+    from what was last seen are reported, as PollingWatcher does.
+
+    Raises:
+    OSError: If inotify is not available on this system.
+    """
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MOVED_FROM | IN_DELETE
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+        self.root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._fd, selectors.EVENT_READ)
+        # the (size, mtime_ns) last seen of every file, to tell what changed when events were lost
+        self._snapshot = self._watch_tree(root)
+
+    def _watch_tree(self, top):
+        """
+        Watches top and every directory below it, returning the (size, mtime_ns) of the files already in them.
+        """
+        import ctypes
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), self.mask)
+            if wd < 0:
+                print(f'Could not watch {dirpath}: {os.strerror(ctypes.get_errno())}', file=sys.stderr)
+                continue
+            self._dirs[wd] = dirpath
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if watch_ignored(path):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = (st.st_size, st.st_mtime_ns)
+        return found
+
+    def changes(self, timeout):
+        """
+        Waits up to timeout seconds and returns the paths of files created or modified meanwhile.
+        """
+        changed = set()
+        if not self._selector.select(timeout):
+            return changed
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].split(b'\0', 1)[0]
+                offset += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, including perhaps those of new directories, so watch the whole tree
+                    # again and report what differs from the files last seen
+                    snapshot = self._watch_tree(self.root)
+                    changed.update(path for path, signature in snapshot.items() if self._snapshot.get(path) != signature)
+                    self._snapshot = snapshot
+                    continue
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                dirpath = self._dirs.get(wd)
+                if dirpath is None or not name:
+                    continue
+                path = os.path.join(dirpath, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and not os.path.basename(path).startswith('.'):
+                        found = self._watch_tree(path)
+                        changed.update(found)
+                        self._snapshot.update(found)
+                elif mask & (IN_MOVED_FROM | IN_DELETE):
+                    self._snapshot.pop(path, None)
+                    changed.discard(path)
+                else:
+                    changed.add(path)
+        changed = {path for path in changed if not watch_ignored(path)}
+        for path in changed:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self._snapshot.pop(path, None)
+                continue
+            self._snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return changed
+
+    def close(self):
+        self._selector.close()
+        os.close(self._fd)
+
+
+def open_watcher(root, poll_interval=2.0, use_inotify=True):
+    """
+    Returns an InotifyWatcher for root where inotify works, otherwise a PollingWatcher.
+    """
+    if use_inotify:
+        try:
+            return InotifyWatcher(root)
+        except OSError as e:
+            print(f'Falling back to polling {root} every {poll_interval}s: {e}', file=sys.stderr)
+    return PollingWatcher(root, poll_interval)
+
+
+def watch_batches(root, batch_size=50, batch_wait=1.0, settle_seconds=2.0, poll_interval=2.0, use_inotify=True,
+                  initial_scan=False, stop=None):
+    """
+    Watches a directory and yields batches of files that have finished arriving.
+
+    A file counts as fully written once its size and modification time have not changed for settle_seconds.
+    Settled files are gathered for up to batch_wait seconds, or until batch_size of them are ready, so a burst
+    of arrivals is handled in a few runs rather than one per file.
+
+    Parameters:
+    root (str): The directory to watch, including its subdirectories.
+    initial_scan (bool): Also yield the files already present when watching starts.
+    stop (threading.Event, optional): Ends the generator once set.
+
+    Yields:
+    list: Paths of settled files.
+    """
+    watcher = open_watcher(root, poll_interval, use_inotify)
+    settling = {}
+    batch = []
+    first_ready = None
+    try:
+        if initial_scan:
+            settling.update((path, None) for path in scan_tree(root))
+        while stop is None or not stop.is_set():
+            timeout = settle_seconds / 4 if settling else batch_wait
+            for path in watcher.changes(timeout):
+                settling[path] = None
+            now = time.monotonic()
+            for path, seen in list(settling.items()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    del settling[path] # removed or renamed before it settled
+                    continue
+                signature = (st.st_size, st.st_mtime_ns)
+                if seen is None or seen[0] != signature:
+                    settling[path] = (signature, now)
+                elif now - seen[1] >= settle_seconds:
+                    del settling[path]
+                    if path not in batch:
+                        batch.append(path)
+                    first_ready = first_ready or now
+            if batch and (len(batch) >= batch_size or now - first_ready >= batch_wait):
+                ready, batch, first_ready = batch[:batch_size], batch[batch_size:], None
+                if batch:
+                    first_ready = now
+                yield ready
+    finally:
+        watcher.close()
+
+
+def watch_and_normalize(working_dir, target_dir, cache=None, batch_size=50, batch_wait=1.0, settle_seconds=2.0,
+                        poll_interval=2.0, use_inotify=True, initial_scan=False, stop=None, **batch_norm_args):
+    """
+    Runs as a hot folder: normalizes each file that arrives in working_dir into target_dir, seconds after it
+    has been written, without profiling or converting the rest of the tree again.
+
+    Batches from watch_batches are identified with identify_files and passed to batch_norm with the
+    remaining keyword arguments. A modified file is converted again, replacing its earlier derivative.
+
+    Parameters:
+    cache (IdentificationCache, optional): Reused identifications, see identify_files.
+    stop (threading.Event, optional): Stops watching once set, after the batch in progress.
+
+    Returns:
+    dict: Totals of the files processed and of each outcome.
+    """
+    totals = {'f_count': 0, 'success': 0, 'success_copy': 0, 'fail': 0}
+    for paths in watch_batches(working_dir, batch_size, batch_wait, settle_seconds, poll_interval, use_inotify,
+                               initial_scan, stop):
+        rows = []
+        for path, metadata in identify_files(paths, batch_size=batch_size, cache=cache):
+            row = dict(metadata or {})
+            row.update({'TYPE': 'File', 'FILE_PATH': path, 'MIME_TYPE': row.get('MIME_TYPE') or ''})
+            rows.append(row)
+        status_dict = batch_norm(rows, target_dir, working_dir=working_dir, mirror_dirs=False, report=False,
+                                 **batch_norm_args)
+        totals['f_count'] += status_dict['f_count']
+        for key in ('success', 'success_copy', 'fail'):
+            totals[key] += status_count(status_dict, key)
+        print(f"{time.strftime('%H:%M:%S')} normalized {status_count(status_dict, 'success')}, copied "
+              f"{status_count(status_dict, 'success_copy')} and failed {status_count(status_dict, 'fail')} of "
+              f"{len(rows)} new files", file=sys.stderr)
+    return totals
@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import platform
+import subprocess
+import tempfile
+import multiprocessing
+
+from normalize import build_droid_profile, identify_file, batch_norm, status_count
+
+
+# Default number of files of each kind in a generated corpus
+default_mix = {'video': 2, 'audio': 4, 'text': 20, 'eps': 10, 'odt': 10}
+
+# The stage metrics compared against a baseline, and whether higher values are better
+compared_metrics = {'seconds': False, 'files_per_second': True, 'mb_per_second': True}
+
+words = ('archive', 'record', 'accession', 'normalize', 'derivative', 'format', 'preserve', 'digital',
+         'collection', 'folder', 'oral', 'history', 'video', 'audio', 'document', 'vector')
+
+
+def generate_corpus(root, mix=None, seed=0, media_seconds=5):
+    """
+    Builds a reproducible synthetic corpus for benchmarking.
+
+    Video and audio are made with the same ffmpeg lavfi testsrc and sine sources as the test fixtures, and text,
+    EPS and ODT files are generated from a seeded random generator, so the same arguments always give the same
+    corpus. Files are spread over a few subdirectories.
+
+    Parameters:
+    root (str): The directory to create the corpus in.
+    mix (dict, optional): The number of files of each kind ('video', 'audio', 'text', 'eps', 'odt').
+    seed (int): Seed for the generated contents.
+    media_seconds (int): Length of each generated video and audio file.
+
+    Returns:
+    list: The paths of the generated files.
+    """
+    mix = dict(default_mix if mix is None else mix)
+    unknown = set(mix) - set(default_mix)
+    if unknown:
+        raise ValueError(f"Unknown file kinds {', '.join(sorted(unknown))}, expected {', '.join(default_mix)}")
+    rng = random.Random(seed)
+    paths = []
+    for kind, count in sorted(mix.items()):
+        for i in range(count):
+            folder = os.path.join(root, f'folder{i % 3}', kind)
+            os.makedirs(folder, exist_ok=True)
+            if kind == 'video':
+                path = os.path.join(folder, f'video{i}.avi')
+                subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi',
+                                '-i', 'testsrc=size=320x240:rate=30', '-t', str(media_seconds), path], check=True)
+            elif kind == 'audio':
+                path = os.path.join(folder, f'audio{i}.wav')
+                subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi',
+                                '-i', f'sine=frequency={220 + 110 * (i % 8)}:duration={media_seconds}',
+                                '-ar', '44100', '-ac', '2', path], check=True)
+            elif kind == 'text':
+                path = os.path.join(folder, f'text{i}.txt')
+                with open(path, 'w') as f:
+                    for line in range(rng.randint(10, 200)):
+                        f.write(' '.join(rng.choice(words) for _ in range(12)) + '\n')
+            elif kind == 'eps':
+                path = os.path.join(folder, f'drawing{i}.eps')
+                with open(path, 'w') as f:
+                    f.write('%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 200 200\n')
+                    for shape in range(rng.randint(1, 20)):
+                        x, y, r = rng.randint(0, 200), rng.randint(0, 200), rng.randint(5, 50)
+                        f.write(f'newpath {x} {y} {r} 0 360 arc stroke\n')
+                    f.write('showpage\n%%EOF\n')
+            else:
+                path = os.path.join(folder, f'document{i}.odt')
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<document>\n')
+                    for paragraph in range(rng.randint(5, 50)):
+                        f.write(f"  <p>{' '.join(rng.choice(words) for _ in range(20))}</p>\n")
+                    f.write('</document>\n')
+            paths.append(path)
+    return paths
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process and of its largest finished child, in MB.
+    Both are lifetime peaks, so each stage is measured in a process of its own, see run_stage.
+    """
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+    try:
+        # Linux carries ru_maxrss over fork and exec, but VmHWM starts afresh with the new program
+        with open('/proc/self/status') as f:
+            own = next(int(line.split()[1]) * 1024 / 1e6 for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        pass
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6
+    return own, children
+
+
+def stage_result(seconds, files, total_bytes):
+    own, children = peak_rss_mb()
+    return {
+        'seconds': round(seconds, 3),
+        'files': files,
+        'mb': round(total_bytes / 1e6, 3),
+        'files_per_second': round(files / seconds, 3) if seconds else None,
+        'mb_per_second': round(total_bytes / 1e6 / seconds, 3) if seconds else None,
+        'peak_rss_mb': round(own, 1),
+        'peak_child_rss_mb': round(children, 1),
+    }
+
+
+def run_stage(stage, *args):
+    """
+    Runs one stage function in a freshly spawned interpreter and returns what it returns, so the peak memory
+    each stage reports is its own and not that of the stages run before it.
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(stage, args)
+
+
+def profile_stage(corpus_dir, files, total_bytes):
+    started = time.perf_counter()
+    profile = build_droid_profile(corpus_dir)
+    return list(profile), stage_result(time.perf_counter() - started, files, total_bytes)
+
+
+def identify_stage(sample):
+    started = time.perf_counter()
+    for path in sample:
+        identify_file(path)
+    return stage_result(time.perf_counter() - started, len(sample), sum(os.path.getsize(path) for path in sample))
+
+
+def norm_stage(profile, corpus_dir, target_dir, workers, total_bytes):
+    started = time.perf_counter()
+    status = batch_norm(profile, target_dir, working_dir=corpus_dir, workers=workers)
+    result = stage_result(time.perf_counter() - started, status['f_count'], total_bytes)
+    result['failed'] = status_count(status, 'fail')
+    return result
+
+
+def end_to_end_stage(corpus_dir, target_dir, workers, files, total_bytes):
+    started = time.perf_counter()
+    batch_norm(build_droid_profile(corpus_dir), target_dir, working_dir=corpus_dir, workers=workers)
+    return stage_result(time.perf_counter() - started, files, total_bytes)
+
+
+def run_benchmark(corpus_dir, identify_sample=5, workers=1):
+    """
+    Times each stage of the pipeline over a corpus, and a separate end to end run of profiling and normalizing.
+    Every stage runs in its own process, see run_stage.
+
+    Returns:
+    dict: Per-stage results for 'build_droid_profile', 'identify_file' and 'batch_norm', plus 'end_to_end'.
+    """
+    paths = [os.path.join(root, name) for root, dirs, names in os.walk(corpus_dir) for name in names]
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    results = {}
+    target_dir = tempfile.mkdtemp(prefix='normalize-bench-')
+    try:
+        profile, results['build_droid_profile'] = run_stage(profile_stage, corpus_dir, len(paths), total_bytes)
+        results['identify_file'] = run_stage(identify_stage, sorted(paths)[:identify_sample])
+        results['batch_norm'] = run_stage(norm_stage, profile, corpus_dir, os.path.join(target_dir, 'stage'),
+                                          workers, total_bytes)
+        results['end_to_end'] = run_stage(end_to_end_stage, corpus_dir, os.path.join(target_dir, 'end_to_end'),
+                                          workers, len(paths), total_bytes)
+    finally:
+        shutil.rmtree(target_dir, ignore_errors=True)
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    Compares benchmark results against a baseline.
+
+    Returns:
+    list: A message for every stage metric that is more than `tolerance` (a fraction) worse than the baseline.
+    """
+    regressions = []
+    for stage, metrics in baseline.get('stages', {}).items():
+        current = results.get('stages', {}).get(stage)
+        if current is None:
+            continue
+        for metric, higher_is_better in compared_metrics.items():
+            before, after = metrics.get(metric), current.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f'{stage} {metric}: {before} -> {after} ({change:+.0%})')
+    return regressions
+
+
+if __name__ == '__main__':
+    """
+    Benchmark script that generates a synthetic corpus, times build_droid_profile, identify_file and batch_norm
+    over it, and writes the results to a JSON file. With --baseline it exits with status 1 if any stage is slower
+    than the baseline by more than --tolerance.
+
+    Usage:
+    python normalize_bench.py --output bench.json
+    python normalize_bench.py --mix video=4,audio=8,text=200,eps=50,odt=50 --workers 4 --baseline baseline.json
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus-dir', help='Use or create the corpus here instead of a temporary directory')
+    parser.add_argument('--mix', help='Files of each kind, e.g. video=2,audio=4,text=20,eps=10,odt=10')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the generated corpus')
+    parser.add_argument('--media-seconds', type=int, default=5, help='Length of generated video and audio')
+    parser.add_argument('--identify-sample', type=int, default=5, help='Files identified one at a time with identify_file')
+    parser.add_argument('--workers', type=int, default=1, help='Workers passed to batch_norm')
+    parser.add_argument('--output', default='bench_results.json', help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='A previous results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline, as a fraction')
+    args = parser.parse_args()
+
+    mix = default_mix
+    if args.mix:
+        mix = {kind: int(count) for kind, count in (pair.split('=') for pair in args.mix.split(','))}
+
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix='normalize-corpus-')
+    try:
+        if not os.path.isdir(corpus_dir) or not os.listdir(corpus_dir):
+            generate_corpus(corpus_dir, mix, seed=args.seed, media_seconds=args.media_seconds)
+        stages = run_benchmark(corpus_dir, identify_sample=args.identify_sample, workers=args.workers)
+    finally:
+        if not args.corpus_dir:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'cpus': os.cpu_count(),
+        'config': {'mix': mix, 'seed': args.seed, 'media_seconds': args.media_seconds, 'workers': args.workers},
+        'stages': stages,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(stages, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print('Warning: the baseline was recorded with a different configuration', file=sys.stderr)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
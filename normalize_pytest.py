@@ -1,16 +1,38 @@
+import asyncio
+import io
 import os
+import re
 import tempfile
 import shutil
+import sys
 import subprocess
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import json
+import tarfile
+import zipfile
+import urllib.request
 
 import pytest
 
+from signature_matcher import SignatureMatcher, compile_hex
+from normalize_bench import generate_corpus, compare_results, run_stage, peak_rss_mb
+
+import normalize
 from normalize import norm_to_mp4, norm_to_mp3,\
                       norm_to_svg, norm_file,\
                       norm_to_doc, build_droid_profile,\
                       identify_file, batch_norm,\
                       construct_output_path, no_norm,\
-                      replace_suffix, norm_to_pdf
+                      replace_suffix, norm_to_pdf,\
+                      resolve_tool_limits, tool_for,\
+                      LibreOfficePool, IdentificationCache,\
+                      identify_files, plan_droid_shards, watch_and_normalize,\
+                      iter_droid_profile_sharded, iter_droid_profile_batches,\
+                      prefetch, mp4_strategy, conversion_notes, RunMetrics, ToolEngine, InkscapePool, CostModel, lpt_order, SQLiteJobQueue, coordinate, run_worker, RunResults,\
+                      FilePlacer, ScratchSpace, placement_strategies
 
 @pytest.fixture(scope='class')
 def setup_and_teardown(request):
@@ -78,6 +100,31 @@ class TestFileNormalize:
                 assert key in matching_dict, f"Key '{key}' not found in dictionary with FILE_PATH {matching_dict['FILE_PATH']}"
                 assert matching_dict[key] == value, f"Value for key '{key}' does not match expected value for FILE_PATH {matching_dict['FILE_PATH']}"
         
+    def test_droid_profile_cached(self, tmp_path):
+        with IdentificationCache(str(tmp_path / "ids.sqlite")) as cache:
+            first = build_droid_profile(self.temp_dir, cache=cache)
+            assert len(cache) == len(first)
+            second = build_droid_profile(self.temp_dir, cache=cache)
+        by_path = {row['FILE_PATH']: row['PUID'] for row in self.profile if row['TYPE'] == 'File'}
+        assert {row['FILE_PATH']: row['PUID'] for row in first} == by_path
+        assert {row['FILE_PATH']: row['PUID'] for row in second} == by_path
+
+    def test_signature_matcher_parity(self):
+        matcher = SignatureMatcher(normalize.droid_sign_file)
+        for path in [self.temp_file, self.eps_file, self.wav_file, self.video_file, self.odt_file]:
+            droid_puid = [x for x in self.profile if x['FILE_PATH'] == path][0]['PUID']
+            result = matcher.identify(path)
+            # the matcher may defer to DROID, but must never disagree with it
+            assert result is None or result['PUID'] == droid_puid
+            assert identify_file(path, matcher=matcher)['PUID'] == droid_puid
+
+    def test_identify_files(self):
+        paths = [self.temp_file, self.eps_file, self.wav_file, self.video_file, self.odt_file]
+        results = dict(identify_files(paths, batch_size=2))
+        assert sorted(results) == sorted(paths)
+        for path in paths:
+            assert results[path]['PUID'] == identify_file(path)['PUID']
+
     def test_no_norm_with_output_dir(self):
         output_file_path = no_norm(self.temp_file, output_dir = self.output_dir)
         assert os.path.isfile(output_file_path)
@@ -132,6 +179,21 @@ class TestFileNormalize:
         assert metadata['PUID'] == 'fmt/199'
         os.remove(mp4_path)
 
+    def test_norm_to_mp4_remux(self, tmp_path):
+        h264_file = str(tmp_path / 'test_h264.mkv')
+        subprocess.run(['ffmpeg', '-y', '-f', 'lavfi', '-i', 'testsrc=size=320x240:rate=30', '-f', 'lavfi',
+                        '-i', 'sine=frequency=1000', '-t', '2', '-c:v', 'libx264', '-c:a', 'aac', h264_file], check=True)
+        with conversion_notes() as notes:
+            mp4_path = norm_to_mp4(h264_file)
+        assert notes['mp4_strategy'] == 'remux'
+        assert notes['exit_code'] == 0 and notes['cpu_seconds'] > 0
+        assert identify_file(mp4_path)['PUID'] == 'fmt/199'
+
+        with conversion_notes() as notes:
+            mp4_path = norm_to_mp4(self.video_file, output_dir=str(tmp_path))
+        assert notes['mp4_strategy'] == 'transcode'
+        assert os.path.exists(mp4_path)
+
     def test_norm_to_mp3(self):
         mp3_path = norm_to_mp3(self.wav_file)
         assert os.path.exists(mp3_path)
@@ -160,6 +222,16 @@ class TestFileNormalize:
         # Remove the output file
         os.remove(pdf_path)
 
+    def test_norm_to_doc_pool(self):
+        with LibreOfficePool(size=1, batch_size=4, max_conversions=1) as pool:
+            doc_path = norm_to_doc(self.odt_file, pool=pool)
+            assert os.path.exists(doc_path)
+            os.remove(doc_path)
+            # the instance was recycled after one conversion and still works
+            pdf_path = norm_to_pdf(self.odt_file, pool=pool)
+            assert os.path.exists(pdf_path)
+            os.remove(pdf_path)
+
     def test_norm_to_svg(self):
         svg_path = norm_to_svg(self.eps_file)
         assert os.path.exists(svg_path)
@@ -201,6 +273,29 @@ class TestFileNormalize:
         plain_text = norm_file(unknown_file, metadata)
         assert os.path.exists(plain_text)
     
+    def test_norm_file_audio_memory(self, tmp_path):
+        # 5 minutes of 24-bit/96 kHz stereo is about 170 MB of PCM
+        large_wav = str(tmp_path / 'large_audio.wav')
+        subprocess.run(['ffmpeg', '-y', '-f', 'lavfi', '-i', 'sine=frequency=440:duration=300:sample_rate=96000',
+                        '-ac', '2', '-c:a', 'pcm_s24le', large_wav], check=True)
+        wav_size = os.path.getsize(large_wav)
+
+        with conversion_notes() as notes:
+            mp3_path = norm_file(large_wav, {'MIME_TYPE': 'audio/x-wav'})
+
+        # ffmpeg's own peak, from wait4: it streams the audio instead of holding the decoded file
+        assert notes['max_rss_kb'] * 1024 < wav_size / 4
+        probe = json.loads(subprocess.run(['ffprobe', '-v', 'error', '-show_entries',
+                                           'stream=codec_name,channels:format=duration', '-of', 'json', mp3_path],
+                                          check=True, capture_output=True, text=True).stdout)
+        assert [(stream['codec_name'], stream['channels']) for stream in probe['streams']] == [('mp3', 2)]
+        assert abs(float(probe['format']['duration']) - 300) < 1
+
+        # norm_file and batch_norm produce the same derivative
+        (tmp_path / 'batch').mkdir()
+        batch_path = norm_to_mp3(large_wav, output_dir=str(tmp_path / 'batch'))
+        assert os.path.getsize(batch_path) == os.path.getsize(mp3_path)
+
     def test_batch_norm(self, tmp_path):
         target_dir = tmp_path / "target"
         target_dir.mkdir()
@@ -216,4 +311,1218 @@ class TestFileNormalize:
         for file in expected_files:
             assert os.path.exists(file), f"File {file} not found in target directory"
 
+    def test_batch_norm_parallel(self, tmp_path):
+        sequential_dir = tmp_path / "sequential"
+        parallel_dir = tmp_path / "parallel"
+        sequential = batch_norm(self.profile, str(sequential_dir), working_dir=self.temp_dir)
+        parallel = batch_norm(self.profile, str(parallel_dir), working_dir=self.temp_dir, workers=4)
+
+        # CPU time is measured, so it differs from run to run
+        parallel.pop('cpu_seconds', None)
+        sequential.pop('cpu_seconds', None)
+        assert parallel == sequential
+        assert sorted(os.listdir(parallel_dir)) == sorted(os.listdir(sequential_dir))
+
+
+def copy_only_profile(working_dir, count):
+    profile = [{'TYPE': 'Folder', 'MIME_TYPE': '', 'FILE_PATH': str(working_dir)}]
+    for i in range(count):
+        path = working_dir / f'file{i}.txt'
+        path.write_text(f'data {i}')
+        mime_type = 'text/plain' if i % 2 else 'application/x-unknown'
+        profile.append({'TYPE': 'File', 'MIME_TYPE': mime_type, 'FILE_PATH': str(path)})
+    return profile
+
+
+def test_batch_norm_parallel_matches_sequential(tmp_path):
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = copy_only_profile(working_dir, 20)
+
+    sequential = batch_norm(profile, str(tmp_path / "sequential"), working_dir=str(working_dir))
+    parallel = batch_norm(profile, str(tmp_path / "parallel"), working_dir=str(working_dir), workers=4)
+
+    assert parallel == sequential
+    assert sequential['f_count'] == 20
+    assert sequential['unnormalized'] == {'text/plain': 10}
+    assert sequential['undefined'] == {'application/x-unknown': 10}
+    assert sorted(os.listdir(tmp_path / "parallel")) == sorted(os.listdir(tmp_path / "sequential"))
+
+
+def test_resolve_tool_limits():
+    assert tool_for(norm_to_mp4) == 'ffmpeg'
+    assert tool_for(norm_to_doc) == 'libreoffice'
+    assert tool_for(no_norm) == 'copy'
+    assert tool_for(None) == 'copy'
+
+    limits = resolve_tool_limits(8, {'ffmpeg': 2})
+    assert limits == {'ffmpeg': 2, 'libreoffice': 1, 'inkscape': 8, 'copy': 8}
+    with pytest.raises(ValueError):
+        resolve_tool_limits(2, {'gimp': 1})
+
+
+def test_identification_cache(tmp_path, monkeypatch):
+    data = tmp_path / "data.txt"
+    data.write_text('test data')
+    row = {'FILE_PATH': str(data), 'NAME': 'data.txt', 'MIME_TYPE': 'text/plain', 'PUID': 'x-fmt/111'}
+    cache_path = str(tmp_path / "ids.sqlite")
+
+    with IdentificationCache(cache_path) as cache:
+        assert cache.get(str(data)) is None
+        cache.put(str(data), row)
+        assert cache.get(str(data)) == row
+        assert cache.get(str(data), kind='identify') is None
+
+    # entries survive a reopen but not a change to the file
+    with IdentificationCache(cache_path) as cache:
+        assert cache.get(str(data)) == row
+        data.write_text('changed data')
+        assert cache.get(str(data)) is None
+
+    # a different DROID build invalidates everything
+    with IdentificationCache(cache_path) as cache:
+        cache.put(str(data), row)
+    monkeypatch.setattr(normalize, 'droid_cmd', 'java -jar droid-command-line-6.7.0.jar')
+    with IdentificationCache(cache_path) as cache:
+        assert len(cache) == 0
+
+
+def test_identification_cache_hash_and_eviction(tmp_path, monkeypatch):
+    first = tmp_path / "first.txt"
+    copy_of_first = tmp_path / "copy.txt"
+    first.write_text('same bytes')
+    copy_of_first.write_text('same bytes')
+    row = {'FILE_PATH': str(first), 'NAME': 'first.txt', 'MIME_TYPE': 'text/plain'}
+
+    with IdentificationCache(str(tmp_path / "ids.sqlite"), max_entries=1, verify_hash=True) as cache:
+        cache.put(str(first), row)
+        # a byte-identical file reuses the entry under its own path
+        reused = cache.get(str(copy_of_first))
+        assert reused['FILE_PATH'] == str(copy_of_first)
+        assert reused['MIME_TYPE'] == 'text/plain'
+        cache.commit()
+        assert len(cache) == 1
+
+        # each file is hashed once per version, across the lookup and the put that follows it
+        hashed = []
+        file_sha256 = normalize.file_sha256
+        monkeypatch.setattr(normalize, 'file_sha256', lambda path: hashed.append(path) or file_sha256(path))
+        assert cache.get(str(copy_of_first)) == reused
+        assert hashed == []
+        os.utime(copy_of_first, ns=(0, 0))
+        assert cache.get(str(copy_of_first))['MIME_TYPE'] == 'text/plain'
+        assert hashed == [str(copy_of_first)]
+
+
+def test_batch_norm_resume(tmp_path):
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    target_dir = tmp_path / "target"
+    profile = copy_only_profile(working_dir, 6)
+
+    first = batch_norm(profile, str(target_dir), working_dir=str(working_dir), resume=True)
+    assert first['skipped'] == 0
+    assert os.path.exists(target_dir / normalize.journal_name)
+
+    second = batch_norm(profile, str(target_dir), working_dir=str(working_dir), resume=True)
+    assert second['skipped'] == 6
+    assert second['success_copy'] == first['success_copy']
+
+    # a changed source and a missing output are redone, everything else is skipped
+    (working_dir / 'file0.txt').write_text('changed')
+    os.remove(target_dir / 'file1.txt')
+    third = batch_norm(profile, str(target_dir), working_dir=str(working_dir), resume=True)
+    assert third['skipped'] == 4
+    assert (target_dir / 'file0.txt').read_text() == 'changed'
+    assert (target_dir / 'file1.txt').exists()
+
+
+signature_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<FFSignatureFile xmlns="http://www.nationalarchives.gov.uk/pronom/SignatureFile" Version="1">
+  <InternalSignatureCollection>
+    <InternalSignature ID="1"><ByteSequence Reference="BOFoffset">
+      <SubSequence Position="1" SubSeqMinOffset="0" SubSeqMaxOffset="0"><Sequence>25215053</Sequence>
+        <RightFragment Position="1" MinOffset="0" MaxOffset="4">(2D|20)41646F6265</RightFragment>
+      </SubSequence></ByteSequence></InternalSignature>
+    <InternalSignature ID="2"><ByteSequence Reference="BOFoffset">
+      <SubSequence Position="1" SubSeqMinOffset="0" SubSeqMaxOffset="0"><Sequence>25215053</Sequence></SubSequence>
+    </ByteSequence></InternalSignature>
+    <InternalSignature ID="3"><ByteSequence Reference="EOFoffset">
+      <SubSequence Position="1" SubSeqMinOffset="0" SubSeqMaxOffset="2"><Sequence>454E44[00:1F]</Sequence></SubSequence>
+    </ByteSequence></InternalSignature>
+    <InternalSignature ID="4"><ByteSequence>
+      <SubSequence Position="1"><Sequence>4E45454444</Sequence></SubSequence>
+    </ByteSequence></InternalSignature>
+  </InternalSignatureCollection>
+  <FileFormatCollection>
+    <FileFormat ID="10" Name="Adobe PostScript" PUID="fmt/124" MIMEType="application/postscript">
+      <InternalSignatureID>1</InternalSignatureID><HasPriorityOverFileFormatID>11</HasPriorityOverFileFormatID></FileFormat>
+    <FileFormat ID="11" Name="PostScript" PUID="x-fmt/91" MIMEType="application/postscript"><InternalSignatureID>2</InternalSignatureID></FileFormat>
+    <FileFormat ID="12" Name="Trailer" PUID="x-fmt/999" MIMEType="application/x-trailer"><InternalSignatureID>3</InternalSignatureID></FileFormat>
+    <FileFormat ID="13" Name="Needle" PUID="x-fmt/998" MIMEType="application/x-needle"><InternalSignatureID>4</InternalSignatureID></FileFormat>
+  </FileFormatCollection>
+</FFSignatureFile>
+"""
+
+
+def test_signature_matcher(tmp_path):
+    signature_file = tmp_path / "signatures.xml"
+    signature_file.write_text(signature_xml)
+    files = {
+        'adobe.eps': b'%!PS-Adobe-3.0',
+        'plain.ps': b'%!PS plain',
+        'trailer.bin': b'xxxxEND\x01\n',
+        'unknown.bin': b'zzz',
+        'empty.bin': b'',
+        # two formats without a priority between them: DROID has to decide
+        'both.ps': b'%!PS' + b'x' * 100 + b'NEEDD' + b'y' * 100,
+    }
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+
+    matcher = SignatureMatcher(str(signature_file))
+    puids = {name: (matcher.identify(str(tmp_path / name)) or {}).get('PUID') for name in files}
+    assert puids == {'adobe.eps': 'fmt/124', 'plain.ps': 'x-fmt/91', 'trailer.bin': 'x-fmt/999',
+                     'unknown.bin': None, 'empty.bin': None, 'both.ps': None}
+    assert matcher.identify(str(tmp_path / 'adobe.eps'))['MIME_TYPE'] == 'application/postscript'
+
+    # with a small window the variable signature cannot be checked, but it has no priority over the winner
+    windowed = SignatureMatcher(str(signature_file), window=20)
+    assert windowed.identify(str(tmp_path / 'both.ps'))['PUID'] == 'x-fmt/91'
+
+    # a stream's header alone settles beginning-anchored signatures, but not trailers unless it is all there
+    assert matcher.identify_header(files['adobe.eps'], 1000000)['PUID'] == 'fmt/124'
+    assert matcher.identify_header(files['trailer.bin'], len(files['trailer.bin']))['PUID'] == 'x-fmt/999'
+    assert matcher.identify_header(files['trailer.bin'], 1000000) is None
+
+
+def test_compile_hex():
+    regex, width = compile_hex("4D5A{2-4}[!00:1F]??(0D|0A0B)'ab'")
+    assert width == 12
+    pattern = re.compile(regex, re.DOTALL)
+    assert pattern.fullmatch(b'MZ\x00\x00 \xff\rab')
+    assert pattern.fullmatch(b'MZ\x00\x00\x00\x00 \xff\n\x0bab')
+    assert not pattern.fullmatch(b'MZ\x00\x00\x01\xff\rab')
+    assert compile_hex('00{4-*}')[1] is None
+    with pytest.raises(ValueError):
+        compile_hex('4D5A)')
+
+
+fake_droid = """
+import csv, os, sys
+link_dir = sys.argv[sys.argv.index('-Nr') + 1]
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runs'), 'a') as f:
+    f.write(link_dir + '\\n')
+writer = csv.writer(sys.stdout)
+writer.writerow(['FILE_PATH', 'PUID', 'MIME_TYPE'])
+for name in sorted(os.listdir(link_dir)):
+    if not name.endswith('.skip'):
+        writer.writerow([os.path.join(link_dir, name), 'x-fmt/111', 'text/plain'])
+"""
+
+
+def test_identify_files_batches(tmp_path, monkeypatch):
+    script = tmp_path / "fake_droid.py"
+    script.write_text(fake_droid)
+    monkeypatch.setattr(normalize, 'droid_cmd', f'{sys.executable} {script}')
+    paths = []
+    for i in range(5):
+        path = tmp_path / f'file {i}.txt'
+        path.write_text(str(i))
+        paths.append(str(path))
+    unreported = tmp_path / 'odd.skip'
+    unreported.write_text('')
+    paths.append(str(unreported))
+
+    with IdentificationCache(str(tmp_path / "ids.sqlite")) as cache:
+        results = dict(identify_files(paths, batch_size=2, cache=cache))
+        assert len((tmp_path / 'runs').read_text().split()) == 3
+        assert results[str(unreported)] is None
+        for path in paths[:-1]:
+            assert results[path]['FILE_PATH'] == path
+            assert results[path]['PUID'] == 'x-fmt/111'
+
+        # everything DROID reported is now cached
+        results = dict(identify_files(paths[:-1], batch_size=2, cache=cache))
+        assert len((tmp_path / 'runs').read_text().split()) == 3
+        assert results[paths[0]]['PUID'] == 'x-fmt/111'
+
+    # a path listed twice is identified once but answered for both times it was asked
+    results = list(identify_files([paths[1], paths[2], paths[1], str(unreported), str(unreported)], batch_size=10))
+    assert len((tmp_path / 'runs').read_text().split()) == 4
+    assert [path for path, metadata in results] == [paths[1], paths[1], paths[2], str(unreported), str(unreported)]
+    assert [metadata['PUID'] for path, metadata in results[:3]] == ['x-fmt/111'] * 3
+    assert results[3][1] is None and results[4][1] is None
+
+
+fake_droid_profile = """
+import csv, os, sys
+args = sys.argv[1:]
+profile = args[args.index('-p') + 1]
+if '-e' in args:
+    with open(profile) as f, open(args[args.index('-e') + 1], 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(['TYPE', 'FILE_PATH', 'MIME_TYPE'])
+        for path in f.read().splitlines():
+            writer.writerow(['File', path, 'text/plain'])
+else:
+    dirs = args[args.index('-a') + 1:args.index('-Ns')]
+    with open(profile, 'w') as f:
+        for d in dirs:
+            if os.path.isfile(d):
+                f.write(d + '\\n')
+                continue
+            for name in sorted(os.listdir(d)):
+                if os.path.isfile(os.path.join(d, name)):
+                    f.write(os.path.join(d, name) + '\\n')
+"""
+
+
+def make_tree(root, layout):
+    paths = []
+    for subdir, count in layout.items():
+        (root / subdir).mkdir(parents=True, exist_ok=True)
+        for i in range(count):
+            path = root / subdir / f'file{i}.txt'
+            path.write_text('x' * (i + 1))
+            paths.append(str(path))
+    return paths
+
+
+def test_plan_droid_shards(tmp_path):
+    make_tree(tmp_path, {'a': 6, 'b': 3, 'c': 3, 'c/d': 2})
+    shards = plan_droid_shards(str(tmp_path), 2)
+    counts = sorted(sum(len([n for n in os.listdir(d) if os.path.isfile(os.path.join(d, n))]) for d in dirs)
+                    for dirs in shards)
+    assert counts == [6, 8]
+    assert sorted(d for dirs in shards for d in dirs) == sorted(str(p) for p in
+                                                                [tmp_path, tmp_path / 'a', tmp_path / 'b', tmp_path / 'c', tmp_path / 'c/d'])
+    assert len(plan_droid_shards(str(tmp_path), 2, balance='bytes')) == 2
+    with pytest.raises(ValueError):
+        plan_droid_shards(str(tmp_path), 2, balance='lines')
+
+
+def test_iter_droid_profile_sharded(tmp_path, monkeypatch):
+    script = tmp_path / "fake_droid.py"
+    script.write_text(fake_droid_profile)
+    monkeypatch.setattr(normalize, 'droid_cmd', f'{sys.executable} {script}')
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(scratch))
+    tree = tmp_path / "tree"
+    paths = make_tree(tree, {'a': 4, 'b': 2, 'b/c': 5, 'd': 1})
+
+    rows = iter_droid_profile_sharded(str(tree), shards=3)
+    assert not isinstance(rows, list)
+    assert sorted(row['FILE_PATH'] for row in rows) == sorted(paths)
+    # every shard's temporary profile was removed
+    assert os.listdir(scratch) == []
+
+
+def test_prefetch():
+    assert list(prefetch(iter(range(100)), 3)) == list(range(100))
+
+    def failing():
+        yield 1
+        raise RuntimeError('DROID failed')
+    rows = prefetch(failing(), 3)
+    assert next(rows) == 1
+    with pytest.raises(RuntimeError):
+        next(rows)
+
+
+def test_batch_norm_streaming(tmp_path):
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = copy_only_profile(working_dir, 30)
+
+    batch = batch_norm(profile, str(tmp_path / "batch"), working_dir=str(working_dir), workers=4)
+    streamed = batch_norm(iter(profile), str(tmp_path / "streamed"), working_dir=str(working_dir), workers=4,
+                          stream_queue_size=4)
+    assert streamed == batch
+    streamed = batch_norm(iter(profile), str(tmp_path / "sequential"), working_dir=str(working_dir),
+                          stream_queue_size=4)
+    assert streamed == batch
+
+
+def test_iter_droid_profile_batches(tmp_path, monkeypatch):
+    script = tmp_path / "fake_droid.py"
+    script.write_text(fake_droid_profile)
+    monkeypatch.setattr(normalize, 'droid_cmd', f'{sys.executable} {script}')
+    tree = tmp_path / "tree"
+    paths = make_tree(tree, {'a': 4, 'b': 2, 'b/c': 5})
+
+    with IdentificationCache(str(tmp_path / "ids.sqlite")) as cache:
+        rows = list(iter_droid_profile_batches(str(tree), batch_size=3, processes=2, cache=cache))
+        assert sorted(row['FILE_PATH'] for row in rows) == sorted(paths)
+        assert len(cache) == len(paths)
+        # a second pass is served from the cache without running DROID
+        monkeypatch.setattr(normalize, 'droid_cmd', 'false')
+        rows = list(iter_droid_profile_batches(str(tree), batch_size=3, processes=2, cache=cache))
+        assert sorted(row['FILE_PATH'] for row in rows) == sorted(paths)
+
+def test_iter_droid_profile_batches_mostly_cached(tmp_path, monkeypatch):
+    script = tmp_path / "fake_droid.py"
+    script.write_text(fake_droid_profile)
+    monkeypatch.setattr(normalize, 'droid_cmd', f'{sys.executable} {script}')
+    tree = tmp_path / "tree"
+    paths = make_tree(tree, {'a': 4, 'b': 4, 'c': 4, 'd': 4})
+    walk = os.walk
+    walked = []
+
+    def tracking_walk(top):
+        yield from walk(top)
+        walked.append(top)
+
+    with IdentificationCache(str(tmp_path / "ids.sqlite")) as cache:
+        for path in paths[:-1]:
+            cache.put(path, {'TYPE': 'File', 'FILE_PATH': path, 'MIME_TYPE': 'text/plain'})
+        monkeypatch.setattr(normalize.os, 'walk', tracking_walk)
+        rows = iter_droid_profile_batches(str(tree), batch_size=2, processes=1, cache=cache)
+        # cache hits come out as the walk reaches them, in the walk's order
+        first = [next(rows)['FILE_PATH'] for i in range(3)]
+        assert walked == []
+        rest = [row['FILE_PATH'] for row in rows]
+    assert walked == [str(tree)]
+    assert first + rest[:-1] == [path for path in walk_order(tree) if path != paths[-1]]
+    assert rest[-1] == paths[-1]
+
+
+def walk_order(root):
+    return [os.path.join(dirpath, name) for dirpath, dirnames, names in os.walk(root) for name in names]
+
+
+def test_mp4_strategy():
+    h264 = {'codec_type': 'video', 'codec_name': 'h264'}
+    mpeg4 = {'codec_type': 'video', 'codec_name': 'mpeg4'}
+    aac = {'codec_type': 'audio', 'codec_name': 'aac'}
+    pcm = {'codec_type': 'audio', 'codec_name': 'pcm_s16le'}
+    assert mp4_strategy([h264, aac]) == 'remux'
+    assert mp4_strategy([h264]) == 'remux'
+    assert mp4_strategy([h264, pcm]) == 'copy_video'
+    assert mp4_strategy([mpeg4, aac]) == 'copy_audio'
+    assert mp4_strategy([mpeg4, pcm]) == 'transcode'
+    assert mp4_strategy([mpeg4]) == 'transcode'
+    assert mp4_strategy([aac]) == 'transcode'
+    assert mp4_strategy(None) == 'transcode'
+
+
+def test_file_placer(tmp_path):
+    src = tmp_path / "source.txt"
+    src.write_text('test data')
+
+    placer = FilePlacer('hardlink')
+    assert placer.place(str(src), str(tmp_path / "linked.txt")) == 'hardlink'
+    assert os.path.samefile(src, tmp_path / "linked.txt")
+    # placing again replaces the existing file
+    assert placer.place(str(src), str(tmp_path / "linked.txt")) == 'hardlink'
+    assert placer.bytes_linked == 2 * len('test data')
+
+    placer = FilePlacer('auto')
+    method = placer.place(str(src), str(tmp_path / "placed.txt"))
+    assert method in ('reflink', 'copy_file_range', 'copy')
+    assert (tmp_path / "placed.txt").read_text() == 'test data'
+    assert not os.path.samefile(src, tmp_path / "placed.txt")
+    assert placer.bytes_linked + placer.bytes_copied == len('test data')
+
+    with pytest.raises(ValueError):
+        FilePlacer('symlink')
+
+
+@pytest.mark.parametrize('strategy', ['auto', 'copy'])
+def test_file_placer_replaces_hardlinked_target(tmp_path, strategy):
+    src = tmp_path / "source.txt"
+    src.write_text('test data')
+    dst = tmp_path / "placed.txt"
+    FilePlacer('hardlink').place(str(src), str(dst))
+
+    # a later run with another strategy places over the earlier run's hard link
+    assert FilePlacer(strategy).place(str(src), str(dst)) in placement_strategies[strategy]
+    assert src.read_text() == 'test data' and dst.read_text() == 'test data'
+    assert not os.path.samefile(src, dst)
+    with pytest.raises(OSError):
+        FilePlacer(strategy).place(str(src), str(src))
+    assert src.read_text() == 'test data'
+
+
+def test_batch_norm_placement(tmp_path):
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = copy_only_profile(working_dir, 10)
+    total = sum(os.path.getsize(row['FILE_PATH']) for row in profile if row['TYPE'] == 'File')
+
+    copied = batch_norm(profile, str(tmp_path / "copied"), working_dir=str(working_dir))
+    assert copied['bytes_copied'] == total
+    assert copied['placement'] == {'copy': 10}
+
+    linked = batch_norm(profile, str(tmp_path / "linked"), working_dir=str(working_dir), placement='hardlink')
+    assert linked['bytes_linked'] == total
+    assert linked['bytes_copied'] == 0
+    assert linked['placement'] == {'hardlink': 10}
+    assert linked['success_copy'] == copied['success_copy']
+
+
+fake_ffmpeg = """#!/bin/sh
+# copies the input to the last argument, recording every run
+echo "$2" >> "$(dirname "$0")/runs"
+for last; do :; done
+cp "$2" "$last"
+"""
+
+
+def test_norm_file_reencodes_mp3_in_place(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    # like ffmpeg, refuses to write its output over its input
+    (bin_dir / "ffmpeg").write_text("""#!/bin/sh
+for last; do :; done
+[ "$2" -ef "$last" ] && exit 1
+{ echo encoded; cat "$2"; } > "$last"
+""")
+    (bin_dir / "ffmpeg").chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    audio_dir = tmp_path / "audio"
+    audio_dir.mkdir()
+    (audio_dir / "song.mp3").write_bytes(b'ID3 old encoding')
+
+    assert norm_file(str(audio_dir / "song.mp3"), {'MIME_TYPE': 'audio/mpeg'}) == str(audio_dir / "song.mp3")
+    assert (audio_dir / "song.mp3").read_bytes() == b'encoded\nID3 old encoding'
+    assert os.listdir(audio_dir) == ['song.mp3']
+
+
+def test_batch_norm_dedup(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "ffmpeg").write_text(fake_ffmpeg)
+    (bin_dir / "ffmpeg").chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    working_dir = tmp_path / "input"
+    profile = []
+    for i in range(4):
+        folder = working_dir / f'project{i}'
+        folder.mkdir(parents=True)
+        (folder / 'interview.wav').write_bytes(b'RIFF same recording')
+        profile.append({'TYPE': 'File', 'MIME_TYPE': 'audio/x-wav', 'FILE_PATH': str(folder / 'interview.wav')})
+    (working_dir / 'other.wav').write_bytes(b'RIFF another recording')
+    profile.append({'TYPE': 'File', 'MIME_TYPE': 'audio/x-wav', 'FILE_PATH': str(working_dir / 'other.wav')})
+    store = tmp_path / "store"
+
+    status = batch_norm(profile, str(tmp_path / "first"), working_dir=str(working_dir), workers=4, dedup_store=str(store))
+    assert len(status['success']) == 5
+    assert status['dedup'] == {'converted': 2, 'reused': 3}
+    assert len((bin_dir / 'runs').read_text().split()) == 2
+    for i in range(4):
+        assert (tmp_path / "first" / f'project{i}' / 'interview.mp3').read_bytes() == b'RIFF same recording'
+
+    # a later run reuses the stored derivatives without converting anything
+    status = batch_norm(profile, str(tmp_path / "second"), working_dir=str(working_dir), dedup_store=str(store))
+    assert status['dedup'] == {'reused': 5}
+    assert len((bin_dir / 'runs').read_text().split()) == 2
+    assert (tmp_path / "second" / 'other.mp3').read_bytes() == b'RIFF another recording'
+
+
+def test_dedup_store_survives_placement_over_hardlinked_targets(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "ffmpeg").write_text(fake_ffmpeg)
+    (bin_dir / "ffmpeg").chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    (working_dir / 'interview.wav').write_bytes(b'RIFF recording')
+    profile = [{'TYPE': 'File', 'MIME_TYPE': 'audio/x-wav', 'FILE_PATH': str(working_dir / 'interview.wav')}]
+    store = tmp_path / "store"
+    target = tmp_path / "output"
+
+    batch_norm(profile, str(target), working_dir=str(working_dir), dedup_store=str(store), placement='hardlink')
+    [stored] = [path for path in store.rglob('*.mp3')]
+    assert os.path.samefile(stored, target / 'interview.mp3')
+
+    # placing the reused derivative over the earlier run's hard link must not truncate the stored object
+    status = batch_norm(profile, str(target), working_dir=str(working_dir), dedup_store=str(store), placement='auto')
+    assert status['dedup'] == {'reused': 1}
+    assert stored.read_bytes() == b'RIFF recording'
+    assert (target / 'interview.mp3').read_bytes() == b'RIFF recording'
+    batch_norm(profile, str(tmp_path / "later"), working_dir=str(working_dir), dedup_store=str(store))
+    assert (tmp_path / "later" / 'interview.mp3').read_bytes() == b'RIFF recording'
+
+
+def test_generate_corpus_is_reproducible(tmp_path):
+    mix = {'text': 5, 'eps': 3, 'odt': 2}
+    first = generate_corpus(str(tmp_path / 'a'), mix, seed=7)
+    second = generate_corpus(str(tmp_path / 'b'), mix, seed=7)
+    assert len(first) == 10
+    for a, b in zip(first, second):
+        assert os.path.relpath(a, tmp_path / 'a') == os.path.relpath(b, tmp_path / 'b')
+        with open(a, 'rb') as fa, open(b, 'rb') as fb:
+            assert fa.read() == fb.read()
+    other = generate_corpus(str(tmp_path / 'c'), mix, seed=8)
+    assert [open(path).read() for path in other] != [open(path).read() for path in first]
+    with pytest.raises(ValueError):
+        generate_corpus(str(tmp_path / 'd'), {'spreadsheet': 1})
+
+
+def test_compare_results():
+    baseline = {'stages': {'batch_norm': {'seconds': 10.0, 'files_per_second': 5.0, 'mb_per_second': 2.0}}}
+    faster = {'stages': {'batch_norm': {'seconds': 8.0, 'files_per_second': 6.25, 'mb_per_second': 2.5}}}
+    slower = {'stages': {'batch_norm': {'seconds': 13.0, 'files_per_second': 3.8, 'mb_per_second': 1.5}}}
+    assert compare_results(faster, baseline) == []
+    assert len(compare_results(slower, baseline)) == 3
+    assert compare_results(slower, baseline, tolerance=0.5) == []
+    assert compare_results({'stages': {}}, baseline) == []
+
+
+def test_run_stage_measures_its_own_peak():
+    ballast = bytearray(300 * 1024 * 1024)
+    ballast[::4096] = b'x' * len(ballast[::4096])
+    own, children = run_stage(peak_rss_mb)
+    assert own < 200
+    assert peak_rss_mb()[0] > 300
+
+
+def test_batch_norm_event_log_and_metrics(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "ffmpeg").write_text(fake_ffmpeg)
+    (bin_dir / "ffmpeg").chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    (working_dir / 'interview.wav').write_bytes(b'RIFF recording')
+    (working_dir / 'notes.txt').write_text('plain text')
+    profile = [{'TYPE': 'File', 'MIME_TYPE': 'audio/x-wav', 'PUID': 'fmt/141', 'FILE_PATH': str(working_dir / 'interview.wav')},
+               {'TYPE': 'File', 'MIME_TYPE': 'text/plain', 'PUID': 'x-fmt/111', 'FILE_PATH': str(working_dir / 'notes.txt')}]
+    event_log = tmp_path / "events.jsonl"
+    metrics_file = tmp_path / "normalize.prom"
+
+    with RunMetrics(path=str(metrics_file), port=0) as metrics:
+        status = batch_norm(profile, str(tmp_path / "output"), working_dir=str(working_dir), workers=2,
+                            event_log=str(event_log), metrics=metrics)
+        with urllib.request.urlopen(f'http://127.0.0.1:{metrics.port}/metrics') as response:
+            served = response.read().decode()
+    assert 'exit_code' not in status and 'max_rss_kb' not in status
+
+    events = {json.loads(line)['function']: json.loads(line) for line in event_log.read_text().splitlines()}
+    audio = events['norm_to_mp3']
+    assert audio['puid'] == 'fmt/141' and audio['tool'] == 'ffmpeg' and audio['outcome'] == 'success'
+    assert audio['size'] == audio['output_size'] == len(b'RIFF recording')
+    assert audio['exit_code'] == 0 and audio['max_rss_kb'] > 0 and audio['cpu_seconds'] >= 0
+    assert audio['wall_seconds'] > 0 and audio['queue_seconds'] >= 0
+    assert events['no_norm']['exit_code'] is None and events['no_norm']['output_size'] == len('plain text')
+
+    written = metrics_file.read_text()
+    assert written == served
+    assert 'normalize_files_total{function="norm_to_mp3",mime="audio/x-wav",outcome="success"} 1' in written
+    assert 'normalize_input_bytes_total{function="no_norm",mime="text/plain"} 10' in written
+    assert re.search(r'^normalize_max_rss_bytes\{function="norm_to_mp3"\} [1-9]', written, re.M)
+
+
+def test_tool_engine(tmp_path):
+    engine = ToolEngine({'ffmpeg': 1})
+    try:
+        result = engine.run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        assert (result.returncode, result.stdout, result.stderr, result.timed_out) == (3, b'out\n', b'err\n', False)
+
+        # the timeout kills the whole process group, including the backgrounded grandchild
+        pid_file = tmp_path / 'pid'
+        started = time.monotonic()
+        result = engine.run(['sh', '-c', f'sleep 30 & echo $! > {pid_file}; wait'], timeout=0.5)
+        assert result.timed_out and result.returncode == -signal.SIGKILL
+        assert time.monotonic() - started < 5
+        grandchild = int(pid_file.read_text())
+        time.sleep(0.2)
+        if os.path.exists(f'/proc/{grandchild}/stat'):
+            with open(f'/proc/{grandchild}/stat') as f:
+                assert f.read().split(') ')[1][0] == 'Z'
+
+        # no more than the tool's limit of processes run at once
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            started = time.monotonic()
+            list(pool.map(lambda i: engine.run(['sleep', '0.2'], tool='ffmpeg'), range(3)))
+            assert time.monotonic() - started >= 0.6
+            started = time.monotonic()
+            list(pool.map(lambda i: engine.run(['sleep', '0.2']), range(3)))
+            assert time.monotonic() - started < 0.6
+
+        # a cancelled run still has its process killed and reaped
+        pid_file = tmp_path / 'cancelled'
+        future = asyncio.run_coroutine_threadsafe(engine.run_async(['sh', '-c', f'echo $$ > {pid_file}; exec sleep 30']),
+                                                  engine._loop)
+        while not pid_file.exists() or not pid_file.read_text().strip():
+            time.sleep(0.05)
+        future.cancel()
+        pid = int(pid_file.read_text())
+        deadline = time.monotonic() + 5
+        while os.path.exists(f'/proc/{pid}'):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        engine.close()
+
+
+def test_norm_to_mp3_timeout(tmp_path, monkeypatch, capsys):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "ffmpeg").write_text("#!/bin/sh\necho stuck >&2\nsleep 30\n")
+    (bin_dir / "ffmpeg").chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setitem(normalize.conversion_timeouts, 'norm_to_mp3', (0.5, 0))
+    wav = tmp_path / 'hang.wav'
+    wav.write_bytes(b'RIFF')
+
+    with conversion_notes() as notes:
+        assert norm_to_mp3(str(wav)) is None
+    assert notes['exit_code'] == -signal.SIGKILL
+    err = capsys.readouterr().err
+    assert 'stuck' in err and 'timed out' in err
+
+
+fake_inkscape = """
+import os, sys, time
+# records each process start, then converts like `inkscape --shell`: copies the source to the export target
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'starts'), 'a') as f:
+    f.write(f'{os.getpid()}\\n')
+sys.stdout.write('Inkscape interactive shell mode.\\n> ')
+sys.stdout.flush()
+for line in sys.stdin:
+    actions = dict(action.strip().split(':', 1) for action in line.split(';') if ':' in action)
+    source = actions.get('file-open', '')
+    if 'crash' in source:
+        sys.exit(1)
+    if 'hang' in source:
+        time.sleep(30)
+    if 'busy' in source:
+        deadline = time.process_time() + 0.3
+        while time.process_time() < deadline:
+            pass
+    with open(source, 'rb') as src, open(actions['export-filename'], 'wb') as dst:
+        dst.write(src.read())
+    sys.stdout.write('> ')
+    sys.stdout.flush()
+"""
+
+
+def test_inkscape_pool(tmp_path, monkeypatch):
+    script = tmp_path / "inkscape"
+    script.write_text(f'#!{sys.executable}\n' + fake_inkscape)
+    script.chmod(0o755)
+    monkeypatch.setattr(normalize, 'inkscape_cmd', str(script))
+    monkeypatch.setitem(normalize.conversion_timeouts, 'norm_to_svg', (1, 0))
+    starts = tmp_path / "starts"
+
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = []
+    for name in ['a', 'b', 'c', 'crash', 'd', 'hang', 'e']:
+        (working_dir / f'{name}.eps').write_text(f'%!PS-Adobe-3.0 EPSF-3.0 {name}')
+        profile.append({'TYPE': 'File', 'MIME_TYPE': 'application/postscript', 'FILE_PATH': str(working_dir / f'{name}.eps')})
+
+    with InkscapePool(size=1, max_conversions=2) as pool:
+        status = batch_norm(profile, str(tmp_path / "output"), working_dir=str(working_dir), inkscape_pool=pool)
+        # the dead and hung instances were replaced, as was each one that reached max_conversions
+        assert len(starts.read_text().split()) == 4
+        assert norm_file(str(working_dir / 'a.eps'), {'MIME_TYPE': 'application/postscript'}, inkscape_pool=pool) \
+            == str(working_dir / 'a.svg')
+    assert sorted(os.path.basename(path) for path in status['fail']) == ['crash.eps', 'hang.eps']
+    assert len(status['success']) == 5
+    assert (tmp_path / "output" / 'e.svg').read_text() == '%!PS-Adobe-3.0 EPSF-3.0 e'
+    with pytest.raises(RuntimeError):
+        pool.convert(str(working_dir / 'a.eps'), str(tmp_path / 'a.svg'))
+
+
+def test_inkscape_pool_notes_usage(tmp_path, monkeypatch):
+    script = tmp_path / "inkscape"
+    script.write_text(f'#!{sys.executable}\n' + fake_inkscape)
+    script.chmod(0o755)
+    monkeypatch.setattr(normalize, 'inkscape_cmd', str(script))
+    for name in ('busy', 'idle', 'crash'):
+        (tmp_path / f'{name}.eps').write_text('%!PS-Adobe-3.0 EPSF-3.0')
+
+    with InkscapePool(size=1) as pool:
+        with conversion_notes() as busy:
+            assert pool.convert(str(tmp_path / 'busy.eps'), str(tmp_path / 'busy.svg'))
+        with conversion_notes() as idle:
+            assert pool.convert(str(tmp_path / 'idle.eps'), str(tmp_path / 'idle.svg'))
+        with conversion_notes() as crashed:
+            assert pool.convert(str(tmp_path / 'crash.eps'), str(tmp_path / 'crash.svg')) is None
+    # each file is charged the CPU time the instance used for it, not the instance's total
+    assert busy['cpu_seconds'] >= 0.25 and idle.get('cpu_seconds', 0) < 0.2
+    assert busy['max_rss_kb'] > 0 and busy['exit_code'] == idle['exit_code'] == 0
+    assert crashed['exit_code'] == 1
+
+
+def test_cost_model(tmp_path):
+    small, large = tmp_path / 'small.wav', tmp_path / 'large.wav'
+    small.write_bytes(b'0' * 1000)
+    large.write_bytes(b'0' * 3000000)
+    row = lambda path, mime='audio/x-wav', puid='fmt/141': {'MIME_TYPE': mime, 'PUID': puid, 'FILE_PATH': str(path)}
+
+    defaults = CostModel(probe_media=False)
+    assert defaults.estimate(row(large)) > defaults.estimate(row(small)) > defaults.estimate(row(small, 'text/plain'))
+
+    history = tmp_path / 'events.jsonl'
+    with open(history, 'w') as f:
+        for size, seconds in [(1e6, 3.0), (2e6, 5.0), (4e6, 9.0)]:
+            f.write(json.dumps({'function': 'norm_to_mp3', 'puid': 'fmt/141', 'mime': 'audio/x-wav', 'outcome': 'success',
+                                'size': size, 'wall_seconds': seconds}) + '\n')
+        f.write(json.dumps({'function': 'norm_to_mp3', 'puid': 'fmt/141', 'outcome': 'fail', 'size': 1, 'wall_seconds': 99}) + '\n')
+        f.write('torn line\n')
+    learned = CostModel([str(history)], probe_media=False)
+    # 1 second per file plus 2 per MB, for this PUID and for other audio converted by the same function
+    assert learned.estimate(row(large)) == pytest.approx(7.0)
+    assert learned.estimate(row(large, puid='fmt/6')) == pytest.approx(7.0)
+    assert learned.estimate(row(small, 'text/plain')) == defaults.estimate(row(small, 'text/plain'))
+
+    jobs = [('ffmpeg', [row(small)]), ('copy', [row(small, 'text/plain')]), ('ffmpeg', [row(large)])]
+    assert lpt_order(jobs, learned) == [2, 0, 1]
+
+
+def test_batch_norm_lpt(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "ffmpeg").write_text(fake_ffmpeg + 'echo "$@" >> "$(dirname "$0")/args"\n')
+    (bin_dir / "ffmpeg").chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = []
+    for name, size in [('short', 10), ('long', 30000000), ('medium', 300000)]:
+        (working_dir / f'{name}.wav').write_bytes(b'0' * size)
+        profile.append({'TYPE': 'File', 'MIME_TYPE': 'audio/x-wav', 'FILE_PATH': str(working_dir / f'{name}.wav')})
+
+    sequential = batch_norm(profile, str(tmp_path / "sequential"), working_dir=str(working_dir))
+    (bin_dir / 'runs').unlink()
+    scheduled = batch_norm(profile, str(tmp_path / "scheduled"), working_dir=str(working_dir), tool_limits={'ffmpeg': 1},
+                           schedule='lpt', cost_model=CostModel(probe_media=False))
+    # the biggest file runs first, yet outcomes are recorded in profile order
+    assert [os.path.basename(path) for path in (bin_dir / 'runs').read_text().split()] == ['long.wav', 'medium.wav', 'short.wav']
+    for status in (sequential, scheduled):
+        status.pop('cpu_seconds', None)
+    assert scheduled == sequential
+    # the lone ffmpeg slot gets every core
+    assert f'-threads {os.cpu_count()}' in (bin_dir / 'args').read_text()
+    assert normalize.ffmpeg_threads is None
+
+    with pytest.raises(ValueError):
+        batch_norm(profile, str(tmp_path / "streamed"), working_dir=str(working_dir), schedule='lpt', stream_queue_size=8)
+
+
+def test_distributed_batch_norm(tmp_path):
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = copy_only_profile(working_dir, 12)
+    expected = batch_norm(profile, str(tmp_path / "local"), working_dir=str(working_dir))
+    queue_path = str(tmp_path / "jobs.sqlite")
+    target_dir = str(tmp_path / "output")
+    dead_worker_leased = threading.Event()
+
+    def droid_rows():
+        for i, row in enumerate(profile):
+            if i == 3:
+                # the first chunk is queued; a worker leases two of its jobs and dies
+                with SQLiteJobQueue(queue_path, lease_seconds=0.5) as dead_queue:
+                    assert [job_id for job_id, item in dead_queue.lease('dead-worker', count=2)] == [1, 2]
+                dead_worker_leased.set()
+            yield row
+
+    def worker(i):
+        with SQLiteJobQueue(queue_path, lease_seconds=0.5) as worker_queue:
+            return run_worker(worker_queue, workers=2, worker_id=f'worker{i}', poll_interval=0.05)
+
+    with SQLiteJobQueue(queue_path, lease_seconds=0.5) as job_queue, ThreadPoolExecutor(max_workers=3) as pool:
+        coordinator = pool.submit(coordinate, droid_rows(), job_queue, target_dir, str(working_dir),
+                                  poll_interval=0.05, chunk_size=2)
+        assert dead_worker_leased.wait(5)
+        workers = [pool.submit(worker, i) for i in range(2)]
+        status = coordinator.result()
+        # the expired leases were retried by the live workers
+        assert sum(future.result() for future in workers) == 12
+        assert not job_queue.complete('dead-worker', 1, 'success')
+    assert status == expected
+    assert sorted(os.listdir(target_dir)) == sorted(os.listdir(tmp_path / "local"))
+
+
+def test_coordinate_restarted_before_sealing(tmp_path):
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = copy_only_profile(working_dir, 6)
+    expected = batch_norm(profile, str(tmp_path / "local"), working_dir=str(working_dir))
+    queue_path = str(tmp_path / "jobs.sqlite")
+    target_dir = str(tmp_path / "output")
+
+    def dying_profile():
+        yield from profile[:4]
+        raise RuntimeError('coordinator killed')
+
+    with SQLiteJobQueue(queue_path) as job_queue:
+        with pytest.raises(RuntimeError):
+            coordinate(dying_profile(), job_queue, target_dir, str(working_dir), chunk_size=2)
+        assert job_queue.progress() == (0, 2, False)
+    with SQLiteJobQueue(queue_path) as job_queue, ThreadPoolExecutor(max_workers=2) as pool:
+        coordinator = pool.submit(coordinate, profile, job_queue, target_dir, str(working_dir), poll_interval=0.05,
+                                  chunk_size=2)
+        worker = pool.submit(run_worker, job_queue, worker_id='worker', poll_interval=0.05)
+        status = coordinator.result(timeout=10)
+        # the files queued before the restart are converted once
+        assert worker.result(timeout=10) == 6
+        assert job_queue.progress() == (6, 6, True)
+    assert status == expected
+
+
+def test_job_queue_gives_up_after_max_attempts(tmp_path):
+    with SQLiteJobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=0, max_attempts=2) as job_queue:
+        job_queue.add([{'TYPE': 'File', 'MIME_TYPE': 'text/plain', 'FILE_PATH': '/missing.txt'}])
+        job_queue.seal()
+        assert len(job_queue.lease('a')) == 1
+        assert len(job_queue.lease('b')) == 1
+        assert job_queue.lease('c') == []
+        assert job_queue.progress() == (1, 1, True)
+        [(item, outcome, notes)] = job_queue.results()
+        assert outcome == 'fail' and notes == {'lease': 'expired'}
+
+
+def test_coordinate_finishes_when_every_worker_dies(tmp_path):
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = copy_only_profile(working_dir, 3)[1:]
+    with SQLiteJobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=0.2, max_attempts=1) as job_queue:
+        job_queue.configure(str(working_dir), str(tmp_path / "output"))
+        job_queue.add(profile)
+        job_queue.seal()
+        assert len(job_queue.lease('dead-worker', count=3)) == 3
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            coordinator = pool.submit(coordinate, [], job_queue, str(tmp_path / "output"), str(working_dir),
+                                      poll_interval=0.05)
+            status = coordinator.result(timeout=5)
+    assert status['fail'] == [item['FILE_PATH'] for item in profile]
+
+
+def test_job_queue_is_abstract():
+    with pytest.raises(TypeError):
+        normalize.JobQueue()
+
+
+def test_batch_norm_results_db(tmp_path):
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = copy_only_profile(working_dir, 6)
+    (working_dir / 'broken.wav').write_bytes(b'not audio')
+    profile.append({'TYPE': 'File', 'MIME_TYPE': 'audio/x-wav', 'PUID': 'fmt/141', 'FILE_PATH': str(working_dir / 'broken.wav')})
+    results_db = str(tmp_path / "results.sqlite")
+    expected = batch_norm(profile, str(tmp_path / "listed"), working_dir=str(working_dir))
+
+    status = batch_norm(profile, str(tmp_path / "output"), working_dir=str(working_dir), results_db=results_db, resume=True)
+    # only counts are kept in memory; the paths are in the store
+    assert (status['success'], status['success_copy'], status['fail']) == (0, 6, 1)
+    assert {key: value for key, value in status.items() if not isinstance(value, int)} == \
+           {key: value for key, value in expected.items() if not isinstance(value, (int, list))}
+
+    status = batch_norm(profile, str(tmp_path / "output"), working_dir=str(working_dir), results_db=results_db, resume=True)
+    assert status['skipped'] == 6
+
+    with RunResults(results_db) as results:
+        columns, runs = results.query('runs')
+        assert len(runs) == 2 and json.loads(runs[0][-1])['success_copy'] == 6
+        assert results.query('failures', run_id=1)[1] == [(str(working_dir / 'broken.wav'), 'audio/x-wav', 'fmt/141', 'norm_to_mp3')]
+        assert results.query('failures-by-mime', run_id=1) == (['mime', 'files'], [('audio/x-wav', 1)])
+        columns, rows = results.query('unnormalized-types')
+        assert sorted(row[:3] for row in rows) == [('application/x-unknown', 'undefined', 3), ('text/plain', 'unnormalized', 3)]
+        assert dict((outcome, files) for outcome, files, size in results.query('summary')[1]) == \
+               {'fail': 1, 'unnormalized': 3, 'undefined': 3}
+
+
+def test_batch_norm_results_db_bounds_jobs_and_skips_summary_on_error(tmp_path, monkeypatch):
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = copy_only_profile(working_dir, 4)
+    results_db = str(tmp_path / "results.sqlite")
+    run_jobs = normalize.run_jobs
+    bounds = []
+
+    def recording_run_jobs(*args, **kwargs):
+        bounds.append(kwargs['max_pending'])
+        return run_jobs(*args, **kwargs)
+
+    monkeypatch.setattr(normalize, 'run_jobs', recording_run_jobs)
+    batch_norm(profile, str(tmp_path / "output"), working_dir=str(working_dir), results_db=results_db, workers=2)
+    batch_norm(profile, str(tmp_path / "output"), working_dir=str(working_dir), workers=2)
+    assert bounds == [normalize.results_db_pending, None]
+
+    def dying_profile():
+        yield from profile[:3]
+        raise RuntimeError('DROID died')
+
+    try:
+        raise KeyError('handled by the caller')
+    except KeyError:
+        # the caller's handled exception must not stop the summary of a run that finished
+        batch_norm(profile, str(tmp_path / "again"), working_dir=str(working_dir), results_db=results_db)
+        with pytest.raises(RuntimeError):
+            batch_norm(dying_profile(), str(tmp_path / "dead"), working_dir=str(working_dir), results_db=results_db)
+    with RunResults(results_db) as results:
+        columns, runs = results.query('runs')
+        recorded = [sum(files for outcome, files, size in results.query('summary', run_id=run[0])[1]) for run in runs]
+    assert [run[2] is not None for run in runs] == [True, True, False]
+    # the dead run keeps the results it recorded
+    assert recorded[:2] == [4, 4] and recorded[2] > 0
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_watch_and_normalize(tmp_path, monkeypatch, use_inotify):
+    script = tmp_path / "fake_droid.py"
+    script.write_text(fake_droid)
+    monkeypatch.setattr(normalize, 'droid_cmd', f'{sys.executable} {script}')
+    working_dir = tmp_path / "hot"
+    target_dir = tmp_path / "output"
+    working_dir.mkdir()
+    (working_dir / 'waiting.txt').write_text('already here')
+
+    def wait_for(condition):
+        deadline = time.monotonic() + 10
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+    stop = threading.Event()
+    with ThreadPoolExecutor(1) as pool:
+        watching = pool.submit(watch_and_normalize, str(working_dir), str(target_dir), settle_seconds=0.3,
+                               batch_wait=0.2, poll_interval=0.1, use_inotify=use_inotify, initial_scan=True, stop=stop)
+        wait_for(lambda: (target_dir / 'waiting.txt').exists())
+        (working_dir / 'new folder').mkdir()
+        (working_dir / 'new folder' / 'report.txt').write_text('first draft')
+        (working_dir / 'upload.txt.part').write_text('partial')
+        wait_for(lambda: (target_dir / 'new folder' / 'report.txt').exists())
+        os.rename(working_dir / 'upload.txt.part', working_dir / 'upload.txt')
+        wait_for(lambda: (target_dir / 'upload.txt').exists())
+        # a modified file replaces its earlier output
+        time.sleep(0.05)
+        (working_dir / 'new folder' / 'report.txt').write_text('final version')
+        wait_for(lambda: (target_dir / 'new folder' / 'report.txt').read_text() == 'final version')
+        stop.set()
+        totals = watching.result(timeout=10)
+    assert totals == {'f_count': 4, 'success': 0, 'success_copy': 4, 'fail': 0}
+    assert not (target_dir / 'upload.txt.part').exists()
+
+
+def test_inotify_overflow_watches_lost_directories(tmp_path, monkeypatch):
+    for name in ('old1.txt', 'old2.txt', 'old3.txt'):
+        (tmp_path / name).write_text('already here')
+    try:
+        watcher = normalize.InotifyWatcher(str(tmp_path))
+    except OSError:
+        pytest.skip('inotify is not available')
+    try:
+        (tmp_path / 'lost').mkdir()
+        (tmp_path / 'lost' / 'early.txt').write_text('early')
+        read = os.read
+        overflowed = []
+
+        def overflowing_read(fd, size):
+            if overflowed:
+                return read(fd, size)
+            # the queued events are dropped, as the kernel does when its queue overflows
+            while True:
+                try:
+                    read(fd, size)
+                except BlockingIOError:
+                    break
+            overflowed.append(True)
+            return normalize.struct.pack('iIII', -1, normalize.IN_Q_OVERFLOW, 0, 0)
+
+        (tmp_path / 'old2.txt').write_text('changed meanwhile')
+        monkeypatch.setattr(normalize.os, 'read', overflowing_read)
+        # only the files that differ from what was last seen are reported, not the whole tree
+        assert watcher.changes(1) == {str(tmp_path / 'lost' / 'early.txt'), str(tmp_path / 'old2.txt')}
+        (tmp_path / 'lost' / 'late.txt').write_text('late')
+        assert watcher.changes(1) == {str(tmp_path / 'lost' / 'late.txt')}
+        # files reported by their events are not reported again by a later overflow
+        overflowed.clear()
+        (tmp_path / 'upload.part').write_text('ignored, but wakes the watcher')
+        assert watcher.changes(1) == set()
+    finally:
+        watcher.close()
+
+
+def test_batch_norm_expand_archives(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "ffmpeg").write_text(fake_ffmpeg)
+    (bin_dir / "ffmpeg").chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    working_dir = tmp_path / "input"
+    (working_dir / "accession").mkdir(parents=True)
+    members = {'notes.txt': b'some notes', 'audio/one.wav': b'RIFF' + b'1' * 40, 'audio/two.wav': b'RIFF' + b'2' * 60,
+               'audio/three.wav': b'RIFF' + b'3' * 20, 'data.bin': b'\x00\x01'}
+    with zipfile.ZipFile(working_dir / "accession" / "bundle.zip", 'w') as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+        archive.writestr('../escape.txt', b'outside')
+    with tarfile.open(working_dir / "box.tar.gz", 'w:gz') as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    (working_dir / "loose.txt").write_text('loose')
+    (working_dir / "fake.zip").write_bytes(b'not a zip')
+    profile = [{'TYPE': 'File', 'MIME_TYPE': 'application/zip', 'FILE_PATH': str(working_dir / "accession" / "bundle.zip")},
+               {'TYPE': 'File', 'MIME_TYPE': 'application/gzip', 'FILE_PATH': str(working_dir / "box.tar.gz")},
+               {'TYPE': 'File', 'MIME_TYPE': 'text/plain', 'FILE_PATH': str(working_dir / "loose.txt")},
+               {'TYPE': 'File', 'MIME_TYPE': 'application/zip', 'FILE_PATH': str(working_dir / "fake.zip")}]
+    target_dir = tmp_path / "output"
+    scratch_dir = tmp_path / "scratch"
+    scratch_dir.mkdir()
+
+    status = batch_norm(profile, str(target_dir), working_dir=str(working_dir), workers=3, expand_archives=True,
+                        scratch_dir=str(scratch_dir), scratch_bytes=70)
+    assert status['archives'] == 2
+    assert len(status['success']) == 6
+    assert len(status['success_copy']) == 6
+    assert status['fail'] == []
+    for root in (target_dir / "accession" / "bundle", target_dir / "box"):
+        assert (root / 'notes.txt').read_bytes() == b'some notes'
+        assert (root / 'data.bin').read_bytes() == b'\x00\x01'
+        for name in ('one', 'two', 'three'):
+            assert (root / 'audio' / f'{name}.mp3').read_bytes() == members[f'audio/{name}.wav']
+    assert not (target_dir / "accession" / "escape.txt").exists()
+    assert (target_dir / "fake.zip").read_bytes() == b'not a zip'
+    assert not (target_dir / "box.tar.gz").exists()
+    assert status['bytes_streamed'] == 2 * (len(members['notes.txt']) + len(members['data.bin']))
+    assert status['bytes_spooled'] == 2 * (44 + 64 + 24)
+    # converted members went through the scratch space, which never held more than fits or one member alone
+    assert all(line.startswith(str(scratch_dir)) for line in (bin_dir / 'runs').read_text().split())
+    assert 0 < status['scratch_peak_bytes'] <= 70
+    assert os.listdir(scratch_dir) == []
+
+
+def test_expand_archives_member_roots_and_probing(tmp_path, monkeypatch):
+    working_dir = tmp_path / "input"
+    (working_dir / "photos").mkdir(parents=True)
+    (working_dir / "photos" / "a.txt").write_text('on disk')
+    with zipfile.ZipFile(working_dir / "photos.zip", 'w') as archive:
+        archive.writestr('a.txt', b'from the zip')
+    with zipfile.ZipFile(working_dir / "scans.zip", 'w') as archive:
+        archive.writestr('b.txt', b'from zip')
+    with tarfile.open(working_dir / "scans.tar", 'w') as archive:
+        info = tarfile.TarInfo('b.txt')
+        info.size = 8
+        archive.addfile(info, io.BytesIO(b'from tar'))
+    profile = [{'TYPE': 'File', 'MIME_TYPE': 'text/plain', 'FILE_PATH': str(working_dir / "photos" / "a.txt")},
+               {'TYPE': 'File', 'MIME_TYPE': 'application/zip', 'FILE_PATH': str(working_dir / "photos.zip")},
+               {'TYPE': 'File', 'MIME_TYPE': 'application/zip', 'FILE_PATH': str(working_dir / "scans.zip")},
+               {'TYPE': 'File', 'MIME_TYPE': 'application/x-tar', 'FILE_PATH': str(working_dir / "scans.tar")}]
+    probes = []
+    for module, name in ((zipfile, 'is_zipfile'), (tarfile, 'is_tarfile')):
+        def probe(path, original=getattr(module, name), name=name):
+            probes.append((name, os.path.basename(path)))
+            return original(path)
+        monkeypatch.setattr(module, name, probe)
+    target_dir = tmp_path / "output"
+
+    status = batch_norm(profile, str(target_dir), working_dir=str(working_dir), expand_archives=True)
+    assert status['archives'] == 3 and status['fail'] == []
+    # a directory or archive already claiming the stripped name moves the members aside
+    assert (target_dir / "photos" / "a.txt").read_text() == 'on disk'
+    assert (target_dir / "photos.zip.d" / "a.txt").read_text() == 'from the zip'
+    assert (target_dir / "scans.zip.d" / "b.txt").read_text() == 'from zip'
+    assert (target_dir / "scans.tar.d" / "b.txt").read_text() == 'from tar'
+    assert not (target_dir / "scans").exists()
+    # each archive is probed once, and read with the kind found
+    assert probes == [('is_zipfile', 'photos.zip'), ('is_zipfile', 'scans.zip'), ('is_zipfile', 'scans.tar'),
+                      ('is_tarfile', 'scans.tar')]
+
+
+def test_scratch_space_limit(tmp_path):
+    with ScratchSpace(str(tmp_path), max_bytes=10) as scratch:
+        first = scratch.spool('a.wav', 6, b'abc', io.BytesIO(b'def'))
+        spooled = []
+        waiting = threading.Thread(target=lambda: spooled.append(scratch.spool('b.wav', 6, b'', io.BytesIO(b'123456'))))
+        waiting.start()
+        time.sleep(0.2)
+        assert spooled == [] and scratch.used == 6
+        scratch.discard(first, 6)
+        waiting.join(5)
+        assert open(spooled[0], 'rb').read() == b'123456'
+        # larger than the limit, so it waits until the space is empty and then has it alone
+        scratch.discard(spooled[0], 6)
+        big = scratch.spool('c.wav', 25, b'x' * 25, io.BytesIO())
+        assert scratch.peak == 25
+        scratch.discard(big, 25)
+        assert not os.path.exists(os.path.dirname(big))
+    assert not os.path.exists(scratch.path)
+
+
+fake_soffice = """
+import os, sys, time
+args = sys.argv[1:]
+fmt = args[args.index('--convert-to') + 1]
+outdir = args[args.index('--outdir') + 1]
+for path in args[args.index('--outdir') + 2:]:
+    with open(os.path.join(outdir, os.path.splitext(os.path.basename(path))[0] + '.' + fmt), 'w') as f:
+        f.write(fmt)
+# use some CPU for the batch to be charged
+deadline = time.process_time() + 0.2
+while time.process_time() < deadline:
+    pass
+"""
+
+
+def test_pooled_documents_share_the_batch_usage(tmp_path, monkeypatch):
+    script = tmp_path / "soffice.py"
+    script.write_text(fake_soffice)
+    monkeypatch.setattr(normalize, 'libreoffice_cmd', str(tmp_path / "soffice"))
+    (tmp_path / "soffice").write_text(f'#!/bin/sh\nexec {sys.executable} {script} "$@"\n')
+    (tmp_path / "soffice").chmod(0o755)
+    working_dir = tmp_path / "input"
+    working_dir.mkdir()
+    profile = []
+    for i in range(4):
+        (working_dir / f'doc{i}.odt').write_text('document')
+        profile.append({'TYPE': 'File', 'MIME_TYPE': 'application/vnd.oasis.opendocument.text',
+                        'FILE_PATH': str(working_dir / f'doc{i}.odt')})
+    event_log = tmp_path / "events.jsonl"
+
+    with LibreOfficePool(size=1, batch_size=4) as pool:
+        status = batch_norm(profile, str(tmp_path / "output"), working_dir=str(working_dir), libreoffice_pool=pool,
+                            event_log=str(event_log))
+    assert len(status['success']) == 4
+    events = [json.loads(line) for line in event_log.read_text().splitlines()]
+    assert len(events) == 4
+    assert len({event['cpu_seconds'] for event in events}) == 1
+    assert 0.15 < sum(event['cpu_seconds'] for event in events) < 2
+    assert all(event['max_rss_kb'] > 0 and event['exit_code'] == 0 for event in events)
+    assert abs(status['cpu_seconds'] - sum(event['cpu_seconds'] for event in events)) < 1e-6
+
+
+def test_cost_model_probes_in_parallel(tmp_path, monkeypatch):
+    script = tmp_path / "ffprobe"
+    # the duration in seconds is the file's size in bytes
+    script.write_text('#!/bin/sh\necho "$@" >> "$(dirname "$0")/probes"\nsleep 0.3\n'
+                      'for last; do :; done\necho "{\\"format\\": {\\"duration\\": \\"$(wc -c < "$last")\\"}}"\n')
+    script.chmod(0o755)
+    monkeypatch.setattr(normalize, 'ffprobe_cmd', str(script))
+    items = []
+    for i in range(6):
+        (tmp_path / f'{i}.wav').write_bytes(b'0' * (i + 1) * 1000)
+        items.append({'TYPE': 'File', 'MIME_TYPE': 'audio/x-wav', 'FILE_PATH': str(tmp_path / f'{i}.wav')})
+    items.append({'TYPE': 'File', 'MIME_TYPE': 'text/plain', 'FILE_PATH': str(tmp_path / '0.wav')})
 
+    model = CostModel(probe_media=True)
+    engine = ToolEngine()
+    try:
+        with normalize.using_tool_engine(engine):
+            started = time.monotonic()
+            model.probe(items, workers=6)
+            assert time.monotonic() - started < 1.2
+    finally:
+        engine.close()
+    assert model.durations == {item['FILE_PATH']: (i + 1) * 1000 for i, item in enumerate(items[:6])}
+    # the jobs are then ordered by duration without probing again
+    assert lpt_order([('ffmpeg', [item]) for item in items], model) == [5, 4, 3, 2, 1, 0, 6]
+    assert len((tmp_path / 'probes').read_text().splitlines()) == 6
+    # without probe_media nothing is probed
+    assert CostModel().estimate(items[0]) > 0
+    assert len((tmp_path / 'probes').read_text().splitlines()) == 6
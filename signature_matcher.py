@@ -0,0 +1,327 @@
+import os
+import re
+import sys
+import mmap
+import time
+import argparse
+import xml.etree.ElementTree as ET
+
+
+# Formats whose binary signature only says "some container"; DROID refines these with its container signatures
+container_puids = {'x-fmt/263', 'fmt/111', 'x-fmt/265', 'x-fmt/266'}
+
+
+class SignatureMatcher:
+    """
+    Identifies files in-process from a DROID binary signature file.
+
+    The signature file is parsed once and every byte sequence is compiled into a regular expression. A file
+    is identified from its first and last `window` bytes, read through mmap, or from all of it when it is
+    small enough. identify() only answers when the result is certain to be what DROID would report from the
+    same signature file, and returns None otherwise so the caller can fall back to DROID:
+
+    - no signature matched (DROID would fall back to extension matching),
+    - more than one format is left after applying priorities,
+    - the winner is a generic container format DROID refines with container signatures, or
+    - a signature that could not be checked within the window belongs to a format with priority over the winner.
+
+    Parameters:
+    signature_file (str): The path to a DROID_SignatureFile_V*.xml file.
+    window (int): The number of bytes read from each end of a file.
+    """
+
+    def __init__(self, signature_file, window=64 * 1024):
+        self.window = window
+        self.formats = {}
+        self.signatures = []
+        root = ET.parse(signature_file).getroot()
+        ns = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+
+        signature_formats = {}
+        for fmt in root.iter(f'{ns}FileFormat'):
+            format_id = fmt.get('ID')
+            self.formats[format_id] = {
+                'PUID': fmt.get('PUID', ''),
+                'MIME_TYPE': fmt.get('MIMEType', ''),
+                'FORMAT_NAME': fmt.get('Name', ''),
+                'FORMAT_VERSION': fmt.get('Version', ''),
+                'priority_over': {p.text for p in fmt.findall(f'{ns}HasPriorityOverFileFormatID')},
+            }
+            for sig in fmt.findall(f'{ns}InternalSignatureID'):
+                signature_formats.setdefault(sig.text, []).append(format_id)
+
+        for sig in root.iter(f'{ns}InternalSignature'):
+            format_ids = signature_formats.get(sig.get('ID'))
+            if not format_ids:
+                continue
+            try:
+                sequences = [compile_byte_sequence(seq, ns) for seq in sig.findall(f'{ns}ByteSequence')]
+            except ValueError:
+                # syntax this matcher does not understand; those formats always go to DROID
+                sequences = None
+            self.signatures.append((format_ids, sequences))
+
+    def identify(self, filepath):
+        """
+        Returns a dict with the PUID, MIME_TYPE, FORMAT_NAME and FORMAT_VERSION of a file, or None if DROID is needed.
+        """
+        size = os.path.getsize(filepath)
+        with open(filepath, 'rb') as f:
+            if size == 0:
+                header = trailer = b''
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if size <= 2 * self.window:
+                        header = trailer = mm[:]
+                    else:
+                        header = mm[:self.window]
+                        trailer = mm[-self.window:]
+        return self._identify(header, trailer, size <= 2 * self.window, filepath)
+
+    def identify_header(self, header, size):
+        """
+        Identifies a stream, such as an archive member, from its first bytes without a file on disk.
+        Unless header holds all size bytes, signatures anchored to the end of the stream cannot be checked.
+
+        Returns:
+        dict: As identify, with FILE_PATH None, or None if DROID is needed.
+        """
+        whole_file = len(header) >= size
+        return self._identify(header, header if whole_file else None, whole_file, None)
+
+    def _identify(self, header, trailer, whole_file, filepath):
+        matched = set()
+        undecided = set()
+        for format_ids, sequences in self.signatures:
+            result = signature_matches(sequences, header, trailer, whole_file, self.window)
+            if result is None:
+                undecided.update(format_ids)
+            elif result:
+                matched.update(format_ids)
+
+        if not matched:
+            return None
+        beaten = set()
+        for format_id in matched:
+            beaten |= self.formats[format_id]['priority_over']
+        winners = matched - beaten
+        if len(winners) != 1:
+            return None
+        winner = winners.pop()
+        if self.formats[winner]['PUID'] in container_puids:
+            return None
+        if any(winner in self.formats[f]['priority_over'] for f in undecided - matched):
+            return None
+
+        fmt = self.formats[winner]
+        return {'FILE_PATH': filepath, 'PUID': fmt['PUID'], 'MIME_TYPE': fmt['MIME_TYPE'],
+                'FORMAT_NAME': fmt['FORMAT_NAME'], 'FORMAT_VERSION': fmt['FORMAT_VERSION'], 'METHOD': 'Signature'}
+
+
+def signature_matches(sequences, header, trailer, whole_file, window):
+    """
+    Returns True or False if every byte sequence of a signature was checked, or None if one could not be.
+    trailer is None when the end of the file is unknown.
+    """
+    if sequences is None:
+        return None
+    undecided = False
+    for anchor, pattern, extent in sequences:
+        if anchor == 'BOF':
+            found = pattern.match(header) is not None
+            fits = whole_file or (extent is not None and extent <= window)
+        elif anchor == 'EOF':
+            # without a trailer (a stream read from the start) end-anchored sequences stay undecided
+            found = trailer is not None and pattern.search(trailer) is not None
+            fits = trailer is not None and (whole_file or (extent is not None and extent <= window))
+        else:
+            found = pattern.search(header) is not None
+            fits = whole_file
+        if not found:
+            if fits:
+                return False
+            undecided = True
+    return None if undecided else True
+
+
+def compile_byte_sequence(element, ns=''):
+    """
+    Compiles a ByteSequence element into (anchor, regex, extent).
+
+    The anchor is 'BOF', 'EOF' or 'VAR'. The extent is the furthest from its anchor a match can reach,
+    or None when it is unbounded.
+    """
+    reference = element.get('Reference', '')
+    anchor = 'BOF' if reference.startswith('BOF') else 'EOF' if reference.startswith('EOF') else 'VAR'
+    subsequences = sorted(element.findall(f'{ns}SubSequence'), key=lambda e: int(e.get('Position', 1)))
+    if not subsequences:
+        raise ValueError('ByteSequence without SubSequence')
+
+    parts = []
+    extent = 0
+    for sub in subsequences:
+        sub_regex, sub_width = compile_subsequence(sub, ns)
+        gap_min = int(sub.get('SubSeqMinOffset', 0))
+        gap_max = max(int(sub.get('SubSeqMaxOffset', gap_min)), gap_min)
+        gap = gap_regex(gap_min, gap_max)
+        # BOF offsets are measured from the start, EOF offsets back from the end of the file
+        parts.append((gap, sub_regex) if anchor != 'EOF' else (sub_regex, gap))
+        extent = None if extent is None or sub_width is None else extent + gap_max + sub_width
+
+    if anchor == 'EOF':
+        regex = b''.join(sub + gap for sub, gap in reversed(parts)) + rb'\Z'
+    elif anchor == 'BOF':
+        regex = b''.join(gap + sub for gap, sub in parts)
+    else:
+        # the first gap of a variable sequence is meaningless, it can start anywhere
+        regex = parts[0][1] + b''.join(gap + sub for gap, sub in parts[1:])
+        extent = None
+    return anchor, re.compile(regex, re.DOTALL), extent
+
+
+def compile_subsequence(sub, ns=''):
+    """
+    Compiles a SubSequence, its anchoring Sequence plus left and right fragments, into a regex and its maximum width.
+    """
+    sequence = sub.find(f'{ns}Sequence')
+    if sequence is None or not sequence.text:
+        raise ValueError('SubSequence without Sequence')
+    regex, width = compile_hex(sequence.text)
+
+    for side in ('Left', 'Right'):
+        by_position = {}
+        for frag in sub.findall(f'{ns}{side}Fragment'):
+            by_position.setdefault(int(frag.get('Position', 1)), []).append(frag)
+        for position in sorted(by_position):
+            alternatives = [compile_hex(frag.text or '') for frag in by_position[position]]
+            frag = by_position[position][0]
+            gap_min = int(frag.get('MinOffset', 0))
+            gap_max = max(int(frag.get('MaxOffset', gap_min)), gap_min)
+            frag_regex = b'(?:' + b'|'.join(r for r, w in alternatives) + b')'
+            frag_widths = [w for r, w in alternatives]
+            frag_width = None if None in frag_widths else max(frag_widths)
+            if side == 'Left':
+                regex = frag_regex + gap_regex(gap_min, gap_max) + regex
+            else:
+                regex = regex + gap_regex(gap_min, gap_max) + frag_regex
+            width = None if width is None or frag_width is None else width + gap_max + frag_width
+    return regex, width
+
+
+def gap_regex(gap_min, gap_max):
+    if gap_max == 0:
+        return b''
+    return b'.{%d,%d}' % (gap_min, gap_max)
+
+
+token_re = re.compile(r"\s*(?:(?P<hex>[0-9A-Fa-f]{2})|(?P<any>\?\?)|\[(?P<neg>!)?(?P<lo>[0-9A-Fa-f]{2})(?::(?P<hi>[0-9A-Fa-f]{2}))?\]"
+                      r"|\{(?P<gmin>\d+)(?:-(?P<gmax>\d+|\*))?\}|(?P<star>\*)|'(?P<text>[^']*)'|(?P<open>\()|(?P<bar>\|)|(?P<close>\)))")
+
+
+def compile_hex(text):
+    """
+    Compiles a PRONOM hex sequence, e.g. "4D5A{2-4}[00:1F]??(0D|0A)", into a bytes regex and its maximum width.
+    """
+    regex, width, pos = compile_hex_group(text, 0)
+    if text[pos:].strip():
+        raise ValueError(f'Unexpected {text[pos:]!r} in sequence')
+    return regex, width
+
+
+def compile_hex_group(text, pos, nested=False):
+    alternatives = [(b'', 0)]
+    while pos < len(text):
+        m = token_re.match(text, pos)
+        if not m or not m.group(0).strip():
+            if text[pos:].strip():
+                raise ValueError(f'Unexpected {text[pos:]!r} in sequence')
+            pos = len(text)
+            break
+        regex, width = alternatives[-1]
+        if m.group('close'):
+            if not nested:
+                raise ValueError('Unbalanced ) in sequence')
+            break
+        pos = m.end()
+        if m.group('bar'):
+            if not nested:
+                raise ValueError('| outside of a group')
+            alternatives.append((b'', 0))
+            continue
+        if m.group('hex'):
+            piece, piece_width = re.escape(bytes.fromhex(m.group('hex'))), 1
+        elif m.group('any'):
+            piece, piece_width = b'.', 1
+        elif m.group('lo'):
+            lo = bytes.fromhex(m.group('lo'))
+            hi = bytes.fromhex(m.group('hi') or m.group('lo'))
+            piece = b'[' + (b'^' if m.group('neg') else b'') + re.escape(lo) + b'-' + re.escape(hi) + b']'
+            piece_width = 1
+        elif m.group('gmin'):
+            gmin = int(m.group('gmin'))
+            gmax = m.group('gmax')
+            if gmax == '*':
+                piece, piece_width = b'.{%d,}' % gmin, None
+            else:
+                gmax = int(gmax) if gmax else gmin
+                piece, piece_width = b'.{%d,%d}' % (gmin, gmax), gmax
+        elif m.group('star'):
+            piece, piece_width = b'.*', None
+        elif m.group('text') is not None:
+            literal = m.group('text').encode('latin-1')
+            piece, piece_width = re.escape(literal), len(literal)
+        else:
+            inner, inner_width, pos = compile_hex_group(text, pos, nested=True)
+            m = token_re.match(text, pos)
+            if not m or not m.group('close'):
+                raise ValueError('Unbalanced ( in sequence')
+            pos = m.end()
+            piece, piece_width = inner, inner_width
+        alternatives[-1] = (regex + piece, None if width is None or piece_width is None else width + piece_width)
+
+    if len(alternatives) == 1:
+        return alternatives[0][0], alternatives[0][1], pos
+    widths = [w for r, w in alternatives]
+    return (b'(?:' + b'|'.join(r for r, w in alternatives) + b')',
+            None if None in widths else max(widths), pos)
+
+
+if __name__ == '__main__':
+    """
+    Benchmarks the in-process matcher against DROID's identify_file over the files in a directory and reports any disagreement.
+
+    Usage:
+    python signature_matcher.py <dirpath> [--signature-file DROID_SignatureFile_V111.xml]
+    """
+    from normalize import identify_file, droid_sign_file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dirpath', help='The directory of files to identify')
+    parser.add_argument('--signature-file', default=droid_sign_file, help='The DROID signature file to compile')
+    parser.add_argument('--skip-droid', action='store_true', help='Only time the in-process matcher')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    matcher = SignatureMatcher(args.signature_file)
+    load_time = time.perf_counter() - started
+    paths = [os.path.join(root, name) for root, dirs, names in os.walk(args.dirpath) for name in names]
+
+    started = time.perf_counter()
+    results = {path: matcher.identify(path) for path in paths}
+    match_time = time.perf_counter() - started
+    identified = sum(1 for r in results.values() if r)
+    print(f'Compiled {len(matcher.signatures)} signatures in {load_time:.2f}s')
+    print(f'Matcher: {identified}/{len(paths)} files identified in {match_time:.3f}s '
+          f'({len(paths) / match_time if match_time else 0:.0f} files/s), the rest would fall back to DROID')
+
+    if not args.skip_droid:
+        mismatches = 0
+        started = time.perf_counter()
+        for path in paths:
+            droid_puid = identify_file(path).get('PUID')
+            if results[path] and results[path]['PUID'] != droid_puid:
+                mismatches += 1
+                print(f'MISMATCH {path}: matcher {results[path]["PUID"]}, DROID {droid_puid}', file=sys.stderr)
+        droid_time = time.perf_counter() - started
+        print(f'DROID: {len(paths)} files in {droid_time:.1f}s ({len(paths) / droid_time if droid_time else 0:.1f} files/s)')
+        print(f'{mismatches} mismatches between the matcher and DROID')